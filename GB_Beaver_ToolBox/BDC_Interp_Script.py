@@ -9,210 +9,140 @@
 ########################################################################################################################
 ########################################################################################################################
 
+from __future__ import print_function
+
 import sys
-import arcpy
 import os
+import shutil
+import tempfile
 import numpy as np
-arcpy.env.overwriteOutput = True
-arcpy.CheckOutExtension("spatial")
-
-
-def main(bdc_nets, s_zone, zones_out):
-    scratchPath = os.path.abspath(os.path.join(__file__, os.pardir))
-    scratchName = "scratch.gdb"
-    scratch = os.path.join(scratchPath, scratchName)
 
-    if arcpy.Exists(scratch):
-        print("scratch gdb exists - Deleting")
-        arcpy.Delete_management(scratch) # turned off for testing
-
-    arcpy.CreateFileGDB_management(scratchPath, scratchName)
+import BDC_Network_Cache
+import BDC_Stats_Core
+import Beaver_NumPy_Utils
+import Run_Trace
+import Zone_Parallel
+import Zone_Schedule
+
+# without ArcGIS only the NumPy backend (Beaver_NumPy_Utils) can be used
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+if arcpy is not None:
+    import Beaver_Arc_Utils
+    arcpy.env.overwriteOutput = True
+
+
+def zone_worker(task):
+    """Overlay the BDC network with one run of the zone schedule in a private scratch gdb and return the BDC
+    fields of those zones."""
+    scratch = Beaver_Arc_Utils.make_scratch()
+    try:
+        zone_info = task["zone_info"]
+        if task["subset"]:
+            zone_info = Beaver_Arc_Utils.zone_subset(zone_info, scratch, zones=task["order"])
+
+        zone_ids = Beaver_Arc_Utils.zone_table(zone_info)[0]
+        # clipped reaches are folded into the accumulator chunk by chunk - a zone's reaches are never held at once.
+        acc = BDC_Stats_Core.BDCAccumulator(zone_ids, task["fieldset"])
+        if task["cache_dir"]:
+            network = BDC_Network_Cache.open_cache(task["cache_dir"])
+            # zones are projected on the fly to the network's coordinates, as Clip/Intersect would
+            sr = Beaver_Arc_Utils.spatial_reference(task["bdc_nets"][0])
+            BDC_Stats_Core.accumulate_zone_pieces(acc, Beaver_Arc_Utils.cache_zone_pieces(network, zone_info,
+                                                                                          task["order"],
+                                                                                          task["overlap"], sr))
+        else:
+            for zones, bdc, length in Beaver_Arc_Utils.overlay_chunks(task["bdc_copy"], zone_info, scratch, "BDC"):
+                acc.update(zones, bdc, length)
+        return acc.fields()
+    finally:
+        Beaver_Arc_Utils.remove_scratch(scratch)
+
+
+def main(bdc_nets, s_zone, zones_out, workers=1, cache_dir=None, result_cache=None, table_out=None, backend=None,
+         trace_out=None, profile=False, overlap=False, stats_spec=None):
+    # multi-value parameters arrive as a single "a;b;c" string
+    if hasattr(bdc_nets, "split"):
+        bdc_nets = [net.strip("'\"") for net in bdc_nets.split(";") if net]
+
+    Run_Trace.start(trace_out, str(profile).lower() in ("true", "1"))
+    overlap = str(overlap).lower() in ("true", "1")
+    try:
+        if (backend or ("arcpy" if arcpy is not None else "numpy")) == "numpy":
+            Beaver_NumPy_Utils.run_bdc(bdc_nets, s_zone, zones_out, workers, cache_dir, result_cache, table_out,
+                                       overlap=overlap, stats_spec=stats_spec or None)
+        else:
+            run_arcpy(bdc_nets, s_zone, zones_out, workers, cache_dir, result_cache, table_out, overlap,
+                      stats_spec or None)
+    finally:
+        Run_Trace.finish(arcpy.AddMessage if arcpy is not None else print)
+
+
+def run_arcpy(bdc_nets, s_zone, zones_out, workers=1, cache_dir=None, result_cache=None, table_out=None,
+              overlap=False, stats_spec=None):
+    arcpy.CheckOutExtension("spatial")
+    scratch = Beaver_Arc_Utils.make_scratch()
+    fieldset = BDC_Stats_Core.field_set(stats_spec)
 
     if arcpy.Exists(zones_out):
         arcpy.Delete_management(zones_out)
 
-    bdc_copy = os.path.join(scratch, "bdc_copy")
-    if len(bdc_nets) > 1:
-        print("merging bdc files")
-        arcpy.Merge_management(bdc_nets, bdc_copy)
-    elif len(bdc_nets) == 1:
-        arcpy.CopyFeatures_management(bdc_nets[0], bdc_copy)
-    else:
-        print("no bdc features supplied") # also worth raising error here perhaps????
-
-    # arcpy.AddField_management(bdc_copy, field_name="BDC_CAT", field_type="SHORT")
-    # print("Running BHI Stand Alone Script")
-
-    # classifying_zones
-    sZone_fields = [f.name for f in arcpy.ListFields(s_zone)]
-    if "Zone_no" in sZone_fields:
-        arcpy.DeleteField_management(s_zone, "Zone_no")
-
-    zone_info = os.path.join(scratch, "tmp_shp_copy")
-    arcpy.CopyFeatures_management(s_zone, zone_info)
-
-    # create sequential numbers for reaches
-    arcpy.AddField_management(zone_info, "Zone_no", "LONG")
-
-    with arcpy.da.UpdateCursor(zone_info, ["Zone_no", 'OBJECTID']) as cursor:
-        for row in cursor:
-            row[0] = row[1]
-
-            cursor.updateRow(row)
-
-    arcpy.AddField_management(zone_info, field_name="BDC_MEAN", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_W_AVG", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_TOT", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_MIN", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_MAX", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_STD", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_W_STD", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_P_NONE", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_P_RARE", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_P_OCC", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_P_FREQ", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_P_PERV", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_km_NONE", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_km_RARE", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_km_OCC", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_km_FREQ", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BDC_km_PERV", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="TOT_km", field_type="DOUBLE")
-
-    sz_fl = arcpy.MakeFeatureLayer_management(zone_info, "tempFL", "", r"in_memory")
-
-    n_feat = arcpy.GetCount_management(sz_fl)
-
-    tmp_table = os.path.join(r"in_memory", "temp_table")
-
-    with arcpy.da.SearchCursor(sz_fl, ["Zone_no"]) as cursor:
-        for row in cursor:
-            arcpy.AddMessage("working on feature {0}/{1}".format(row[0], n_feat))
-
-            expr = """{0} = {1}""".format('Zone_no', row[0])
-            arcpy.SelectLayerByAttribute_management(sz_fl,
-                                                    "NEW_SELECTION",
-                                                    expr)
-            out_shp = os.path.join(scratch, "op{0}".format(row[0]))
-
-            arcpy.CopyFeatures_management(sz_fl, out_shp)
-            tempshp = r"in_memory/tempshp"
-            # tempshp = os.path.join(scratch, "tempshp")  # SHALL WE GO WITH GDB SAVES OR IN-MEMORY... HMMM
-
-            arcpy.Clip_analysis(bdc_copy, out_shp, tempshp)
-
-            arcpy.AddMessage("converting bdc network to numpy array")
-            # bdc_arr = arcpy.da.FeatureClassToNumPyArray(tempshp, ("BDC", "SHAPE@LENGTH"))
-            bdcVal_arr = arcpy.da.FeatureClassToNumPyArray(tempshp, "BDC").astype(np.float)
-            if bdcVal_arr.size > 0:
-                lenVal_arr = arcpy.da.FeatureClassToNumPyArray(tempshp,  "SHAPE@LENGTH").astype(np.float)
-
-                arcpy.AddMessage("retrieving statistics from array")
-                total_length = np.sum(lenVal_arr)
-                no_cap_length = np.sum(lenVal_arr[bdcVal_arr <= 0])
-                rare_cap_length = np.sum(lenVal_arr[(bdcVal_arr > 0) & (bdcVal_arr <= 1)])
-                occ_cap_length = np.sum(lenVal_arr[(bdcVal_arr > 1) & (bdcVal_arr <= 4)])
-                freq_cap_length = np.sum(lenVal_arr[(bdcVal_arr > 4) & (bdcVal_arr <= 15)])
-                perv_cap_length = np.sum(lenVal_arr[bdcVal_arr > 15])
-
-
-                # weigh_arr = bdcVal_arr * lenVal_arr
-                # weigh_avg = np.sum(weigh_arr)/total_length
-                #standard stats
-                bdc_mean = np.mean(bdcVal_arr)
-                bdc_std = np.std(bdcVal_arr)
-                bdc_max = np.max(bdcVal_arr)
-                bdc_min = np.min(bdcVal_arr)
-                bdc_tot = np.sum(bdcVal_arr)
-
-                # weighted stats
-                bdc_w_avg = np.average(bdcVal_arr, weights=lenVal_arr) # weighted average
-                bdc_variance = np.average((bdcVal_arr - bdc_w_avg) ** 2, weights=lenVal_arr)  # weighted  variance and stDev
-                bdc_w_std = np.sqrt(bdc_variance)
-                arcpy.AddMessage("assigning bdc values to area shape file")
-
-                with arcpy.da.UpdateCursor(out_shp, ["BDC_MEAN", "BDC_W_AVG", "BDC_TOT", "BDC_MIN", "BDC_MAX","BDC_STD",
-                                                     "BDC_W_STD", "BDC_P_NONE", "BDC_P_RARE", "BDC_P_OCC", "BDC_P_FREQ",
-                                                     "BDC_P_PERV", "BDC_km_NONE", "BDC_km_RARE", "BDC_km_OCC",
-                                                     "BDC_km_FREQ", "BDC_km_PERV", "TOT_km"]) as cursord:
-                    for rowd in cursord:
-                        rowd[0] = round(float(bdc_mean), 2)
-                        rowd[1] = round(float(bdc_w_avg), 2)
-                        rowd[2] = round(float(bdc_tot), 2)
-                        rowd[3] = round(float(bdc_min), 2)
-                        rowd[4] = round(float(bdc_max), 2)
-                        rowd[5] = round(float(bdc_std), 2)
-                        rowd[6] = round(float(bdc_w_std), 2)
-                        rowd[7] = round(float((no_cap_length/total_length) * 100), 2)
-                        rowd[8] = round(float((rare_cap_length/total_length) * 100), 2)
-                        rowd[9] = round(float((occ_cap_length/total_length) * 100), 2)
-                        rowd[10] = round(float((freq_cap_length/total_length) * 100), 2)
-                        rowd[11] = round(float((perv_cap_length/total_length) * 100), 2)
-                        rowd[12] = round(float(no_cap_length/1000), 2)
-                        rowd[13] = round(float(rare_cap_length/1000), 2)
-                        rowd[14] = round(float(occ_cap_length/1000), 2)
-                        rowd[15] = round(float(freq_cap_length/1000), 2)
-                        rowd[16] = round(float(perv_cap_length/1000), 2)
-                        rowd[17] = round(float(total_length/1000), 2)
-
-                        cursord.updateRow(rowd)
-            else:
-                with arcpy.da.UpdateCursor(out_shp,
-                                           ["BDC_MEAN", "BDC_W_AVG", "BDC_TOT", "BDC_MIN", "BDC_MAX", "BDC_STD",
-                                            "BDC_W_STD", "BDC_P_NONE", "BDC_P_RARE", "BDC_P_OCC", "BDC_P_FREQ",
-                                            "BDC_P_PERV", "BDC_km_NONE", "BDC_km_RARE", "BDC_km_OCC",
-                                            "BDC_km_FREQ", "BDC_km_PERV", "TOT_km"]) as cursord:
-                    for rowd in cursord:
-                        rowd[0] = 0
-                        rowd[1] = 0
-                        rowd[2] = 0
-                        rowd[3] = 0
-                        rowd[4] = 0
-                        rowd[5] = 0
-                        rowd[6] = 0
-                        rowd[7] = 0
-                        rowd[8] = 0
-                        rowd[9] = 0
-                        rowd[10] = 0
-                        rowd[11] = 0
-                        rowd[12] = 0
-                        rowd[13] = 0
-                        rowd[14] = 0
-                        rowd[15] = 0
-                        rowd[16] = 0
-                        rowd[17] = 0
-
-                        cursord.updateRow(rowd)
-
-    zones_list = []
-
-    if arcpy.Exists(tempshp):
-        arcpy.Delete_management(zone_info)
-
-    walk = arcpy.da.Walk(scratch, datatype="FeatureClass", type="Polygon")
-
-    for dirpath, dirnames, filenames in walk:
-        for filename in filenames:
-            zones_list.append(os.path.join(dirpath, filename))
-
-    if len(zones_list) > 1:
-        arcpy.AddMessage("merging final features")
-        arcpy.Merge_management(zones_list, zones_out)
-    else:
-        arcpy.AddMessage("copying final features")
-        arcpy.CopyFeatures_management(zones_list[0], zones_out)
-
-    for fc in zones_list:
-        arcpy.Delete_management(fc)
-
-    if arcpy.Exists(scratch):
-        try:
-            arcpy.Delete_management(scratch)
-        except Exception:
-            print("An issue occured when deleting the scratch folder - not a big deal")
-
-    arcpy.Delete_management(r"in_memory")
-
+    workers = max(1, int(workers or 1))
+    # each parallel task would otherwise intersect the whole network with its zones, reading it 4 x workers times -
+    # the workers share one temporary network cache instead, as the NumPy backend does.
+    network_dir = cache_dir or (tempfile.mkdtemp(prefix="beaver_bdc_") if workers > 1 else None)
+
+    try:
+        bdc_copy = os.path.join(scratch, "bdc_copy")
+        if network_dir:
+            # the cached network is memory-mapped and spatially indexed - no merged copy is needed.
+            Beaver_Arc_Utils.open_network_cache(bdc_nets, network_dir)
+        elif len(bdc_nets) > 1:
+            print("merging bdc files")
+            with Run_Trace.phase("merge bdc networks"):
+                arcpy.Merge_management(bdc_nets, bdc_copy)
+        elif len(bdc_nets) == 1:
+            with Run_Trace.phase("copy bdc network"):
+                arcpy.CopyFeatures_management(bdc_nets[0], bdc_copy)
+        else:
+            print("no bdc features supplied") # also worth raising error here perhaps????
+
+        if overlap and not network_dir:
+            arcpy.AddMessage("overlapping zones share their reaches only with a network cache - without one every "
+                             "zone is already intersected in a single overlay")
+
+        # classifying_zones
+        with Run_Trace.phase("prepare zones"):
+            zone_info = Beaver_Arc_Utils.prepare_zones(s_zone, scratch, fieldset.names)
+
+        # zones are read in the coordinates of the (first) network, as the network cache holds it
+        sr = Beaver_Arc_Utils.spatial_reference(bdc_nets[0])
+
+        def compute(zones):
+            # work through the zones one OS 100 km tile at a time - each task gets a run of the tile schedule.
+            zone_ids, extents = Beaver_Arc_Utils.zone_extents(zones, sr)
+            groups = Zone_Schedule.schedule(extents, Beaver_NumPy_Utils.read_os_grid())
+            arcpy.AddMessage(Zone_Schedule.describe(groups))
+            parts = Zone_Schedule.split_order(groups, 1 if workers == 1 else workers * 4)
+            tasks = [{"bdc_copy": bdc_copy, "bdc_nets": bdc_nets, "cache_dir": network_dir, "zone_info": zones,
+                      "overlap": overlap, "fieldset": fieldset, "order": [int(z) for z in zone_ids[part]],
+                      "subset": len(parts) > 1} for part in parts]
+
+            arcpy.AddMessage("overlaying bdc network with {0} features on {1} worker(s)".format(len(zone_ids),
+                                                                                                workers))
+            return np.sort(np.concatenate(Zone_Parallel.run_zones(zone_worker, tasks, workers)), order="Zone_no")
+
+        fingerprint = fieldset.fingerprint(Beaver_Arc_Utils.source_fingerprint(bdc_nets)) if result_cache else None
+        results = Beaver_Arc_Utils.cached_results(zone_info, scratch, fieldset.names, compute, result_cache,
+                                                  fingerprint, sr)
+    finally:
+        if network_dir and not cache_dir:
+            shutil.rmtree(network_dir, ignore_errors=True)
+
+    Beaver_Arc_Utils.write_outputs(zone_info, zones_out, table_out, results, scratch)
     arcpy.AddMessage("Tool completed")
 
 
@@ -220,4 +150,5 @@ if __name__ == '__main__':
     main(
         sys.argv[1],
         sys.argv[2],
-        sys.argv[3])
+        sys.argv[3],
+        *sys.argv[4:])
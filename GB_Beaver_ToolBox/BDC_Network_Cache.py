@@ -0,0 +1,204 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: BDC Network Cache.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It builds, once, a columnar cache of the BDC reaches:
+#                  BDC value, length and bounding box of every reach, its vertex coordinates and a uniform grid
+#                  spatial index, all stored as .npy arrays that are memory-mapped when the cache is opened. The
+#                  cache is keyed by a fingerprint of the source feature classes and is rebuilt when they change.
+#                  Zones are then overlaid using only the reaches near them, with no Merge/Copy/Clip of the network.
+#                  The source record of every reach is kept, so per-reach results can be written back to the network.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import os
+import json
+
+import numpy as np
+
+import Zone_Geometry
+
+METADATA = "network.json"
+ARRAYS = ("bdc", "length", "bbox", "reach_parts", "part_vertices", "vertices", "grid_offsets", "grid_items",
+          "source")
+
+# side (map units) of the spatial index grid cells
+DEFAULT_GRID_SIZE = 2000.0
+
+# caches opened by this process, by folder: (metadata time stamp, NetworkCache)
+_OPEN = {}
+
+
+def is_current(folder, fingerprint):
+    """True if folder holds a complete cache built from sources with this fingerprint."""
+    try:
+        with open(os.path.join(folder, METADATA)) as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+    return meta.get("fingerprint") == fingerprint and all(
+        os.path.exists(os.path.join(folder, name + ".npy")) for name in ARRAYS)
+
+
+def _grid_index(bbox, grid_size):
+    """Build a CSR uniform grid index: the reaches whose bounding box touches each grid cell."""
+    if len(bbox) == 0:
+        return {"x0": 0.0, "y0": 0.0, "size": grid_size, "ncols": 0, "nrows": 0}, np.zeros(1, np.int64), \
+            np.zeros(0, np.int64)
+
+    x0, y0 = float(bbox[:, 0].min()), float(bbox[:, 1].min())
+    ncols = int((bbox[:, 2].max() - x0) // grid_size) + 1
+    nrows = int((bbox[:, 3].max() - y0) // grid_size) + 1
+    c0 = ((bbox[:, 0] - x0) // grid_size).astype(np.int64)
+    c1 = ((bbox[:, 2] - x0) // grid_size).astype(np.int64)
+    r0 = ((bbox[:, 1] - y0) // grid_size).astype(np.int64)
+    r1 = ((bbox[:, 3] - y0) // grid_size).astype(np.int64)
+
+    cells, items = [], []
+    reach = np.arange(len(bbox))
+    for dr in range(int((r1 - r0).max()) + 1):
+        for dc in range(int((c1 - c0).max()) + 1):
+            ok = (r0 + dr <= r1) & (c0 + dc <= c1)
+            cells.append((r0[ok] + dr) * ncols + c0[ok] + dc)
+            items.append(reach[ok])
+    cells = np.concatenate(cells)
+    items = np.concatenate(items)
+    order = np.argsort(cells, kind="mergesort")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=nrows * ncols))])
+    return {"x0": x0, "y0": y0, "size": grid_size, "ncols": ncols, "nrows": nrows}, offsets, items[order]
+
+
+def build(reaches, folder, fingerprint, grid_size=DEFAULT_GRID_SIZE):
+    """Write the cache for an iterable of (BDC, length, parts) reaches, parts being lists of (x, y) vertices.
+    Reaches without parts are left out; the position in reaches of every cached reach is kept as its source."""
+    # drop this process's memory maps of an older cache first, so its files can be replaced
+    _OPEN.pop(os.path.abspath(folder), None)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    bdc, length, bbox, source = [], [], [], []
+    reach_parts, part_vertices, vertices = [0], [0], []
+    for n, (value, reach_length, parts) in enumerate(reaches):
+        parts = [np.asarray(part, dtype=np.float64).reshape(-1, 2) for part in parts]
+        parts = [part for part in parts if len(part) > 1]
+        if not parts:
+            continue
+        pts = np.vstack(parts)
+        bdc.append(value)
+        length.append(reach_length)
+        source.append(n)
+        bbox.append((pts[:, 0].min(), pts[:, 1].min(), pts[:, 0].max(), pts[:, 1].max()))
+        for part in parts:
+            vertices.append(part)
+            part_vertices.append(part_vertices[-1] + len(part))
+        reach_parts.append(len(part_vertices) - 1)
+
+    arrays = {"bdc": np.asarray(bdc, dtype=np.float64),
+              "length": np.asarray(length, dtype=np.float64),
+              "bbox": np.asarray(bbox, dtype=np.float64).reshape(-1, 4),
+              "reach_parts": np.asarray(reach_parts, dtype=np.int64),
+              "part_vertices": np.asarray(part_vertices, dtype=np.int64),
+              "vertices": np.vstack(vertices) if vertices else np.zeros((0, 2)),
+              "source": np.asarray(source, dtype=np.int64)}
+    grid, arrays["grid_offsets"], arrays["grid_items"] = _grid_index(arrays["bbox"], grid_size)
+
+    for name in ARRAYS:
+        np.save(os.path.join(folder, name + ".npy"), arrays[name])
+    with open(os.path.join(folder, METADATA), "w") as f:
+        json.dump({"fingerprint": fingerprint, "reaches": len(bdc), "grid": grid}, f, indent=1)
+
+
+def open_cache(folder):
+    """Return the NetworkCache of a folder, reusing the one this process already has open unless the cache has
+    been rebuilt since - so a long-lived process (Beaver_Batch) maps each cache once."""
+    folder = os.path.abspath(folder)
+    stamp = os.path.getmtime(os.path.join(folder, METADATA))
+    held = _OPEN.get(folder)
+    if held is None or held[0] != stamp:
+        held = _OPEN[folder] = (stamp, NetworkCache(folder))
+    return held[1]
+
+
+class NetworkCache(object):
+    def __init__(self, folder):
+        """Open a cache written by build(); every array is memory-mapped rather than loaded."""
+        with open(os.path.join(folder, METADATA)) as f:
+            meta = json.load(f)
+        self.fingerprint = meta["fingerprint"]
+        self.grid = meta["grid"]
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(folder, name + ".npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.bdc)
+
+    def candidates(self, xmin, ymin, xmax, ymax):
+        """Return the ids of the reaches whose bounding box overlaps a box, using the grid index."""
+        g = self.grid
+        if g["ncols"] == 0:
+            return np.zeros(0, np.int64)
+        c0 = max(int((xmin - g["x0"]) // g["size"]), 0)
+        c1 = min(int((xmax - g["x0"]) // g["size"]), g["ncols"] - 1)
+        r0 = max(int((ymin - g["y0"]) // g["size"]), 0)
+        r1 = min(int((ymax - g["y0"]) // g["size"]), g["nrows"] - 1)
+        if c1 < c0 or r1 < r0:
+            return np.zeros(0, np.int64)
+
+        found = [self.grid_items[self.grid_offsets[r * g["ncols"] + c0]:self.grid_offsets[r * g["ncols"] + c1 + 1]]
+                 for r in range(r0, r1 + 1)]
+        ids = np.unique(np.concatenate(found))
+        b = self.bbox[ids]
+        return ids[(b[:, 0] <= xmax) & (b[:, 2] >= xmin) & (b[:, 1] <= ymax) & (b[:, 3] >= ymin)]
+
+    def segments(self, ids):
+        """Return the line segments (x0, y0, x1, y1) of a set of reaches and the reach position of each."""
+        segs, owner = [], []
+        for n, reach in enumerate(ids):
+            for part in range(self.reach_parts[reach], self.reach_parts[reach + 1]):
+                pts = self.vertices[self.part_vertices[part]:self.part_vertices[part + 1]]
+                segs.append(np.hstack([pts[:-1], pts[1:]]))
+                owner.append(np.full(len(pts) - 1, n, dtype=np.int64))
+        if not segs:
+            return np.zeros((0, 4)), np.zeros(0, np.int64)
+        return np.vstack(segs), np.concatenate(owner)
+
+    def zone_reaches(self, rings):
+        """Clip the network to one zone. Returns the BDC value and clipped length of every reach inside it."""
+        return self.zone_reach_pieces(rings)[1:]
+
+    def zone_reach_pieces(self, rings):
+        """Clip the network to one zone. Returns the id, BDC value and clipped length of every reach inside it."""
+        edges = Zone_Geometry.ring_edges(rings)
+        if len(edges) == 0:
+            return np.zeros(0, np.int64), np.zeros(0), np.zeros(0)
+        ids = self.candidates(*Zone_Geometry.edges_extent(edges))
+        segs, owner = self.segments(ids)
+        clipped = np.bincount(owner, weights=Zone_Geometry.segments_inside_length(segs, edges), minlength=len(ids))
+        keep = clipped > 0
+        return ids[keep], np.asarray(self.bdc[ids[keep]]), clipped[keep]
+
+    def group_reaches(self, group_rings):
+        """Clip the network to a group of (overlapping) zones, gathering the reaches and segments under the group
+        once. Yields (position in the group, BDC values, clipped lengths) per zone, as zone_reaches would."""
+        edges = [Zone_Geometry.ring_edges(rings) for rings in group_rings]
+        extents = [Zone_Geometry.edges_extent(e) if len(e) else None for e in edges]
+        live = [e for e in extents if e is not None]
+        ids = np.zeros(0, np.int64)
+        if live:
+            ids = self.candidates(min(e[0] for e in live), min(e[1] for e in live),
+                                  max(e[2] for e in live), max(e[3] for e in live))
+        segs, owner = self.segments(ids)
+        seg_box = np.column_stack([np.minimum(segs[:, 0], segs[:, 2]), np.minimum(segs[:, 1], segs[:, 3]),
+                                   np.maximum(segs[:, 0], segs[:, 2]), np.maximum(segs[:, 1], segs[:, 3])])
+
+        for pos, extent in enumerate(extents):
+            if extent is None:
+                yield pos, np.zeros(0), np.zeros(0)
+                continue
+            # segments away from the zone's box have nothing inside it
+            near = np.flatnonzero((seg_box[:, 0] <= extent[2]) & (seg_box[:, 2] >= extent[0]) &
+                                  (seg_box[:, 1] <= extent[3]) & (seg_box[:, 3] >= extent[1]))
+            clipped = np.bincount(owner[near], weights=Zone_Geometry.segments_inside_length(segs[near], edges[pos]),
+                                  minlength=len(ids))
+            keep = clipped > 0
+            yield pos, np.asarray(self.bdc[ids[keep]]), clipped[keep]
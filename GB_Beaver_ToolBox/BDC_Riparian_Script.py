@@ -0,0 +1,118 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Riparian Corridor BHI (BDC Reach) Tool Script.
+# --- Description: This Script is part of the BeaverMod_ToolBox. The script's purpose is to calculate Beaver Habitat
+#                  Index statistics within distance bands (e.g. 10, 50 and 100 m) of every reach of the BDC networks
+#                  for Great Britain, so forage suitability can be read alongside dam capacity reach by reach. The BHI
+#                  near the networks is swept once (Riparian_Corridor) rather than buffering each reach, and a copy of
+#                  every network is written to the output workspace with the band fields added.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+from __future__ import print_function
+
+import sys
+import os
+import shutil
+import tempfile
+import numpy as np
+
+import BDC_Network_Cache
+import Beaver_NumPy_Utils
+import Riparian_Corridor
+import Run_Trace
+import Zone_Parallel
+import Zone_Table_Export
+
+# without ArcGIS only the NumPy backend (Beaver_NumPy_Utils) can be used
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+if arcpy is not None:
+    import Beaver_Arc_Utils
+    arcpy.env.overwriteOutput = True
+
+
+def block_worker(task):
+    """Count the BHI classes by nearest reach and band over one run of BHI blocks."""
+    arcpy.CheckOutExtension("Spatial")
+    network = BDC_Network_Cache.open_cache(task["cache_dir"])
+    return Riparian_Corridor.corridor_counts(Beaver_Arc_Utils.tile_index(task["bhi_home"]), Beaver_Arc_Utils.read_tile,
+                                             network, task["bands"], task["blocks"])
+
+
+def main(bhi_home, bdc_nets, out_workspace, bands="10;50;100", workers=1, cache_dir=None, table_out=None,
+         backend=None, trace_out=None, profile=False):
+    # multi-value parameters arrive as a single "a;b;c" string
+    if hasattr(bdc_nets, "split"):
+        bdc_nets = [net.strip("'\"") for net in bdc_nets.split(";") if net]
+
+    Run_Trace.start(trace_out, str(profile).lower() in ("true", "1"))
+    try:
+        if (backend or ("arcpy" if arcpy is not None else "numpy")) == "numpy":
+            Beaver_NumPy_Utils.run_riparian([bhi_home], bdc_nets, out_workspace, bands, workers, cache_dir, table_out)
+        else:
+            run_arcpy(bhi_home, bdc_nets, out_workspace, bands, workers, cache_dir, table_out)
+    finally:
+        Run_Trace.finish(arcpy.AddMessage if arcpy is not None else print)
+
+
+def run_arcpy(bhi_home, bdc_nets, out_workspace, bands="10;50;100", workers=1, cache_dir=None, table_out=None):
+    arcpy.CheckOutExtension("Spatial")
+    arcpy.AddMessage("Running Riparian Corridor Script")
+    bands = Riparian_Corridor.parse_bands(bands)
+    workers = max(1, int(workers or 1))
+    index = Beaver_Arc_Utils.tile_index(bhi_home)
+
+    folder = cache_dir or tempfile.mkdtemp(prefix="beaver_bdc_")
+    try:
+        network = Beaver_Arc_Utils.open_network_cache(bdc_nets, folder)
+        source = np.array(network.source)
+
+        with Run_Trace.phase("plan corridor blocks"):
+            blocks = Riparian_Corridor.corridor_blocks(index, network, bands)
+        parts = np.array_split(np.arange(len(blocks)), max(1, min(len(blocks), 1 if workers == 1 else workers * 4)))
+        tasks = [{"bhi_home": bhi_home, "cache_dir": folder, "bands": bands, "blocks": [blocks[k] for k in part]}
+                 for part in parts if len(part)]
+        arcpy.AddMessage("sweeping {0} bhi blocks within {1:g} m of {2} reaches on {3} worker(s)...".format(
+            len(blocks), bands[-1], len(network), workers))
+        outputs = Zone_Parallel.run_zones(block_worker, tasks, workers)
+    finally:
+        if not cache_dir:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    n_records = [int(arcpy.GetCount_management(net).getOutput(0)) for net in bdc_nets]
+    results = Riparian_Corridor.record_fields(outputs, source, sum(n_records), bands)
+    fields = Riparian_Corridor.band_fields(bands)
+
+    # rows are matched to reaches by position - the network cache was built from the rows of the networks in turn
+    first = 0
+    for net, n in zip(bdc_nets, n_records):
+        name = arcpy.ValidateTableName(os.path.splitext(os.path.basename(net))[0], out_workspace)
+        net_out = os.path.join(out_workspace, name)
+        arcpy.AddMessage("writing riparian statistics to {0}".format(net_out))
+        with Run_Trace.phase("write network fields", items=n):
+            arcpy.CopyFeatures_management(net, net_out)
+            for field in fields:
+                arcpy.AddField_management(net_out, field, "DOUBLE")
+            with arcpy.da.UpdateCursor(net_out, fields) as cursor:
+                for k, _ in enumerate(cursor):
+                    cursor.updateRow([float(results[first + k][f]) for f in fields])
+        first += n
+
+    if table_out:
+        arcpy.AddMessage("exporting statistics table")
+        with Run_Trace.phase("export statistics table", items=len(results)):
+            Zone_Table_Export.write_table(results, table_out)
+    arcpy.AddMessage("Tool completed")
+
+
+if __name__ == '__main__':
+    main(
+        sys.argv[1],
+        sys.argv[2],
+        sys.argv[3],
+        *sys.argv[4:])
@@ -0,0 +1,191 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Beaver Dam Capacity (BDC) Zonal Statistics Core.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It holds the arcpy-free statistics engine for the BDC
+#                  tool. The BDC network is overlaid with every search zone once, giving a flat table of
+#                  (Zone_no, BDC, clipped length) rows; all BDC_* statistics are then computed for every zone with
+#                  grouped, length-weighted NumPy reductions, folded chunk by chunk into mergeable accumulators.
+#                  The output fields follow a Zone_Stats_Spec specification, the BDC_* fields by default.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import numpy as np
+
+import Zone_Stats_Spec
+from BHI_Stats_Core import zone_index
+
+# upper bounds of the None, Rare, Occasional and Frequent categories (dams/km) - anything above is Pervasive.
+CATEGORY_EDGES = (0, 1, 4, 15)
+CATEGORIES = ("NONE", "RARE", "OCC", "FREQ", "PERV")
+
+# overlay rows folded into an accumulator at a time
+CHUNK_ROWS = 100000
+
+# BDC value range of each category: (upper bound of the one below, own upper bound]
+CATEGORY_RANGES = ([{"le": CATEGORY_EDGES[0]}] +
+                   [{"gt": lo, "le": hi} for lo, hi in zip(CATEGORY_EDGES[:-1], CATEGORY_EDGES[1:])] +
+                   [{"gt": CATEGORY_EDGES[-1]}])
+
+# the default output fields (see Zone_Stats_Spec) - lengths are reported in km
+DEFAULT_SPEC = ([{"name": "BDC_MEAN", "stat": "mean"}, {"name": "BDC_W_AVG", "stat": "mean", "weighted": True},
+                 {"name": "BDC_TOT", "stat": "sum"}, {"name": "BDC_MIN", "stat": "min"},
+                 {"name": "BDC_MAX", "stat": "max"}, {"name": "BDC_STD", "stat": "std"},
+                 {"name": "BDC_W_STD", "stat": "std", "weighted": True}] +
+                [dict(r, name="BDC_P_" + c, stat="share") for c, r in zip(CATEGORIES, CATEGORY_RANGES)] +
+                [dict(r, name="BDC_km_" + c, stat="weight", scale=0.001) for c, r in zip(CATEGORIES, CATEGORY_RANGES)] +
+                [{"name": "TOT_km", "stat": "weight", "scale": 0.001}])
+BDC_FIELDS = [field["name"] for field in DEFAULT_SPEC]
+
+
+def field_set(spec=None):
+    """Compile the BDC output fields of a statistics specification (None for the BDC_* fields)."""
+    return Zone_Stats_Spec.field_set(spec, "bdc", DEFAULT_SPEC, [s for s in Zone_Stats_Spec.STATS if s != "area"])
+
+
+def bdc_category(bdc):
+    """Return the capacity category (0=None ... 4=Pervasive) of each BDC value."""
+    return np.searchsorted(CATEGORY_EDGES, bdc, side="left")
+
+
+def _group_bounds(idx_sorted):
+    """Return the start position of every run of equal values in a sorted index array."""
+    return np.flatnonzero(np.r_[True, idx_sorted[1:] != idx_sorted[:-1]])
+
+
+def _combine(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """Chan et al. pairwise update of (weight, mean, sum of squared deviations) - exact when either side is empty."""
+    n = n_a + n_b
+    safe_n = np.where(n > 0, n, 1)
+    delta = mean_b - mean_a
+    mean = np.where(n_a == 0, mean_b, np.where(n_b == 0, mean_a, mean_a + delta * n_b / safe_n))
+    m2 = np.where(n_a == 0, m2_b, np.where(n_b == 0, m2_a, m2_a + m2_b + delta ** 2 * n_a * n_b / safe_n))
+    return n, mean, m2
+
+
+class BDCAccumulator(object):
+    def __init__(self, zone_ids, fieldset=None):
+        """Mergeable per-zone BDC accumulator.
+
+        Holds, for every zone, the piece count, BDC total, min and max, a running mean and sum of squared
+        deviations (plain and length-weighted) and the piece count and channel length in each bin group of the
+        output fields (the capacity categories by default). Chunks of the overlay table are folded in one at a
+        time, so memory does not depend on how many reaches a zone holds - unless fieldset asks for quantiles, for
+        which the pieces are kept - and accumulators over the same zones built from different chunks or workers
+        can be merged in any order."""
+        self.zone_ids = np.asarray(zone_ids, dtype=np.int64)
+        self.fieldset = fieldset or field_set()
+        n = len(self.zone_ids)
+        self.count = np.zeros(n)
+        self.total = np.zeros(n)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+        self.length = np.zeros(n)
+        self.w_mean = np.zeros(n)
+        self.w_m2 = np.zeros(n)
+        self.min = np.full(n, np.inf)
+        self.max = np.full(n, -np.inf)
+        self.group_count = np.zeros((n, self.fieldset.n_groups))
+        self.group_length = np.zeros((n, self.fieldset.n_groups))
+        self.pieces = [] if self.fieldset.quantiles else None
+
+    def update(self, zones, bdc, length):
+        """Add one chunk of overlay rows (Zone_no, BDC, clipped length); rows of other zones are ignored."""
+        n = len(self.zone_ids)
+        idx = zone_index(zones, self.zone_ids)
+        keep = idx >= 0
+        idx = idx[keep]
+        bdc = np.asarray(bdc, dtype=np.float64)[keep]
+        length = np.asarray(length, dtype=np.float64)[keep]
+        if idx.size == 0:
+            return self
+
+        # two-pass statistics of the chunk, then combined with the running state
+        count = np.bincount(idx, minlength=n).astype(np.float64)
+        total = np.bincount(idx, weights=bdc, minlength=n)
+        mean = total / np.where(count > 0, count, 1)
+        m2 = np.bincount(idx, weights=(bdc - mean[idx]) ** 2, minlength=n)
+
+        weight = np.bincount(idx, weights=length, minlength=n)
+        w_mean = np.bincount(idx, weights=bdc * length, minlength=n) / np.where(weight > 0, weight, 1)
+        w_m2 = np.bincount(idx, weights=length * (bdc - w_mean[idx]) ** 2, minlength=n)
+
+        order = np.argsort(idx, kind="mergesort")
+        idx_sorted = idx[order]
+        starts = _group_bounds(idx_sorted)
+        groups = idx_sorted[starts]
+        self.min[groups] = np.minimum(self.min[groups], np.minimum.reduceat(bdc[order], starts))
+        self.max[groups] = np.maximum(self.max[groups], np.maximum.reduceat(bdc[order], starts))
+
+        # one digitize of the chunk serves every count, length and share field
+        g = self.fieldset.n_groups
+        key = idx * g + self.fieldset.groups(bdc)
+        self.group_count += np.bincount(key, minlength=n * g).reshape(n, g)
+        self.group_length += np.bincount(key, weights=length, minlength=n * g).reshape(n, g)
+        if self.pieces is not None:
+            self.pieces.append((idx, bdc, length))
+        self.total += total
+        self._combine(count, mean, m2, weight, w_mean, w_m2)
+        return self
+
+    def _combine(self, count, mean, m2, weight, w_mean, w_m2):
+        self.count, self.mean, self.m2 = _combine(self.count, self.mean, self.m2, count, mean, m2)
+        # zones whose pieces all have zero length carry no weighted moments
+        self.length, self.w_mean, self.w_m2 = _combine(self.length, self.w_mean, self.w_m2, weight, w_mean, w_m2)
+
+    def merge(self, other):
+        """Add the state of another accumulator over the same zones."""
+        if not np.array_equal(self.zone_ids, other.zone_ids):
+            raise ValueError("cannot merge BDC accumulators over different zones")
+        self.total += other.total
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.group_count += other.group_count
+        self.group_length += other.group_length
+        if self.pieces is not None:
+            self.pieces += other.pieces
+        self._combine(other.count, other.mean, other.m2, other.length, other.w_mean, other.w_m2)
+        return self
+
+    def quantile(self, q, weighted=False):
+        """Return the q quantile BDC of every zone, length-weighted if asked (see Zone_Stats_Spec.grouped_quantile).
+        Needs an accumulator whose fieldset has quantile fields."""
+        idx, bdc, length = (np.concatenate([p[k] for p in self.pieces] or [np.zeros(0)]) for k in range(3))
+        weights = length if weighted else np.ones(len(bdc))
+        return Zone_Stats_Spec.grouped_quantile(idx.astype(np.int64), bdc, weights, len(self.zone_ids), q)
+
+    def fields(self):
+        """Return a structured array holding Zone_no and every BDC_* field (or those of the accumulator's fieldset);
+        zones without any reach get 0."""
+        safe_count = np.where(self.count > 0, self.count, 1)
+        safe_length = np.where(self.length > 0, self.length, 1)
+        state = {"count": self.count, "weight": self.length, "sum": self.total, "min": self.min, "max": self.max,
+                 "mean": self.mean, "std": np.sqrt(self.m2 / safe_count),
+                 "w_mean": self.w_mean, "w_std": np.sqrt(self.w_m2 / safe_length),
+                 "group_count": self.group_count, "group_weight": self.group_length, "quantile": self.quantile}
+        return self.fieldset.evaluate(self.zone_ids, state)
+
+
+def accumulate_zone_pieces(acc, zone_pieces, chunk_rows=CHUNK_ROWS):
+    """Fold (Zone_no, BDC values, clipped lengths) of one zone at a time into acc, gathered into chunks of about
+    chunk_rows rows so each update covers many zones."""
+    zones, bdc, length, held = [], [], [], 0
+    for zone, values, clipped in zone_pieces:
+        zones.append(np.full(len(values), zone, dtype=np.int64))
+        bdc.append(np.asarray(values, dtype=np.float64))
+        length.append(np.asarray(clipped, dtype=np.float64))
+        held += len(values)
+        if held >= chunk_rows:
+            acc.update(np.concatenate(zones), np.concatenate(bdc), np.concatenate(length))
+            zones, bdc, length, held = [], [], [], 0
+    if held:
+        acc.update(np.concatenate(zones), np.concatenate(bdc), np.concatenate(length))
+    return acc
+
+
+def bdc_fields(zone_ids, zones, bdc, length, fieldset=None):
+    """Build a structured array holding Zone_no and every BDC_* field (or those of fieldset) for each zone.
+
+    zones, bdc and length are the columns of the overlay table: one row per reach (part) clipped to a zone.
+    Zones without any reach get 0 for every field."""
+    return BDCAccumulator(zone_ids, fieldset).update(zones, bdc, length).fields()
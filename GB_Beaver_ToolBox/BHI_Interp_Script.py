@@ -11,254 +11,110 @@
 ########################################################################################################################
 ########################################################################################################################
 
+from __future__ import print_function
+
 import sys
-import arcpy
 import os
-from arcpy.sa import *
 import numpy as np
-arcpy.env.overwriteOutput = True
-
-arcpy.CheckOutExtension("spatial")
-
 
-def main(bhi_ras, s_zone, zones_out):
-
-    scratchPath = os.path.abspath(os.path.join(__file__, os.pardir))
+import BHI_Stats_Core
+import BHI_Tile_Index
+import Beaver_NumPy_Utils
+import Run_Trace
+import Zone_Parallel
+
+# without ArcGIS only the NumPy backend (Beaver_NumPy_Utils) can be used
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+if arcpy is not None:
+    import Beaver_Arc_Utils
+    arcpy.env.overwriteOutput = True
+
+
+def zone_worker(task):
+    """Summarise one Zone_no range of the zones in a private scratch gdb and return its BHI fields."""
+    arcpy.CheckOutExtension("spatial")
+    bhi_ras = task["bhi_ras"]
+    scratch = Beaver_Arc_Utils.make_scratch()
+    try:
+        zone_info = task["zone_info"]
+        if task["subset"]:
+            zone_info = Beaver_Arc_Utils.zone_subset(zone_info, scratch, task["first"], task["last"])
+
+        # zones are projected on the fly onto the BHI grid, as FeatureToRaster did
+        sr = Beaver_Arc_Utils.spatial_reference(bhi_ras)
+        zone_ids, shape_area = Beaver_Arc_Utils.zone_table(zone_info, sr)
+
+        # each zone is rasterised in NumPy to scanline runs on the BHI grid and only the pixels under those runs
+        # are read, so the cost follows the zone's size rather than the extent of the BHI raster.
+        index = BHI_Tile_Index.TileIndex([Beaver_Arc_Utils.raster_tile(bhi_ras)])
+        acc = Beaver_Arc_Utils.zones_pyramid_accumulator(zone_info, index, zone_ids, None, overlap=task["overlap"],
+                                                         spatial_reference=sr)
+        return acc.fields(shape_area, task["fieldset"])
+    finally:
+        Beaver_Arc_Utils.remove_scratch(scratch)
+
+
+def main(bhi_ras, s_zone, zones_out, workers=1, result_cache=None, table_out=None, backend=None,
+         trace_out=None, profile=False, overlap=False, stats_spec=None):
+    Run_Trace.start(trace_out, str(profile).lower() in ("true", "1"))
+    overlap = str(overlap).lower() in ("true", "1")
+    try:
+        if (backend or ("arcpy" if arcpy is not None else "numpy")) == "numpy":
+            Beaver_NumPy_Utils.run_bhi([bhi_ras], s_zone, zones_out, workers, result_cache=result_cache,
+                                       table_out=table_out, overlap=overlap, stats_spec=stats_spec or None)
+        else:
+            run_arcpy(bhi_ras, s_zone, zones_out, workers, result_cache, table_out, overlap, stats_spec or None)
+    finally:
+        Run_Trace.finish(arcpy.AddMessage if arcpy is not None else print)
 
-    scratchName = "scratch.gdb"
-    scratch = os.path.join(scratchPath, scratchName)
-    if arcpy.Exists(scratch):
-        arcpy.AddMessage("scratch gdb exists - Deleting")
-        arcpy.Delete_management(scratch)
 
-    arcpy.CreateFileGDB_management(scratchPath, scratchName)
+def run_arcpy(bhi_ras, s_zone, zones_out, workers=1, result_cache=None, table_out=None, overlap=False,
+              stats_spec=None):
+    arcpy.CheckOutExtension("spatial")
+    scratch = Beaver_Arc_Utils.make_scratch()
+    fieldset = BHI_Stats_Core.field_set(stats_spec)
 
     if arcpy.Exists(zones_out):
         arcpy.Delete_management(zones_out)
     arcpy.AddMessage("Running BHI Interpretation Script")
 
     # classifying_zones
-    sZone_fields = [f.name for f in arcpy.ListFields(s_zone)]
-    if "Zone_no" in sZone_fields:
-        arcpy.DeleteField_management(s_zone, "Zone_no")
-
-    zone_info = os.path.join(scratch, "tmp_shp_copy")
-    arcpy.CopyFeatures_management(s_zone, zone_info)
-
-    # create sequential numbers for reaches
-    arcpy.AddField_management(zone_info, "Zone_no", "LONG")
-
-    with arcpy.da.UpdateCursor(zone_info, ["Zone_no", 'OBJECTID']) as cursor:
-        for row in cursor:
-            row[0] = row[1]
-
-            cursor.updateRow(row)
-
-    arcpy.AddField_management(zone_info, field_name="BHI_MEAN", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_MIN", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_MAX", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_STD", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_PERC_0", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_PERC_1", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_PERC_2", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_PERC_3", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_PERC_4", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_PERC_5", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_AREA_0", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_AREA_1", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_AREA_2", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_AREA_3", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_AREA_4", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_AREA_5", field_type="DOUBLE")
+    with Run_Trace.phase("prepare zones"):
+        zone_info = Beaver_Arc_Utils.prepare_zones(s_zone, scratch, fieldset.names)
 
     arcpy.AddGeometryAttributes_management(zone_info, Geometry_Properties="AREA", Area_Unit="SQUARE_KILOMETERS")
 
-    arcpy.AddMessage("begin looping features...")
-    sz_fl = arcpy.MakeFeatureLayer_management(zone_info, "tempFL", "", scratch)
-
-    n_feat = arcpy.GetCount_management(sz_fl)
-
-    with arcpy.da.UpdateCursor(sz_fl, ["Zone_no"]) as cursor:
-        for row in cursor:
-
-            arcpy.AddMessage("working on feature {0}/{1}".format(row[0], n_feat))
-
-            expr = """{0} = {1}""".format('Zone_no', row[0])
-            arcpy.SelectLayerByAttribute_management(sz_fl,
-                                                    "NEW_SELECTION",
-                                                    expr)
-            out_shp = os.path.join(scratch, "op{0}".format(row[0]))
-
-            arcpy.CopyFeatures_management(sz_fl, out_shp)
-
-            xcell = arcpy.GetRasterProperties_management(bhi_ras, property_type="CELLSIZEX").getOutput(0)
-            area_ras = r"in_memory/area_ras_temp"
-            arcpy.env.snapRaster = os.path.join(bhi_ras)
-            arcpy.FeatureToRaster_conversion(out_shp, field="Zone_no", out_raster=area_ras, cell_size=xcell)
-
-            try:
-                ebm_ras = Con(IsNull(Raster(area_ras)), -100, Raster(bhi_ras))
-
-                ebm_ras = SetNull(ebm_ras == -100, ebm_ras)
-
-                area_ras = None
-
-
-                # arcpy alternative:
-                stdVal = arcpy.GetRasterProperties_management(ebm_ras, property_type="STD").getOutput(0)
-                meanVal = arcpy.GetRasterProperties_management(ebm_ras, property_type="MEAN").getOutput(0)
-                minVal = arcpy.GetRasterProperties_management(ebm_ras, property_type="MINIMUM").getOutput(0)
-                maxVal = arcpy.GetRasterProperties_management(ebm_ras, property_type="MAXIMUM").getOutput(0)
-
-                histtab = os.path.join(scratch, "histtab")
+    workers = max(1, int(workers or 1))
 
-                ZonalHistogram(out_shp, "Zone_no", ebm_ras, histtab)
-                field_names = [f.name for f in arcpy.ListFields(histtab)]
-
-                tab_arr = list(arcpy.da.TableToNumPyArray(histtab, field_names=field_names))
-
-                arr = np.asarray([x[1] for x in tab_arr])
-                arrb = np.asarray([x[2] for x in tab_arr])
-
-                namesList = list(arr)
-
-                if '0' in namesList:
-                    n0 = int(arrb[arr == '0'])
-                else:
-                    n0 = 0
-                if '1' in namesList:
-                    n1 = int(arrb[arr == '1'])
-                else:
-                    n1 = 0
-                if '2' in namesList:
-                    n2 = int(arrb[arr == '2'])
-                else:
-                    n2 = 0
-                if '3' in namesList:
-                    n3 = int(arrb[arr == '3'])
-                else:
-                    n3 = 0
-                if '4' in namesList:
-                    n4 = int(arrb[arr == '4'])
-                else:
-                    n4 = 0
-                if '5' in namesList:
-                    n5 = int(arrb[arr == '5'])
-                else:
-                    n5 = 0
-
-                countN = sum([n0, n1, n2, n3, n4, n5])
-
-                p0 = round(float(n0) / countN * 100, 2)
-                p1 = round(float(n1) / countN * 100, 2)
-                p2 = round(float(n2) / countN * 100, 2)
-                p3 = round(float(n3) / countN * 100, 2)
-                p4 = round(float(n4) / countN * 100, 2)
-                p5 = round(float(n5) / countN * 100, 2)
-
-                with arcpy.da.UpdateCursor(out_shp, ["BHI_MEAN", "BHI_MIN", "BHI_MAX",
-                                                     "BHI_STD", "BHI_PERC_0", "BHI_PERC_1",
-                                                     "BHI_PERC_2", "BHI_PERC_3", "BHI_PERC_4", "BHI_PERC_5",
-                                                     "BHI_AREA_0", "BHI_AREA_1", "BHI_AREA_2", "BHI_AREA_3",
-                                                     "BHI_AREA_4", "BHI_AREA_5",
-                                                     "SHAPE_AREA"]) as cursorc:  # NEED TO CHECK COL NAME OF AREA.
-                    for rowc in cursorc:
-                        rowc[0] = meanVal
-                        rowc[1] = minVal
-                        rowc[2] = maxVal
-                        rowc[3] = stdVal
-                        rowc[4] = p0
-                        rowc[5] = p1
-                        rowc[6] = p2
-                        rowc[7] = p3
-                        rowc[8] = p4
-                        rowc[9] = p5
-                        rowc[10] = round((rowc[16] / 100 * p0) / 1000000, 2)
-                        rowc[11] = round((rowc[16] / 100 * p1) / 1000000, 2)
-                        rowc[12] = round((rowc[16] / 100 * p2) / 1000000, 2)
-                        rowc[13] = round((rowc[16] / 100 * p3) / 1000000, 2)
-                        rowc[14] = round((rowc[16] / 100 * p4) / 1000000, 2)
-                        rowc[15] = round((rowc[16] / 100 * p5) / 1000000, 2)
-
-                        cursorc.updateRow(rowc)
-
-
-            except Exception:
-
-                arcpy.AddMessage("\n WARNING: A FEATURE {0} FALLS OUTSIDE OF THE PROVIDED BHI AREA! \n".format(row[0]))
-
-                with arcpy.da.UpdateCursor(out_shp, ["BHI_MEAN", "BHI_MIN", "BHI_MAX",
-                                                     "BHI_STD", "BHI_PERC_0", "BHI_PERC_1",
-                                                     "BHI_PERC_2", "BHI_PERC_3", "BHI_PERC_4", "BHI_PERC_5",
-                                                     "BHI_AREA_0", "BHI_AREA_1", "BHI_AREA_2", "BHI_AREA_3",
-                                                     "BHI_AREA_4", "BHI_AREA_5",
-                                                     "SHAPE_AREA"]) as cursorc:  # NEED TO CHECK COL NAME OF AREA.
-                    for rowc in cursorc:
-                        rowc[0] = 0
-                        rowc[1] = 0
-                        rowc[2] = 0
-                        rowc[3] = 0
-                        rowc[4] = 0
-                        rowc[5] = 0
-                        rowc[6] = 0
-                        rowc[7] = 0
-                        rowc[8] = 0
-                        rowc[9] = 0
-                        rowc[10] = 0
-                        rowc[11] = 0
-                        rowc[12] = 0
-                        rowc[13] = 0
-                        rowc[14] = 0
-                        rowc[15] = 0
-
-                        cursorc.updateRow(rowc)
-
-            arcpy.Delete_management(r"in_memory")
-
-        if arcpy.Exists(zone_info):
-            arcpy.Delete_management(zone_info)
-        if arcpy.Exists(sz_fl):
-            arcpy.Delete_management(zone_info)
-
-        if arcpy.Exists(os.path.join(scratch, "histtab")):
-            arcpy.Delete_management(os.path.join(scratch, "histtab"))
-
-        if arcpy.Exists(os.path.join(scratch, "tempRas")):
-            arcpy.Delete_management(os.path.join(scratch, "tempRas"))
-
-        zones_list = []
-
-        walk = arcpy.da.Walk(scratch, datatype="FeatureClass", type="Polygon")
-
-        for dirpath, dirnames, filenames in walk:
-            for filename in filenames:
-                zones_list.append(os.path.join(dirpath, filename))
-
-        if len(zones_list) > 1:
-            arcpy.AddMessage("merging final features")
-            arcpy.Merge_management(zones_list, zones_out)
-        else:
-            arcpy.AddMessage("copying final features")
-            arcpy.CopyFeatures_management(zones_list[0], zones_out)
+    def compute(zones):
+        zone_ids = Beaver_Arc_Utils.zone_table(zones)[0]
+        chunks = Zone_Parallel.zone_chunks(zone_ids, 1 if workers == 1 else workers * 4)
+        tasks = [{"bhi_ras": bhi_ras, "zone_info": zones, "first": first, "last": last, "subset": len(chunks) > 1,
+                  "overlap": overlap, "fieldset": fieldset} for first, last in chunks]
 
-        for fc in zones_list:
-            arcpy.Delete_management(fc)
+        arcpy.AddMessage("summarising {0} features on {1} worker(s)...".format(len(zone_ids), workers))
+        return np.concatenate(Zone_Parallel.run_zones(zone_worker, tasks, workers))
 
-        if arcpy.Exists(scratch):
-            try:
-                arcpy.Delete_management(scratch)
-            except Exception:
-                print("An issue occured when deleting the scratch folder - not a big deal")
+    fingerprint = fieldset.fingerprint(Beaver_Arc_Utils.source_fingerprint([bhi_ras])) if result_cache else None
+    results = Beaver_Arc_Utils.cached_results(zone_info, scratch, fieldset.names, compute, result_cache,
+                                              fingerprint, Beaver_Arc_Utils.spatial_reference(bhi_ras))
 
-        arcpy.Delete_management(r"in_memory")
+    for zone in BHI_Stats_Core.outside_zones(results):
+        arcpy.AddMessage("\n WARNING: A FEATURE {0} FALLS OUTSIDE OF THE PROVIDED BHI AREA! \n".format(zone))
 
-        arcpy.AddMessage("Tool completed")
+    Beaver_Arc_Utils.write_outputs(zone_info, zones_out, table_out, results, scratch)
+    arcpy.AddMessage("Tool completed")
 
 
 if __name__ == '__main__':
     main(
         sys.argv[1],
         sys.argv[2],
-        sys.argv[3])
+        sys.argv[3],
+        *sys.argv[4:])
 
 
@@ -0,0 +1,119 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: BHI Quick Look Overviews.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It builds, once, lower resolution overviews of the
+#                  5 m BHI - 25 m and 100 m cells holding the count of each BHI class (so the class fractions, not a
+#                  resampled value) - and uses them for a fast "quick look" summary of zones. Each zone is read at
+#                  the coarsest overview giving enough cells across it, with no BHI pixels read at all. Cells are
+#                  counted by their centre, and cells on the zone boundary give a bound on the error of the
+#                  class percentages (BHI_PC_ERR, percentage points). Build the overviews from the command line:
+#                      python BHI_Overview.py <BHI raster workspace> <overview folder>
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+from __future__ import print_function
+
+import sys
+
+import numpy as np
+
+import BHI_Pyramid
+import BHI_Stats_Core
+import Zone_Geometry
+
+# overview cell sizes (metres), finest first
+LEVELS = (25, 100)
+
+# a zone is read at the coarsest overview that still gives it at least this many cells
+MIN_CELLS = 400
+
+ERROR_FIELD = "BHI_PC_ERR"
+QUICK_FIELDS = BHI_Stats_Core.BHI_FIELDS + [ERROR_FIELD]
+
+
+def build(index, reader, folder, message=print):
+    """Build the class count overviews of every tile of a BHI_Tile_Index.TileIndex into folder."""
+    return BHI_Pyramid.build(index, reader, folder, levels=LEVELS, message=message)
+
+
+def open_overviews(folder):
+    return BHI_Pyramid.open_pyramid(folder)
+
+
+def zone_estimate(overviews, index, rings, min_cells=MIN_CELLS):
+    """Return the estimated class counts (0-5) of a zone and the counts held by overview cells wholly inside the
+    zone and by cells on its boundary."""
+    edges = Zone_Geometry.ring_edges(rings)
+    est, inside, boundary = (np.zeros(BHI_Stats_Core.N_CLASSES, dtype=np.int64) for _ in range(3))
+    if len(edges) == 0:
+        return est, inside, boundary
+
+    win = index.window(*Zone_Geometry.edges_extent(edges))
+    for part in index.tile_windows(win):
+        tile = part.tile
+        levels = overviews.tile_levels(tile)
+        if not levels:
+            raise ValueError("BHI tile {0} has no current overview - rebuild the overviews".format(tile.name))
+
+        px, arr = levels[-1]
+        for level_px, level_arr in levels:
+            if win.nrows * win.ncols >= min_cells * level_px * level_px:
+                px, arr = level_px, level_arr
+                break
+
+        bi0, bj0 = part.row // px, part.col // px
+        bi1 = min((part.row + part.nrows - 1) // px + 1, arr.shape[0])
+        bj1 = min((part.col + part.ncols - 1) // px + 1, arr.shape[1])
+        size = px * tile.cell
+        x0, y0 = tile.xmin + bj0 * size, tile.ymax - bi0 * size
+
+        state = Zone_Geometry.classify_blocks(edges, x0, y0, size, bi1 - bi0, bj1 - bj0)
+        centre = Zone_Geometry.polygon_mask(edges, x0, y0, size, bi1 - bi0, bj1 - bj0)
+        counts = np.asarray(arr[bi0:bi1, bj0:bj1, 1:], dtype=np.int64)
+        est += counts[centre].sum(axis=0)
+        inside += counts[state == Zone_Geometry.INSIDE].sum(axis=0)
+        boundary += counts[state == Zone_Geometry.BOUNDARY].sum(axis=0)
+    return est, inside, boundary
+
+
+def percentage_error(est, inside, boundary):
+    """Bound, in percentage points, how far each zone's estimated class percentages can be from the full
+    resolution ones: each boundary cell's pixels may fall anywhere between all in and all out of the zone."""
+    est, inside, boundary = (np.asarray(a, dtype=np.float64) for a in (est, inside, boundary))
+    n_in = inside.sum(axis=1, keepdims=True)
+    n_bd = boundary.sum(axis=1, keepdims=True)
+    n_est = est.sum(axis=1, keepdims=True)
+
+    def ratio(num, den):
+        return np.where(den > 0, num / np.where(den > 0, den, 1), 0)
+
+    perc = ratio(est, n_est)
+    low = ratio(inside, n_in + n_bd - boundary)
+    high = ratio(inside + boundary, n_in + boundary)
+    err = np.maximum(high - perc, perc - low).max(axis=1) * 100
+    return np.round(np.where((n_in + n_bd)[:, 0] > 0, err, 0), 2)
+
+
+def quick_fields(zone_ids, est, inside, boundary, shape_area):
+    """Build the BHI_* fields from estimated class counts, plus the BHI_PC_ERR error bound."""
+    fields = BHI_Stats_Core.bhi_fields(zone_ids, est, shape_area)
+    out = np.zeros(len(fields), dtype=fields.dtype.descr + [(ERROR_FIELD, np.float64)])
+    for name in fields.dtype.names:
+        out[name] = fields[name]
+    out[ERROR_FIELD] = percentage_error(est, inside, boundary)
+    return out
+
+
+def zones_quick_look(overviews, index, zone_ids, zone_rings, shape_area):
+    """Quick look BHI fields for zones given as a list of ring lists, in zone_ids order."""
+    n = len(zone_ids)
+    est, inside, boundary = (np.zeros((n, BHI_Stats_Core.N_CLASSES), dtype=np.int64) for _ in range(3))
+    for pos, rings in enumerate(zone_rings):
+        est[pos], inside[pos], boundary[pos] = zone_estimate(overviews, index, rings)
+    return quick_fields(zone_ids, est, inside, boundary, shape_area)
+
+
+if __name__ == '__main__':
+    import Beaver_Arc_Utils
+    build(Beaver_Arc_Utils.tile_index(sys.argv[1]), Beaver_Arc_Utils.read_tile, sys.argv[2])
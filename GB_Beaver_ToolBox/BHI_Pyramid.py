@@ -0,0 +1,212 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: BHI Block-Histogram Pyramid.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It builds, once, a pyramid of per-block BHI class
+#                  histograms (NoData plus classes 0-5) for every BHI tile - 1 km and 10 km blocks by default - and
+#                  uses it to summarise zones. Blocks lying wholly inside a zone take their stored histogram, blocks
+#                  outside are skipped and only blocks on the zone boundary are read at pixel level, so the result
+#                  is identical to a full scan. Build the pyramid from the command line:
+#                      python BHI_Pyramid.py <BHI raster workspace> <pyramid folder>
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+
+import numpy as np
+
+import BHI_Stats_Core
+import BHI_Tile_Cache
+import Run_Trace
+import Zone_Geometry
+
+# block sizes (metres) of the pyramid levels, finest first - each must be a whole multiple of the one before.
+LEVELS = (1000, 10000)
+METADATA = "pyramid.json"
+
+# pyramids opened by this process, by folder: (metadata time stamp, Pyramid)
+_OPEN = {}
+
+
+def _tile_fingerprint(tile):
+    """Size and modification time of a tile's file. A raster in a file geodatabase has no file of its own and is
+    fingerprinted by the newest modification time in its .gdb folder, as in BHI_Tile_Cache; None if neither is
+    found, which never matches."""
+    try:
+        st = os.stat(tile.path)
+        return [st.st_size, int(st.st_mtime)]
+    except OSError:
+        stamp = BHI_Tile_Cache.source_stamp(tile.path)
+        return None if stamp is None else ["gdb", stamp]
+
+
+def _class_codes(values, nodata):
+    """Return 0 for NoData pixels and class + 1 for BHI classes 0-5."""
+    values = np.asarray(values)
+    valid = (values >= 0) & (values <= BHI_Stats_Core.N_CLASSES - 1)
+    if nodata is not None:
+        valid &= values != nodata
+    return np.where(valid, values.astype(np.int64) + 1, 0)
+
+
+def _coarsen(hist, factor):
+    """Sum factor x factor groups of blocks into one block of the next level."""
+    nby, nbx, nbins = hist.shape
+    pad_y, pad_x = (-nby) % factor, (-nbx) % factor
+    hist = np.pad(hist, ((0, pad_y), (0, pad_x), (0, 0)), mode="constant")
+    return hist.reshape(hist.shape[0] // factor, factor, hist.shape[1] // factor, factor, nbins).sum(axis=(1, 3))
+
+
+def build_tile(tile, reader, levels=LEVELS):
+    """Return the block histograms (nby, nbx, 7) of one tile for each level, finest first. The tile is read one
+    strip of finest-level blocks at a time."""
+    px = [int(round(level / tile.cell)) for level in levels]
+    fine = px[0]
+    nby = -(-tile.nrows // fine)
+    nbx = -(-tile.ncols // fine)
+    nbins = BHI_Stats_Core.N_CLASSES + 1
+
+    hist = np.zeros((nby, nbx, nbins), dtype=np.uint32)
+    block_col = (np.arange(tile.ncols) // fine) * nbins
+    for bi in range(nby):
+        row = bi * fine
+        nrows = min(fine, tile.nrows - row)
+        codes = _class_codes(reader(tile, row, 0, nrows, tile.ncols), tile.nodata)
+        keys = block_col[None, :] + codes
+        hist[bi] = np.bincount(keys.ravel(), minlength=nbx * nbins).reshape(nbx, nbins)
+
+    out = [hist]
+    for prev, cur in zip(px[:-1], px[1:]):
+        out.append(_coarsen(out[-1], cur // prev).astype(np.uint32))
+    return out
+
+
+def build(index, reader, folder, levels=LEVELS, message=print):
+    """Build the pyramid for every tile of a BHI_Tile_Index.TileIndex into folder."""
+    _OPEN.pop(os.path.abspath(folder), None)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    meta = {"levels": list(levels), "tiles": {}}
+    for n, tile in enumerate(index.tiles):
+        message("building pyramid for tile {0} ({1}/{2})".format(tile.name, n + 1, len(index.tiles)))
+        for level, hist in zip(levels, build_tile(tile, reader, levels)):
+            np.save(os.path.join(folder, "{0}_{1}m.npy".format(tile.name, level)), hist)
+        meta["tiles"][tile.name] = {"fingerprint": _tile_fingerprint(tile), "nrows": tile.nrows,
+                                    "ncols": tile.ncols, "cell": tile.cell}
+
+    with open(os.path.join(folder, METADATA), "w") as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+
+def open_pyramid(folder):
+    """Return the Pyramid of a folder, reusing the one this process already has open unless it has been rebuilt
+    since."""
+    folder = os.path.abspath(folder)
+    stamp = os.path.getmtime(os.path.join(folder, METADATA))
+    held = _OPEN.get(folder)
+    if held is None or held[0] != stamp:
+        held = _OPEN[folder] = (stamp, Pyramid(folder))
+    return held[1]
+
+
+class Pyramid(object):
+    def __init__(self, folder):
+        """Open a pyramid built by build(). Level arrays are memory-mapped on first use."""
+        self.folder = folder
+        with open(os.path.join(folder, METADATA)) as f:
+            meta = json.load(f)
+        self.levels = meta["levels"]
+        self.tiles = meta["tiles"]
+        self._arrays = {}
+
+    def tile_levels(self, tile):
+        """Return [(block size in pixels, histogram array)] for a tile, coarsest first, or [] if the tile is not
+        in the pyramid or has changed since it was built."""
+        info = self.tiles.get(tile.name)
+        if info is None or info["fingerprint"] is None or info["fingerprint"] != _tile_fingerprint(tile) or \
+                info["cell"] != tile.cell:
+            return []
+        if tile.name not in self._arrays:
+            self._arrays[tile.name] = [
+                (int(round(level / tile.cell)),
+                 np.load(os.path.join(self.folder, "{0}_{1}m.npy".format(tile.name, level)), mmap_mode="r"))
+                for level in reversed(self.levels)]
+        return self._arrays[tile.name]
+
+
+def _pixel_counts(tile, reader, edges, row, col, nrows, ncols):
+    """Count the BHI classes of the pixels of a block of a tile whose centres fall in the zone. Only the rows and
+    columns spanned by the zone's scanline runs are read, and only the run pixels are counted."""
+    hist = BHI_Stats_Core.empty_histogram(1)
+    with Run_Trace.phase("rasterise zone"):
+        rows, starts, ends = Zone_Geometry.polygon_runs(edges, tile.xmin + col * tile.cell,
+                                                        tile.ymax - row * tile.cell, tile.cell, nrows, ncols)
+    if len(rows):
+        r0, c0 = rows[0], starts.min()
+        values = np.asarray(reader(tile, row + r0, col + c0, rows[-1] + 1 - r0, ends.max() - c0))
+        pix_rows, pix_cols = Zone_Geometry.run_pixels(rows - r0, starts - c0, ends - c0)
+        BHI_Stats_Core.bhi_histogram(np.ones(len(pix_rows), dtype=np.int64), values[pix_rows, pix_cols], [1],
+                                     nodata=tile.nodata, out=hist)
+    return hist[0]
+
+
+def _visit(tile, reader, edges, levels, k, bi0, bi1, bj0, bj1):
+    """Add up the class counts of a zone over a range of blocks at pyramid level k."""
+    px, arr = levels[k]
+    size = px * tile.cell
+    nby, nbx = arr.shape[:2]
+    bi1, bj1 = min(bi1, nby), min(bj1, nbx)
+    counts = np.zeros(BHI_Stats_Core.N_CLASSES, dtype=np.int64)
+    if bi1 <= bi0 or bj1 <= bj0:
+        return counts
+
+    state = Zone_Geometry.classify_blocks(edges, tile.xmin + bj0 * size, tile.ymax - bi0 * size, size,
+                                          bi1 - bi0, bj1 - bj0)
+    inside = state == Zone_Geometry.INSIDE
+    if inside.any():
+        counts += np.asarray(arr[bi0:bi1, bj0:bj1][inside][:, 1:], dtype=np.int64).sum(axis=0)
+
+    for i, j in zip(*np.nonzero(state == Zone_Geometry.BOUNDARY)):
+        bi, bj = bi0 + i, bj0 + j
+        if k + 1 < len(levels):
+            f = px // levels[k + 1][0]
+            counts += _visit(tile, reader, edges, levels, k + 1, bi * f, (bi + 1) * f, bj * f, (bj + 1) * f)
+        else:
+            row, col = bi * px, bj * px
+            counts += _pixel_counts(tile, reader, edges, row, col,
+                                    min(px, tile.nrows - row), min(px, tile.ncols - col))
+    return counts
+
+
+def zone_counts(pyramid, index, reader, rings):
+    """Return the BHI class counts (0-5) of a zone given as a list of rings, using the pyramid where possible.
+    Tiles missing from the pyramid are read at pixel level, block by block."""
+    edges = Zone_Geometry.ring_edges(rings)
+    counts = np.zeros(BHI_Stats_Core.N_CLASSES, dtype=np.int64)
+    if len(edges) == 0:
+        return counts
+
+    win = index.window(*Zone_Geometry.edges_extent(edges))
+    for part in index.tile_windows(win):
+        tile = part.tile
+        levels = pyramid.tile_levels(tile) if pyramid is not None else []
+        if levels:
+            px = levels[0][0]
+            counts += _visit(tile, reader, edges, levels, 0,
+                             part.row // px, (part.row + part.nrows - 1) // px + 1,
+                             part.col // px, (part.col + part.ncols - 1) // px + 1)
+        else:
+            for row, col, nrows, ncols in BHI_Stats_Core.iter_blocks(part.nrows, part.ncols):
+                counts += _pixel_counts(tile, reader, edges, part.row + row, part.col + col, nrows, ncols)
+    return counts
+
+
+if __name__ == '__main__':
+    import Beaver_Arc_Utils
+    build(Beaver_Arc_Utils.tile_index(sys.argv[1]), Beaver_Arc_Utils.read_tile, sys.argv[2])
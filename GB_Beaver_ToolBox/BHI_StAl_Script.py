@@ -10,15 +10,33 @@
 ########################################################################################################################
 ########################################################################################################################
 
+from __future__ import print_function
+
 import sys
-import arcpy
 import os
-from arcpy.sa import *
 import numpy as np
-arcpy.env.overwriteOutput = True
-arcpy.env.scratchWorkspace = r"in_memory"
 
-arcpy.CheckOutExtension("Spatial")
+import BHI_Overview
+import BHI_Pyramid
+import BHI_Stats_Core
+import BHI_Tile_Cache
+import BHI_Tile_Store
+import Beaver_NumPy_Utils
+import Run_Trace
+import Zone_Parallel
+import Zone_Prefetch
+import Zone_Schedule
+
+# without ArcGIS only the NumPy backend (Beaver_NumPy_Utils) can be used
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+if arcpy is not None:
+    import Beaver_Arc_Utils
+    arcpy.env.overwriteOutput = True
+    arcpy.env.scratchWorkspace = r"in_memory"
 
 
 # def main():
@@ -26,242 +44,122 @@ arcpy.CheckOutExtension("Spatial")
 #     s_zone = os.path.abspath("C:/Users/hughg/Desktop/Beaver_Workshop/BHI_BDC_Demo/Shp_Files/WholeEstate.shp")
 #     zones_out = os.path.abspath("C:/Users/hughg/Desktop/Beaver_Workshop/BHI_BDC_Demo/ToolBoxResults/WholeEstateTB_Out_am2.shp")
 
-def main(bhi_home, s_zone, zones_out):
-
-    scratchPath = os.path.abspath(os.path.join(__file__, os.pardir))
-    scratchName = "scratch.gdb"
-    scratch = os.path.join(scratchPath, scratchName)
-    if arcpy.Exists(scratch):
-
-        arcpy.AddMessage("scratch gdb exists - Deleting")
-        arcpy.Delete_management(scratch)
-
-    arcpy.CreateFileGDB_management(scratchPath, scratchName)
+def zone_worker(task):
+    """Summarise one run of the zone schedule in a private scratch gdb, with its own tile cache. Returns the
+    BHI fields of those zones and the cache report."""
+    arcpy.CheckOutExtension("Spatial")
+    scratch = Beaver_Arc_Utils.make_scratch()
+    try:
+        zone_info = task["zone_info"]
+        if task["subset"]:
+            zone_info = Beaver_Arc_Utils.zone_subset(zone_info, scratch, zones=task["order"])
+
+        # zones are projected on the fly onto the BHI grid, as FeatureToRaster did
+        sr = Beaver_Arc_Utils.grid_spatial_reference(task["bhi_home"])
+        zone_ids, shape_area = Beaver_Arc_Utils.zone_table(zone_info, sr)
+
+        # index the BHI tiles once - each zone then reads only the tile windows under its bounding box.
+        index = Beaver_Arc_Utils.tile_index(task["bhi_home"])
+
+        # neighbouring zones share tile blocks - keep recently read blocks in RAM.
+        cache = BHI_Tile_Cache.open_cache(Beaver_Arc_Utils.read_tile, budget_mb=task["cache_mb"])
+
+        if task["overview_dir"]:
+            # quick look - approximate fields from the class count overviews, no BHI pixels are read.
+            overviews = BHI_Overview.open_overviews(task["overview_dir"])
+            return (Beaver_Arc_Utils.zones_quick_look(zone_info, index, zone_ids, overviews, shape_area, sr),
+                    "(quick look from overviews)")
+
+        # each zone is rasterised in NumPy to scanline runs on the BHI grid and only the pixels under those runs are
+        # read - nothing is written to scratch. With a pyramid, blocks wholly inside a zone come straight from it and
+        # only boundary blocks are read; overlapping zones may share their pixel reads.
+        pyramid = BHI_Pyramid.open_pyramid(task["pyramid_dir"]) if task["pyramid_dir"] else None
+        # the pyramid reads only scattered boundary blocks - only whole zone windows are worth reading ahead.
+        prefetch = Zone_Prefetch.Prefetcher(index, cache, task["prefetch"], task["prefetch_mb"]) \
+            if task["prefetch"] and pyramid is None and not task["overlap"] else None
+        acc = Beaver_Arc_Utils.zones_pyramid_accumulator(zone_info, index, zone_ids, pyramid, reader=cache,
+                                                         prefetch=prefetch, order=task["order"],
+                                                         overlap=task["overlap"], spatial_reference=sr)
+        summary = cache.summary() if prefetch is None else "{0}; {1}".format(cache.summary(), prefetch.summary())
+        return acc.fields(shape_area, task["fieldset"]), summary
+    finally:
+        Beaver_Arc_Utils.remove_scratch(scratch)
+
+
+def main(bhi_home, s_zone, zones_out, cache_mb=512, workers=1, pyramid_dir=None, result_cache=None, table_out=None,
+         backend=None, trace_out=None, profile=False, overview_dir=None, prefetch=0,
+         prefetch_mb=Zone_Prefetch.DEFAULT_BUDGET_MB, overlap=False, stats_spec=None):
+    Run_Trace.start(trace_out, str(profile).lower() in ("true", "1"))
+    overlap = str(overlap).lower() in ("true", "1")
+    try:
+        if (backend or ("arcpy" if arcpy is not None else "numpy")) == "numpy":
+            Beaver_NumPy_Utils.run_bhi([bhi_home], s_zone, zones_out, workers, cache_mb, pyramid_dir, result_cache,
+                                       table_out, overview_dir=overview_dir, prefetch=prefetch,
+                                       prefetch_mb=prefetch_mb, overlap=overlap, stats_spec=stats_spec or None)
+        else:
+            run_arcpy(bhi_home, s_zone, zones_out, cache_mb, workers, pyramid_dir, result_cache, table_out,
+                      overview_dir, prefetch, prefetch_mb, overlap, stats_spec or None)
+    finally:
+        Run_Trace.finish(arcpy.AddMessage if arcpy is not None else print)
+
+
+def run_arcpy(bhi_home, s_zone, zones_out, cache_mb=512, workers=1, pyramid_dir=None, result_cache=None,
+              table_out=None, overview_dir=None, prefetch=0, prefetch_mb=Zone_Prefetch.DEFAULT_BUDGET_MB,
+              overlap=False, stats_spec=None):
+    arcpy.CheckOutExtension("Spatial")
+    scratch = Beaver_Arc_Utils.make_scratch()
+    fieldset = BHI_Stats_Core.field_set(stats_spec)
 
     if arcpy.Exists(zones_out):
         arcpy.Delete_management(zones_out)
 
     arcpy.AddMessage("Running BHI Stand Alone Script")
-
-    p = os.path.abspath(os.path.join(__file__, os.pardir))
-    osGrid = os.path.join(p, "OsGridShp", "OSGB_Grid_100km.shp")
+    if overview_dir:
+        arcpy.AddMessage("quick look mode - approximate statistics from the BHI overviews in {0}".format(
+            overview_dir))
+        if not fieldset.default:
+            arcpy.AddMessage("quick look mode gives the BHI_* fields only - the statistics specification is not used")
+    fields = BHI_Overview.QUICK_FIELDS if overview_dir else fieldset.names
 
     # classifying_zones
-    sZone_fields = [f.name for f in arcpy.ListFields(s_zone)]
-    if "Zone_no" in sZone_fields:
-        arcpy.DeleteField_management(s_zone, "Zone_no")
-
-    zone_info = os.path.join(scratch, "tmp_shp_copy")
-    if arcpy.Exists(zone_info):
-        arcpy.Delete_management(zone_info)
-    arcpy.CopyFeatures_management(s_zone, zone_info)
-
-    # create sequential numbers for reaches
-    arcpy.AddField_management(zone_info, "Zone_no", "LONG")
-
-    with arcpy.da.UpdateCursor(zone_info, ["Zone_no", 'OBJECTID']) as cursor:
-        for row in cursor:
-            row[0] = row[1]
-
-            cursor.updateRow(row)
-
-
-    arcpy.AddField_management(zone_info, field_name="BHI_MEAN", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_MIN", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_MAX", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_STD", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_PERC_0", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_PERC_1", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_PERC_2", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_PERC_3", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_PERC_4", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_PERC_5", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_AREA_0", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_AREA_1", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_AREA_2", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_AREA_3", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_AREA_4", field_type="DOUBLE")
-    arcpy.AddField_management(zone_info, field_name="BHI_AREA_5", field_type="DOUBLE")
+    with Run_Trace.phase("prepare zones"):
+        zone_info = Beaver_Arc_Utils.prepare_zones(s_zone, scratch, fields)
 
     arcpy.AddGeometryAttributes_management(zone_info, Geometry_Properties="AREA", Area_Unit="SQUARE_KILOMETERS")
 
-    arcpy.AddMessage("begin looping features...")
-    sz_fl = arcpy.MakeFeatureLayer_management(zone_info, "tempFL", "", scratch)
-
-    n_feat = arcpy.GetCount_management(sz_fl)
-
-    arcpy.env.workspace = bhi_home
-    bhi_list = arcpy.ListRasters("*", "ALL")
-
-    with arcpy.da.SearchCursor(sz_fl, ["Zone_no"]) as cursor:
-        for row in cursor:
-
-            # print("working on feature {0}/{1}".format(row[0], n_feat))
-            arcpy.AddMessage("working on feature {0}/{1}".format(row[0], n_feat))
-            expr = """{0} = {1}""".format('Zone_no', row[0])
-            arcpy.SelectLayerByAttribute_management(sz_fl,
-                                                    "NEW_SELECTION",
-                                                    expr)
-            out_shp = os.path.join(scratch, "op{0}".format(row[0]))
-
-            arcpy.CopyFeatures_management(sz_fl, out_shp)
-
-            tempshp = r"in_memory/tempshp"
-            if arcpy.Exists(tempshp):
-                arcpy.Delete_management(tempshp)
-
-            arcpy.Clip_analysis(osGrid, sz_fl, tempshp)
-
-            with arcpy.da.SearchCursor(tempshp, ["TILE_NAME"]) as cursorb:
-                gridList = sorted({rowb[0] for rowb in cursorb})
-
-            ras_selec = []
-
-            for ras in bhi_list:
-                if ras[:2] in gridList:
-                    ras_selec.append(ras)
-            ras_selecN = [os.path.join(bhi_home, s) for s in ras_selec]
-
-            if len(ras_selec) > 1:
-                arcpy.AddMessage("feature intersects multiple OS tiles - merging rasters")
-                bhi_ras = arcpy.MosaicToNewRaster_management(ras_selecN, scratch, "tempRas", number_of_bands=1)
-            else:
-                arcpy.AddMessage("feature intersects only one OS tile - skip merge")
-                bhi_ras = arcpy.CopyRaster_management(ras_selec[0], os.path.join(scratch, "tempRas"))
-
-            xcell = arcpy.GetRasterProperties_management(bhi_ras, property_type="CELLSIZEX").getOutput(0)
-            area_ras = r"in_memory/area_ras_temp"
-            arcpy.env.snapRaster = os.path.join(scratch, "tempRas")
-            arcpy.FeatureToRaster_conversion(out_shp, field="Zone_no", out_raster=area_ras, cell_size=xcell)
-
-            ebm_ras = Con(IsNull(Raster(area_ras)), -100, Raster(bhi_ras))
-
-            ebm_ras = SetNull(ebm_ras == -100, ebm_ras)
-
-            area_ras = None
-            bhi_ras = None
-
-            #arcpy alternative:
-            stdVal = arcpy.GetRasterProperties_management(ebm_ras, property_type="STD").getOutput(0)
-            meanVal = arcpy.GetRasterProperties_management(ebm_ras, property_type="MEAN").getOutput(0)
-            minVal = arcpy.GetRasterProperties_management(ebm_ras, property_type="MINIMUM").getOutput(0)
-            maxVal = arcpy.GetRasterProperties_management(ebm_ras, property_type="MAXIMUM").getOutput(0)
-
-            histtab = os.path.join(scratch, "histtab")
-
-            ZonalHistogram(out_shp, "Zone_no", ebm_ras, histtab)
-            field_names = [f.name for f in arcpy.ListFields(histtab)]
-
-            tab_arr = list(arcpy.da.TableToNumPyArray(histtab, field_names=field_names))
-
-            arr = np.asarray([x[1] for x in tab_arr])
-            arrb = np.asarray([x[2] for x in tab_arr])
-            # arr = tab_arr['LABEL']
-            # arrb = tab_arr['OBJEC_1']
-
-            namesList = list(arr)
-
-            if '0' in namesList:
-                n0 = int(arrb[arr == '0'])
-            else:
-                n0 = 0
-            if '1' in namesList:
-                n1 = int(arrb[arr == '1'])
-            else:
-                n1 = 0
-            if '2' in namesList:
-                n2 = int(arrb[arr == '2'])
-            else:
-                n2 = 0
-            if '3' in namesList:
-                n3 = int(arrb[arr == '3'])
-            else:
-                n3 = 0
-            if '4' in namesList:
-                n4 = int(arrb[arr == '4'])
-            else:
-                n4 = 0
-            if '5' in namesList:
-                n5 = int(arrb[arr == '5'])
-            else:
-                n5 = 0
-
-            print(n0, n1, n2, n3, n4, n5)
-
-            countN = sum([n0, n1, n2, n3, n4, n5])
-
-            p0 = round(float(n0)/countN*100, 2)
-            p1 = round(float(n1)/countN*100, 2)
-            p2 = round(float(n2)/countN*100, 2)
-            p3 = round(float(n3)/countN*100, 2)
-            p4 = round(float(n4)/countN*100, 2)
-            p5 = round(float(n5)/countN*100, 2)
-
-            print(p0, p1, p2, p3, p4, p5)
-
-            with arcpy.da.UpdateCursor(out_shp, ["BHI_MEAN", "BHI_MIN", "BHI_MAX",
-                                                 "BHI_STD", "BHI_PERC_0","BHI_PERC_1",
-                                                 "BHI_PERC_2", "BHI_PERC_3", "BHI_PERC_4", "BHI_PERC_5",
-                                                 "BHI_AREA_0", "BHI_AREA_1", "BHI_AREA_2", "BHI_AREA_3",
-                                                 "BHI_AREA_4", "BHI_AREA_5", "SHAPE_AREA"]) as cursorc:  # NEED TO CHECK COL NAME OF AREA.
-                for rowc in cursorc:
-                    rowc[0] = meanVal
-                    rowc[1] = minVal
-                    rowc[2] = maxVal
-                    rowc[3] = stdVal
-                    rowc[4] = p0
-                    rowc[5] = p1
-                    rowc[6] = p2
-                    rowc[7] = p3
-                    rowc[8] = p4
-                    rowc[9] = p5
-                    rowc[10] = round((rowc[16]/100 * p0)/1000000, 2)
-                    rowc[11] = round((rowc[16]/100 * p1)/1000000, 2)
-                    rowc[12] = round((rowc[16]/100 * p2)/1000000, 2)
-                    rowc[13] = round((rowc[16]/100 * p3)/1000000, 2)
-                    rowc[14] = round((rowc[16]/100 * p4)/1000000, 2)
-                    rowc[15] = round((rowc[16]/100 * p5)/1000000, 2)
-
-                    cursorc.updateRow(rowc)
-            arcpy.Delete_management(r"in_memory")
-
-    if arcpy.Exists(zone_info):
-        arcpy.Delete_management(zone_info)
-    if arcpy.Exists(sz_fl):
-        arcpy.Delete_management(zone_info)
-
-    if arcpy.Exists(os.path.join(scratch, "histtab")):
-        arcpy.Delete_management(os.path.join(scratch, "histtab"))
-
-    if arcpy.Exists(os.path.join(scratch, "tempRas")):
-        arcpy.Delete_management(os.path.join(scratch, "tempRas"))
-
-    zones_list = []
-
-    walk = arcpy.da.Walk(scratch, datatype="FeatureClass", type="Polygon")
-
-    for dirpath, dirnames, filenames in walk:
-        for filename in filenames:
-            zones_list.append(os.path.join(dirpath, filename))
-
-    if len(zones_list) > 1:
-        arcpy.AddMessage("merging final features")
-        arcpy.Merge_management(zones_list, zones_out)
-    else:
-        arcpy.AddMessage("copying final features")
-        arcpy.CopyFeatures_management(zones_list[0], zones_out)
-
-    for fc in zones_list:
-        arcpy.Delete_management(fc)
-
-    if arcpy.Exists(scratch):
-        try:
-            arcpy.Delete_management(scratch)
-        except Exception:
-            print("An issue occured when deleting the scratch folder - not a big deal")
-
-    arcpy.Delete_management(r"in_memory")
-
+    workers = max(1, int(workers or 1))
+    sr = Beaver_Arc_Utils.grid_spatial_reference(bhi_home)
+
+    def compute(zones):
+        # work through the zones one OS 100 km tile at a time - each task gets a run of the tile schedule.
+        zone_ids, extents = Beaver_Arc_Utils.zone_extents(zones, sr)
+        groups = Zone_Schedule.schedule(extents, Beaver_NumPy_Utils.read_os_grid())
+        arcpy.AddMessage(Zone_Schedule.describe(groups))
+        parts = Zone_Schedule.split_order(groups, 1 if workers == 1 else workers * 4)
+        tasks = [{"bhi_home": bhi_home, "zone_info": zones, "cache_mb": float(cache_mb), "pyramid_dir": pyramid_dir,
+                  "overview_dir": overview_dir, "prefetch": int(prefetch or 0), "prefetch_mb": float(prefetch_mb),
+                  "overlap": overlap, "fieldset": fieldset, "order": [int(z) for z in zone_ids[part]],
+                  "subset": len(parts) > 1}
+                 for part in parts]
+
+        arcpy.AddMessage("begin looping {0} features on {1} worker(s)...".format(len(zone_ids), workers))
+        outputs = Zone_Parallel.run_zones(zone_worker, tasks, workers)
+        for n, (_, summary) in enumerate(outputs):
+            arcpy.AddMessage("zone range {0}/{1} {2}".format(n + 1, len(outputs), summary))
+        return np.sort(np.concatenate([res for res, _ in outputs]), order="Zone_no")
+
+    fingerprint = None
+    if result_cache:
+        if BHI_Tile_Store.is_store(bhi_home):
+            fingerprint = Beaver_NumPy_Utils.source_fingerprint([bhi_home])
+        else:
+            tiles = Beaver_Arc_Utils.tile_index(bhi_home).tiles
+            fingerprint = Beaver_Arc_Utils.source_fingerprint([t.path for t in tiles])
+        if not overview_dir:
+            fingerprint = fieldset.fingerprint(fingerprint)
+    results = Beaver_Arc_Utils.cached_results(zone_info, scratch, fields, compute, result_cache, fingerprint, sr)
+
+    Beaver_Arc_Utils.write_outputs(zone_info, zones_out, table_out, results, scratch)
     arcpy.AddMessage("Tool completed")
 
 
@@ -269,6 +167,7 @@ if __name__ == '__main__':
     main(
         sys.argv[1],
         sys.argv[2],
-        sys.argv[3])
+        sys.argv[3],
+        *sys.argv[4:])
 
 
@@ -0,0 +1,199 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Beaver Habitat Index (BHI) Zonal Statistics Core.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It holds the arcpy-free statistics engine shared by
+#                  the BHI tools. All zones are burnt into a single label grid and the BHI class histogram of every
+#                  zone is built with one bincount pass. The BHI is an integer raster (0-5), so the mean, min, max and
+#                  standard deviation of each zone are derived exactly from its histogram. Pixels outside 0-5 (or
+#                  equal to the raster NoData value) are ignored. Rasters are walked in fixed-size blocks and each
+#                  block updates mergeable per-zone accumulators, so peak memory is bounded by the block size rather
+#                  than by the raster or zone size. The output fields follow a Zone_Stats_Spec specification, the
+#                  BHI_* fields by default; every one of them is a function of the class histograms.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import numpy as np
+
+import Zone_Stats_Spec
+
+N_CLASSES = 6
+
+# rows/columns per block when streaming a raster window - 2048 x 2048 labels and values is roughly 20 MB.
+DEFAULT_BLOCK_SIZE = 2048
+
+# the default output fields (see Zone_Stats_Spec)
+DEFAULT_SPEC = ([{"name": "BHI_" + stat.upper(), "stat": stat, "round": None}
+                 for stat in ("mean", "min", "max", "std")] +
+                [{"name": "BHI_PERC_{0}".format(c), "stat": "share", "eq": c} for c in range(N_CLASSES)] +
+                [{"name": "BHI_AREA_{0}".format(c), "stat": "area", "eq": c} for c in range(N_CLASSES)])
+BHI_FIELDS = [field["name"] for field in DEFAULT_SPEC]
+
+
+def field_set(spec=None):
+    """Compile the BHI output fields of a statistics specification (None for the BHI_* fields)."""
+    return Zone_Stats_Spec.field_set(spec, "bhi", DEFAULT_SPEC)
+
+
+def empty_histogram(n_zones):
+    """Return a zeroed (n_zones, 6) class count array."""
+    return np.zeros((n_zones, N_CLASSES), dtype=np.int64)
+
+
+def zone_index(labels, zone_ids):
+    """Map a label array of Zone_no values onto row positions in the sorted zone_ids array.
+    Pixels that do not belong to any zone are given -1."""
+    zone_ids = np.asarray(zone_ids)
+    labels = np.asarray(labels).ravel()
+    if zone_ids.size == 0:
+        return np.full(labels.shape, -1, dtype=np.int64)
+    pos = np.searchsorted(zone_ids, labels)
+    pos[pos >= zone_ids.size] = 0
+    return np.where(zone_ids[pos] == labels, pos, -1)
+
+
+def bhi_histogram(labels, values, zone_ids, nodata=None, out=None):
+    """Count the pixels of each BHI class for every zone in a single pass.
+
+    labels and values are aligned arrays of the same shape; labels hold Zone_no values (anything not in the
+    sorted zone_ids array is background). Counts are added to out when it is given, so windows read from
+    several tiles can be accumulated into one histogram."""
+    if out is None:
+        out = empty_histogram(len(zone_ids))
+
+    idx = zone_index(labels, zone_ids)
+    values = np.asarray(values).ravel()
+
+    valid = (idx >= 0) & (values >= 0) & (values <= N_CLASSES - 1)
+    if nodata is not None:
+        valid &= values != nodata
+    if not valid.any():
+        return out
+
+    keys = idx[valid] * N_CLASSES + values[valid].astype(np.int64)
+    counts = np.bincount(keys, minlength=out.size)
+    out += counts.reshape(out.shape)
+    return out
+
+
+def iter_blocks(nrows, ncols, block_size=DEFAULT_BLOCK_SIZE):
+    """Yield (row, col, nrows, ncols) for fixed-size blocks covering an nrows x ncols window, row by row."""
+    for row in range(0, nrows, block_size):
+        for col in range(0, ncols, block_size):
+            yield row, col, min(block_size, nrows - row), min(block_size, ncols - col)
+
+
+class BHIAccumulator(object):
+    def __init__(self, zone_ids):
+        """Mergeable per-zone BHI accumulator.
+
+        The 6-bin class histogram of each zone is the only state kept: count, sum, sum of squares, min and max are
+        all exact functions of it, and two accumulators are merged by adding their histograms. Blocks, tiles or
+        workers can therefore be reduced in any order and give identical results."""
+        self.zone_ids = np.asarray(zone_ids, dtype=np.int64)
+        self.hist = empty_histogram(len(self.zone_ids))
+
+    def update(self, labels, values, nodata=None, zone=None):
+        """Add one aligned block of labels and BHI values. If zone is given only that zone is updated, which
+        lets a zone's own window be read without counting other zones that fall inside it."""
+        if zone is None:
+            bhi_histogram(labels, values, self.zone_ids, nodata=nodata, out=self.hist)
+        else:
+            pos = int(np.searchsorted(self.zone_ids, zone))
+            bhi_histogram(labels, values, self.zone_ids[pos:pos + 1], nodata=nodata, out=self.hist[pos:pos + 1])
+        return self
+
+    def merge(self, other):
+        """Add the counts of another accumulator over the same zones."""
+        if not np.array_equal(self.zone_ids, other.zone_ids):
+            raise ValueError("cannot merge BHI accumulators over different zones")
+        self.hist += other.hist
+        return self
+
+    @property
+    def count(self):
+        return self.hist.sum(axis=1)
+
+    @property
+    def sum(self):
+        return self.hist.dot(np.arange(N_CLASSES, dtype=np.int64))
+
+    @property
+    def sum_sq(self):
+        return self.hist.dot(np.arange(N_CLASSES, dtype=np.int64) ** 2)
+
+    @property
+    def min(self):
+        return bhi_stats(self.hist)["min"]
+
+    @property
+    def max(self):
+        return bhi_stats(self.hist)["max"]
+
+    def fields(self, shape_area, fieldset=None):
+        """Return the BHI_* fields (or those of fieldset) of every zone (see bhi_fields)."""
+        return bhi_fields(self.zone_ids, self.hist, shape_area, fieldset)
+
+
+def bhi_stats(hist):
+    """Derive the per-zone count, mean, min, max and population standard deviation from class histograms.
+    Zones without any BHI pixels get 0 for every statistic."""
+    hist = np.asarray(hist, dtype=np.int64)
+    classes = np.arange(N_CLASSES, dtype=np.float64)
+
+    count = hist.sum(axis=1)
+    has_data = count > 0
+    safe_count = np.where(has_data, count, 1).astype(np.float64)
+
+    total = hist.dot(classes)
+    mean = total / safe_count
+    variance = hist.dot(classes ** 2) / safe_count - mean ** 2
+    std = np.sqrt(np.clip(variance, 0, None))
+
+    present = hist > 0
+    bhi_min = np.where(has_data, np.argmax(present, axis=1), 0).astype(np.float64)
+    bhi_max = np.where(has_data, N_CLASSES - 1 - np.argmax(present[:, ::-1], axis=1), 0).astype(np.float64)
+
+    return {"count": count,
+            "mean": np.where(has_data, mean, 0),
+            "min": bhi_min,
+            "max": bhi_max,
+            "std": np.where(has_data, std, 0)}
+
+
+def outside_zones(results):
+    """Return the Zone_no of the zones of a results array without any BHI pixels - every percentage is 0. Results
+    without the BHI_PERC_* fields (see field_set) give none."""
+    names = ["BHI_PERC_{0}".format(c) for c in range(N_CLASSES)]
+    if not set(names) <= set(results.dtype.names):
+        return results["Zone_no"][:0]
+    perc_total = sum(results[name] for name in names)
+    return results["Zone_no"][perc_total == 0]
+
+
+def histogram_quantile(hist, q):
+    """Return the q quantile class of every zone from its class histogram - the smallest class whose cumulative
+    count reaches q of the zone's pixels (0 for zones without any)."""
+    hist = np.asarray(hist, dtype=np.int64)
+    cum = np.cumsum(hist, axis=1)
+    reached = cum >= np.maximum(q * cum[:, -1:], 1)
+    return np.where(cum[:, -1] > 0, np.argmax(reached, axis=1), 0).astype(np.float64)
+
+
+def bhi_fields(zone_ids, hist, shape_area, fieldset=None):
+    """Build a structured array holding Zone_no and every BHI_* field (or those of fieldset) for each zone.
+
+    shape_area is the zone area in square metres; the BHI_AREA_* fields are reported in square km from the
+    rounded class percentages, as the per-zone tools have always done."""
+    fieldset = fieldset or field_set()
+    hist = np.asarray(hist, dtype=np.int64)
+    stats = bhi_stats(hist)
+    classes = np.arange(N_CLASSES)
+
+    # every pixel weighs the same, so the weighted statistics are the plain ones
+    group_count = hist.dot(fieldset.groups(classes)[:, None] == np.arange(fieldset.n_groups))
+    state = {"count": stats["count"], "weight": stats["count"], "sum": hist.dot(classes),
+             "mean": stats["mean"], "std": stats["std"], "w_mean": stats["mean"], "w_std": stats["std"],
+             "min": stats["min"], "max": stats["max"], "group_count": group_count, "group_weight": group_count,
+             "area": shape_area, "quantile": lambda q, weighted: histogram_quantile(hist, q)}
+    return fieldset.evaluate(zone_ids, state)
@@ -0,0 +1,132 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: BHI Tile Cache.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It wraps a BHI tile reader in a least recently used
+#                  cache of fixed-size pixel blocks with a memory budget. Zones that cluster in the same OS 100 km
+#                  square then read their neighbours' blocks from RAM rather than from disk. Hit, miss and eviction
+#                  counts are kept so they can be reported at the end of a run. A long-lived process (Beaver_Batch)
+#                  can keep one cache per reader warm from run to run with keep_warm().
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_BLOCK_SIZE = 512
+
+# caches kept from run to run once keep_warm() is called, by (reader, budget_mb, block_size)
+_WARM = None
+
+
+def source_stamp(path, gdb_stamps=None):
+    """Return the modification time of a tile's file. A raster held in a file geodatabase has no file of its own, so
+    it takes the newest time of the files in its .gdb folder (gdb_stamps may hold those already found by folder).
+    None when neither can be found."""
+    if os.path.exists(path):
+        return os.path.getmtime(path)
+    gdb = os.path.dirname(path)
+    while gdb and not os.path.isdir(gdb) and os.path.dirname(gdb) != gdb:
+        gdb = os.path.dirname(gdb)
+    if not gdb.lower().endswith(".gdb") or not os.path.isdir(gdb):
+        return None
+    if gdb_stamps is not None and gdb in gdb_stamps:
+        return gdb_stamps[gdb]
+    files = [os.path.join(gdb, f) for f in os.listdir(gdb)]
+    stamp = max([os.path.getmtime(f) for f in files if os.path.isfile(f)] or [os.path.getmtime(gdb)])
+    if gdb_stamps is not None:
+        gdb_stamps[gdb] = stamp
+    return stamp
+
+
+class TileCache(object):
+    def __init__(self, reader, budget_mb=512, block_size=DEFAULT_BLOCK_SIZE):
+        """Cache the blocks returned by reader(tile, row, col, nrows, ncols) within budget_mb megabytes."""
+        self.reader = reader
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.block_size = block_size
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stamps = {}
+
+    def _block(self, tile, brow, bcol):
+        key = (tile.path, brow, bcol)
+        block = self.blocks.get(key)
+        if block is not None:
+            self.hits += 1
+            # re-insert to mark the block as most recently used
+            self.blocks[key] = self.blocks.pop(key)
+            return block
+
+        self.misses += 1
+        bs = self.block_size
+        row, col = brow * bs, bcol * bs
+        block = np.asarray(self.reader(tile, row, col, min(bs, tile.nrows - row), min(bs, tile.ncols - col)))
+
+        if block.nbytes <= self.budget:
+            if tile.path not in self.stamps:
+                self.stamps[tile.path] = source_stamp(tile.path)
+            self.blocks[key] = block
+            self.nbytes += block.nbytes
+            while self.nbytes > self.budget:
+                _, old = self.blocks.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+        return block
+
+    def __call__(self, tile, row, col, nrows, ncols):
+        """Read a block of a tile, assembled from cached blocks."""
+        bs = self.block_size
+        out = None
+        for brow in range(row // bs, (row + nrows - 1) // bs + 1):
+            for bcol in range(col // bs, (col + ncols - 1) // bs + 1):
+                block = self._block(tile, brow, bcol)
+                if out is None:
+                    out = np.empty((nrows, ncols), dtype=block.dtype)
+
+                r0, c0 = max(row, brow * bs), max(col, bcol * bs)
+                r1, c1 = min(row + nrows, brow * bs + block.shape[0]), min(col + ncols, bcol * bs + block.shape[1])
+                out[r0 - row:r1 - row, c0 - col:c1 - col] = block[r0 - brow * bs:r1 - brow * bs,
+                                                                  c0 - bcol * bs:c1 - bcol * bs]
+        return out
+
+    def refresh(self):
+        """Drop the blocks of tiles modified since they were cached and reset the counters, ready for another run."""
+        gdb_stamps = {}
+        changed = set(path for path, stamp in self.stamps.items() if source_stamp(path, gdb_stamps) != stamp)
+        for key in [key for key in self.blocks if key[0] in changed]:
+            self.nbytes -= self.blocks.pop(key).nbytes
+        for path in changed:
+            del self.stamps[path]
+        self.hits = self.misses = self.evictions = 0
+
+    def summary(self):
+        """Return a one line report of the cache counters."""
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        return "tile cache: {0} hits, {1} misses ({2:.1f}% hit rate), {3} evictions, {4:.1f} MB held".format(
+            self.hits, self.misses, rate, self.evictions, self.nbytes / 1024.0 / 1024.0)
+
+
+def keep_warm(enabled=True):
+    """Keep the caches returned by open_cache() (and the blocks they hold) from one run to the next."""
+    global _WARM
+    _WARM = {} if enabled else None
+
+
+def open_cache(reader, budget_mb=512, block_size=DEFAULT_BLOCK_SIZE):
+    """Return a TileCache for reader - a new one, or once keep_warm() is called the one kept from earlier runs."""
+    if _WARM is None:
+        return TileCache(reader, budget_mb, block_size)
+    key = (reader, budget_mb, block_size)
+    cache = _WARM.get(key)
+    if cache is None:
+        cache = _WARM[key] = TileCache(reader, budget_mb, block_size)
+    else:
+        cache.refresh()
+    return cache
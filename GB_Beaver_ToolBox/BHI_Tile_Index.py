@@ -0,0 +1,99 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: BHI Tile Index.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It maps a zone's bounding box onto the exact pixel
+#                  windows of every BHI tile it overlaps, and stitches those windows into one in-memory array. The
+#                  stand-alone BHI tool uses it to read only the pixels it needs instead of copying or mosaicking
+#                  whole 100 km tiles into the scratch gdb. The index itself is arcpy-free; reading a window is left
+#                  to a reader function supplied by the caller.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import math
+from collections import namedtuple
+
+import numpy as np
+
+import BHI_Stats_Core
+
+# value given to stitched pixels that are NoData in their tile or not covered by any tile.
+FILL_VALUE = 255
+
+Window = namedtuple("Window", ["xmin", "ymin", "nrows", "ncols"])
+TileWindow = namedtuple("TileWindow", ["tile", "row", "col", "nrows", "ncols", "dst_row", "dst_col"])
+
+
+class Tile(object):
+    def __init__(self, name, path, xmin, ymin, xmax, ymax, cell, nodata=None):
+        """A single BHI raster tile and its georeferencing."""
+        self.name = name
+        self.path = path
+        self.xmin = xmin
+        self.ymin = ymin
+        self.xmax = xmax
+        self.ymax = ymax
+        self.cell = cell
+        self.nodata = nodata
+        self.nrows = int(round((ymax - ymin) / cell))
+        self.ncols = int(round((xmax - xmin) / cell))
+
+
+class TileIndex(object):
+    def __init__(self, tiles):
+        """Index a set of BHI tiles that share one cell size and snap grid."""
+        self.tiles = list(tiles)
+        if not self.tiles:
+            raise ValueError("no BHI tiles supplied")
+        self.cell = self.tiles[0].cell
+        self.origin_x = self.tiles[0].xmin
+        self.origin_y = self.tiles[0].ymin
+
+    def window(self, xmin, ymin, xmax, ymax):
+        """Snap a bounding box outwards onto the BHI grid."""
+        c = self.cell
+        x0 = self.origin_x + math.floor(round((xmin - self.origin_x) / c, 6)) * c
+        y0 = self.origin_y + math.floor(round((ymin - self.origin_y) / c, 6)) * c
+        x1 = self.origin_x + math.ceil(round((xmax - self.origin_x) / c, 6)) * c
+        y1 = self.origin_y + math.ceil(round((ymax - self.origin_y) / c, 6)) * c
+        return Window(x0, y0, max(int(round((y1 - y0) / c)), 1), max(int(round((x1 - x0) / c)), 1))
+
+    def blocks(self, win, block_size=BHI_Stats_Core.DEFAULT_BLOCK_SIZE):
+        """Split a window into fixed-size sub-windows, from the top left, for streamed reads."""
+        c = self.cell
+        top = win.ymin + win.nrows * c
+        for row, col, nrows, ncols in BHI_Stats_Core.iter_blocks(win.nrows, win.ncols, block_size):
+            yield Window(win.xmin + col * c, top - (row + nrows) * c, nrows, ncols)
+
+    def tile_windows(self, win):
+        """Return the part of the window that falls in each overlapping tile, in tile and window pixel offsets."""
+        c = self.cell
+        wx1 = win.xmin + win.ncols * c
+        wy1 = win.ymin + win.nrows * c
+        parts = []
+        for tile in self.tiles:
+            x0, x1 = max(win.xmin, tile.xmin), min(wx1, tile.xmax)
+            y0, y1 = max(win.ymin, tile.ymin), min(wy1, tile.ymax)
+            ncols = int(round((x1 - x0) / c))
+            nrows = int(round((y1 - y0) / c))
+            if ncols <= 0 or nrows <= 0:
+                continue
+            parts.append(TileWindow(tile,
+                                    int(round((tile.ymax - y1) / c)), int(round((x0 - tile.xmin) / c)),
+                                    nrows, ncols,
+                                    int(round((wy1 - y1) / c)), int(round((x0 - win.xmin) / c))))
+        return parts
+
+    def read(self, win, reader):
+        """Read a window, stitched across tile edges, into a uint8 array (NoData = FILL_VALUE).
+
+        reader(tile, row, col, nrows, ncols) must return the requested block of a tile as a NumPy array."""
+        out = np.full((win.nrows, win.ncols), FILL_VALUE, dtype=np.uint8)
+        for part in self.tile_windows(win):
+            block = np.asarray(reader(part.tile, part.row, part.col, part.nrows, part.ncols))
+            valid = (block >= 0) & (block < FILL_VALUE)
+            if part.tile.nodata is not None:
+                valid &= block != part.tile.nodata
+            dst = out[part.dst_row:part.dst_row + part.nrows, part.dst_col:part.dst_col + part.ncols]
+            dst[valid] = block[valid]
+        return out
@@ -0,0 +1,210 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: BHI Packed Tile Store.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It converts the national BHI tiles into a compact
+#                  store: each tile is cut into fixed blocks and a block directory marks blocks that are all NoData
+#                  (e.g. sea) or hold a single class, so these are never stored or read. Only mixed blocks are kept,
+#                  as 4-bit (or 8-bit) packed BHI values in one memory-mapped file per tile. Reading a window then
+#                  touches only the mixed blocks under it. Convert a BHI workspace from the command line:
+#                      python BHI_Tile_Store.py <BHI raster workspace> <store folder> [bits: 4 or 8]
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+
+import numpy as np
+
+import BHI_Stats_Core
+import BHI_Tile_Index
+import Run_Trace
+
+METADATA = "bhi_store.json"
+DIRECTORY_SUFFIX = ".blocks.npy"
+DATA_SUFFIX = ".packed"
+BLOCK_SIZE = 256
+
+# block directory codes - mixed blocks hold their position in the packed data file (>= 0)
+EMPTY = -1
+UNIFORM = -2  # a block of class c holds UNIFORM - c
+
+# the stored value of NoData pixels for each packing
+NODATA_CODES = {4: 15, 8: BHI_Tile_Index.FILL_VALUE}
+
+# stores opened by this process, by folder: (metadata time stamp, TileStore)
+_STORES = {}
+
+
+def _pack(codes, bits):
+    flat = codes.ravel()
+    if bits == 8:
+        return flat
+    return (flat[0::2] | (flat[1::2] << 4)).astype(np.uint8)
+
+
+def _unpack(data, bits, block_size):
+    data = np.asarray(data)
+    if bits == 8:
+        return data.reshape(block_size, block_size)
+    out = np.empty(data.size * 2, dtype=np.uint8)
+    out[0::2] = data & 15
+    out[1::2] = data >> 4
+    return out.reshape(block_size, block_size)
+
+
+def convert_tile(tile, reader, folder, block_size=BLOCK_SIZE, bits=4):
+    """Write one tile to the store, one strip of blocks at a time. Returns the number of empty, single class and
+    mixed blocks."""
+    nodata_code = NODATA_CODES[bits]
+    nby = -(-tile.nrows // block_size)
+    nbx = -(-tile.ncols // block_size)
+    directory = np.full((nby, nbx), EMPTY, dtype=np.int64)
+    n_mixed = 0
+
+    with open(os.path.join(folder, tile.name + DATA_SUFFIX), "wb") as f:
+        for bi in range(nby):
+            row = bi * block_size
+            nrows = min(block_size, tile.nrows - row)
+            values = np.asarray(reader(tile, row, 0, nrows, tile.ncols))
+            valid = (values >= 0) & (values <= BHI_Stats_Core.N_CLASSES - 1)
+            if tile.nodata is not None:
+                valid &= values != tile.nodata
+            strip = np.full((block_size, nbx * block_size), nodata_code, dtype=np.uint8)
+            strip[:nrows, :tile.ncols][valid] = values[valid]
+
+            for bj in range(nbx):
+                blk = strip[:, bj * block_size:(bj + 1) * block_size]
+                first = blk.flat[0]
+                if not (blk != first).any():
+                    directory[bi, bj] = EMPTY if first == nodata_code else UNIFORM - int(first)
+                else:
+                    directory[bi, bj] = n_mixed
+                    f.write(_pack(blk, bits).tobytes())
+                    n_mixed += 1
+
+    np.save(os.path.join(folder, tile.name + DIRECTORY_SUFFIX), directory)
+    n_empty = int((directory == EMPTY).sum())
+    return n_empty, directory.size - n_empty - n_mixed, n_mixed
+
+
+def convert(index, reader, folder, block_size=BLOCK_SIZE, bits=4, message=print, spatial_reference=None):
+    """Convert every tile of a BHI_Tile_Index.TileIndex into a packed store in folder. spatial_reference (the
+    tiles' coordinate system as text, e.g. an arcpy SpatialReference exported to a string) is kept with the store so
+    zones can be projected onto its grid."""
+    if bits not in NODATA_CODES:
+        raise ValueError("bits must be 4 or 8")
+    _STORES.pop(os.path.abspath(folder), None)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    meta = {"block_size": block_size, "bits": bits, "tiles": {}, "spatial_reference": spatial_reference}
+    for n, tile in enumerate(index.tiles):
+        empty, uniform, mixed = convert_tile(tile, reader, folder, block_size, bits)
+        message("packed tile {0} ({1}/{2}): {3} empty, {4} single class and {5} mixed blocks".format(
+            tile.name, n + 1, len(index.tiles), empty, uniform, mixed))
+        meta["tiles"][tile.name] = [tile.xmin, tile.ymin, tile.xmax, tile.ymax, tile.cell]
+
+    with open(os.path.join(folder, METADATA), "w") as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, METADATA))
+
+
+def is_store_tile(tile):
+    return tile.path.endswith(DIRECTORY_SUFFIX)
+
+
+def open_store(folder):
+    """Open a store built by convert(), once per process unless it has been converted again since."""
+    folder = os.path.abspath(folder)
+    stamp = os.path.getmtime(os.path.join(folder, METADATA))
+    held = _STORES.get(folder)
+    if held is None or held[0] != stamp:
+        held = _STORES[folder] = (stamp, TileStore(folder))
+    return held[1]
+
+
+class TileStore(object):
+    def __init__(self, folder):
+        """A packed BHI tile store. Block directories and packed data are memory-mapped on first use."""
+        self.folder = folder
+        with open(os.path.join(folder, METADATA)) as f:
+            meta = json.load(f)
+        self.block_size = meta["block_size"]
+        self.bits = meta["bits"]
+        self.spatial_reference = meta.get("spatial_reference")
+        self.tiles = [BHI_Tile_Index.Tile(name, os.path.join(folder, name + DIRECTORY_SUFFIX), *ext,
+                                          nodata=BHI_Tile_Index.FILL_VALUE)
+                      for name, ext in sorted(meta["tiles"].items())]
+        self._arrays = {}
+
+    def index(self):
+        return BHI_Tile_Index.TileIndex(self.tiles)
+
+    def _tile_arrays(self, tile):
+        if tile.name not in self._arrays:
+            directory = np.load(tile.path, mmap_mode="r")
+            data_path = os.path.join(self.folder, tile.name + DATA_SUFFIX)
+            nbytes = self.block_size * self.block_size * self.bits // 8
+            data = None
+            if os.path.getsize(data_path):
+                data = np.memmap(data_path, dtype=np.uint8, mode="r").reshape(-1, nbytes)
+            self._arrays[tile.name] = (directory, data)
+        return self._arrays[tile.name]
+
+    def read_tile(self, tile, row, col, nrows, ncols):
+        """Tile reader for BHI_Tile_Index: NoData is returned as FILL_VALUE and empty blocks are never read."""
+        bs = self.block_size
+        directory, data = self._tile_arrays(tile)
+        out = np.full((nrows, ncols), BHI_Tile_Index.FILL_VALUE, dtype=np.uint8)
+        with Run_Trace.phase("read packed window"):
+            for bi in range(row // bs, (row + nrows - 1) // bs + 1):
+                for bj in range(col // bs, (col + ncols - 1) // bs + 1):
+                    code = int(directory[bi, bj])
+                    if code == EMPTY:
+                        continue
+                    r0, c0 = max(row, bi * bs), max(col, bj * bs)
+                    r1, c1 = min(row + nrows, (bi + 1) * bs), min(col + ncols, (bj + 1) * bs)
+                    dst = out[r0 - row:r1 - row, c0 - col:c1 - col]
+                    if code <= UNIFORM:
+                        dst[...] = UNIFORM - code
+                        continue
+                    blk = _unpack(data[code], self.bits, bs)[r0 - bi * bs:r1 - bi * bs, c0 - bj * bs:c1 - bj * bs]
+                    valid = blk != NODATA_CODES[self.bits]
+                    dst[valid] = blk[valid]
+                    Run_Trace.count(blk.size, bytes_read=data.shape[1])
+        return out
+
+
+def read_tile(tile, row, col, nrows, ncols):
+    """Tile reader for tiles of any open store (see is_store_tile)."""
+    return open_store(os.path.dirname(tile.path)).read_tile(tile, row, col, nrows, ncols)
+
+
+def store_tile(path):
+    """Return the Tile of a store given its block directory file."""
+    name = os.path.basename(path)[:-len(DIRECTORY_SUFFIX)]
+    for tile in open_store(os.path.dirname(path)).tiles:
+        if tile.name == name:
+            return tile
+    raise ValueError("{0} is not a tile of a BHI store".format(path))
+
+
+if __name__ == '__main__':
+    try:
+        import Beaver_Arc_Utils as utils
+        source = sys.argv[1]
+        grid_sr = utils.grid_spatial_reference(source).exportToString()
+    except ImportError:
+        import Beaver_NumPy_Utils as utils
+        source = [sys.argv[1]]
+        grid_sr = None
+    convert(utils.tile_index(source), utils.read_tile, sys.argv[2], bits=int(sys.argv[3]) if len(sys.argv) > 3 else 4,
+            spatial_reference=grid_sr)
@@ -0,0 +1,428 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Beaver ToolBox arcpy Utilities.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It holds the arcpy helpers shared by the tool scripts:
+#                  preparing a numbered copy of the search zones, reading zone geometry and aligned raster windows
+#                  into NumPy and writing the per-zone results back in a single cursor pass. Every run
+#                  (and every parallel worker) works in its own temporary scratch gdb.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import itertools
+import tempfile
+import arcpy
+import numpy as np
+
+import BDC_Network_Cache
+import BDC_Stats_Core
+import BHI_Overview
+import BHI_Pyramid
+import BHI_Stats_Core
+import BHI_Tile_Index
+import BHI_Tile_Store
+import Run_Trace
+import Zone_Geometry
+import Zone_Overlap
+import Zone_Prefetch
+import Zone_Result_Cache
+import Zone_Table_Export
+
+# tile indexes built by this process, by BHI workspace: (workspace modification time, TileIndex)
+_INDEXES = {}
+
+
+def make_scratch(scratchName="scratch.gdb"):
+    """Create a private scratch gdb inside a new temporary folder, so that two runs (or two workers) never share
+    or delete each other's scratch data."""
+    scratchPath = tempfile.mkdtemp(prefix="beaver_")
+    arcpy.CreateFileGDB_management(scratchPath, scratchName)
+    return os.path.join(scratchPath, scratchName)
+
+
+def prepare_zones(s_zone, scratch, fields):
+    """Copy the search zones into the scratch gdb, number them (Zone_no) and add the (DOUBLE) output fields."""
+    sZone_fields = [f.name for f in arcpy.ListFields(s_zone)]
+    if "Zone_no" in sZone_fields:
+        arcpy.DeleteField_management(s_zone, "Zone_no")
+
+    zone_info = os.path.join(scratch, "tmp_shp_copy")
+    if arcpy.Exists(zone_info):
+        arcpy.Delete_management(zone_info)
+    with Run_Trace.phase("copy zones"):
+        arcpy.CopyFeatures_management(s_zone, zone_info)
+
+    # create sequential numbers for reaches
+    arcpy.AddField_management(zone_info, "Zone_no", "LONG")
+
+    with arcpy.da.UpdateCursor(zone_info, ["Zone_no", 'OBJECTID']) as cursor:
+        for row in cursor:
+            row[0] = row[1]
+
+            cursor.updateRow(row)
+
+    for field in fields:
+        arcpy.AddField_management(zone_info, field_name=field, field_type="DOUBLE")
+
+    return zone_info
+
+
+def zone_subset(zone_info, scratch, first=None, last=None, zones=None):
+    """Copy the zones with Zone_no between first and last (inclusive), or in the list zones, into a scratch gdb."""
+    subset = os.path.join(scratch, "zone_subset")
+    if zones is not None:
+        where = "Zone_no IN ({0})".format(", ".join(str(int(z)) for z in zones))
+    else:
+        where = "Zone_no >= {0} AND Zone_no <= {1}".format(first, last)
+    with Run_Trace.phase("copy zone subset"):
+        zone_fl = arcpy.MakeFeatureLayer_management(zone_info, "zoneSubsetFL", where)
+        arcpy.CopyFeatures_management(zone_fl, subset)
+        arcpy.Delete_management(zone_fl)
+    return subset
+
+
+def zone_table(zone_info, spatial_reference=None):
+    """Return the sorted Zone_no values and the matching zone areas (map units squared, of spatial_reference if
+    given)."""
+    arr = arcpy.da.FeatureClassToNumPyArray(zone_info, ["Zone_no", "SHAPE@AREA"], spatial_reference=spatial_reference)
+    arr = np.sort(arr, order="Zone_no")
+    return arr["Zone_no"].astype(np.int64), arr["SHAPE@AREA"].astype(np.float64)
+
+
+def spatial_reference(data):
+    """Return the spatial reference of a feature class or raster, to read zones in the coordinates of the data they
+    are laid over."""
+    return arcpy.Describe(data).spatialReference
+
+
+def zone_extents(zone_info, spatial_reference=None):
+    """Return the sorted Zone_no values and the matching (n, 4) zone extents, for Zone_Schedule - in spatial_reference
+    if given, projected on the fly."""
+    with arcpy.da.SearchCursor(zone_info, ["Zone_no", "SHAPE@"], spatial_reference=spatial_reference) as cursor:
+        rows = sorted((row[0], row[1].extent) for row in cursor)
+    extents = np.array([(e.XMin, e.YMin, e.XMax, e.YMax) if e is not None else (np.nan,) * 4 for _, e in rows],
+                       dtype=np.float64).reshape(-1, 4)
+    return np.array([z for z, _ in rows], dtype=np.int64), extents
+
+
+def in_order(items, order=None):
+    """Sort (Zone_no, ...) items into a processing order given as a list of Zone_no; unlisted zones go last."""
+    if order is None:
+        return list(items)
+    rank = dict((int(zone), n) for n, zone in enumerate(order))
+    return sorted(items, key=lambda item: rank.get(int(item[0]), len(rank)))
+
+
+def raster_extent(ras):
+    """Return (xmin, ymin, xmax, ymax, cellsize) for a raster."""
+    r = arcpy.Raster(ras)
+    ext = r.extent
+    return ext.XMin, ext.YMin, ext.XMax, ext.YMax, r.meanCellWidth
+
+
+def raster_nodata(ras):
+    """Return the NoData value of a raster (None if it has none)."""
+    return arcpy.Raster(ras).noDataValue
+
+
+def read_window(ras, xmin, ymin, ncols, nrows, nodata_to_value=None):
+    """Read an ncols x nrows window with lower left corner (xmin, ymin) into a NumPy array. Cells beyond the
+    raster extent are returned as NoData."""
+    with Run_Trace.phase("read raster window"):
+        if nodata_to_value is None:
+            arr = arcpy.RasterToNumPyArray(ras, arcpy.Point(xmin, ymin), ncols, nrows)
+        else:
+            arr = arcpy.RasterToNumPyArray(ras, arcpy.Point(xmin, ymin), ncols, nrows, nodata_to_value)
+        Run_Trace.count(arr.size, bytes_read=arr.nbytes)
+    return arr
+
+
+def raster_tile(ras):
+    """Return a single BHI raster as a BHI_Tile_Index.Tile."""
+    xmin, ymin, xmax, ymax, cell = raster_extent(ras)
+    return BHI_Tile_Index.Tile(os.path.basename(ras), ras, xmin, ymin, xmax, ymax, cell, raster_nodata(ras))
+
+
+def tile_index(bhi_home):
+    """Build a tile index of every BHI raster in a workspace from the raster extents, or of the tiles of a
+    BHI_Tile_Store packed store."""
+    if BHI_Tile_Store.is_store(bhi_home):
+        return BHI_Tile_Store.open_store(bhi_home).index()
+    # a workspace already indexed by this process is reused until rasters are added to or removed from it
+    key = os.path.abspath(bhi_home)
+    stamp = os.path.getmtime(bhi_home)
+    held = _INDEXES.get(key)
+    if held is not None and held[0] == stamp:
+        return held[1]
+
+    arcpy.env.workspace = bhi_home
+    tiles = []
+    for ras in arcpy.ListRasters("*", "ALL"):
+        path = os.path.join(bhi_home, ras)
+        xmin, ymin, xmax, ymax, cell = raster_extent(path)
+        tiles.append(BHI_Tile_Index.Tile(ras, path, xmin, ymin, xmax, ymax, cell, raster_nodata(path)))
+    index = _INDEXES[key] = (stamp, BHI_Tile_Index.TileIndex(tiles))
+    return index[1]
+
+
+def grid_spatial_reference(bhi_home):
+    """Return the spatial reference of the BHI grid: that of the first raster of a workspace, or the one recorded in
+    a packed BHI_Tile_Store (None for a store converted without one - zones are then taken as they are)."""
+    if BHI_Tile_Store.is_store(bhi_home):
+        text = BHI_Tile_Store.open_store(bhi_home).spatial_reference
+        if not text:
+            return None
+        sr = arcpy.SpatialReference()
+        sr.loadFromString(text)
+        return sr
+    return spatial_reference(tile_index(bhi_home).tiles[0].path)
+
+
+def read_tile(tile, row, col, nrows, ncols):
+    """Tile reader for BHI_Tile_Index: read a block of a tile given in pixel offsets from its top left corner."""
+    if BHI_Tile_Store.is_store_tile(tile):
+        return BHI_Tile_Store.read_tile(tile, row, col, nrows, ncols)
+    xmin = tile.xmin + col * tile.cell
+    ymin = tile.ymax - (row + nrows) * tile.cell
+    return read_window(tile.path, xmin, ymin, ncols, nrows)
+
+
+def geometry_rings(geom):
+    """Return the rings of an arcpy polygon as lists of (x, y); arcpy separates interior rings with None."""
+    rings = []
+    for part in geom:
+        ring = []
+        for pnt in part:
+            if pnt is None:
+                rings.append(ring)
+                ring = []
+            else:
+                ring.append((pnt.X, pnt.Y))
+        rings.append(ring)
+    return [ring for ring in rings if ring]
+
+
+def zones_pyramid_accumulator(zone_info, index, zone_ids, pyramid, reader=read_tile, prefetch=None, order=None,
+                              overlap=False, spatial_reference=None):
+    """Accumulate the BHI class histograms of all zones from a block-histogram pyramid. Only blocks on each zone's
+    boundary are read at pixel level; zones are handled from their own geometry, so overlaps need no special
+    treatment. With no pyramid every zone is read from the scanline runs of the pixels inside it, and a
+    Zone_Prefetch.Prefetcher may read the windows of the next zones in the background. Zones are processed in order
+    (a list of Zone_no) when one is given. With overlap, groups of overlapping zones are summarised together from
+    one read of their pixels (Zone_Overlap) and prefetch is not used. Zones are projected on the fly to
+    spatial_reference, which should be that of the BHI grid (see grid_spatial_reference)."""
+    acc = BHI_Stats_Core.BHIAccumulator(zone_ids)
+    n_feat = len(zone_ids)
+    with arcpy.da.SearchCursor(zone_info, ["Zone_no", "SHAPE@"], spatial_reference=spatial_reference) as cursor:
+        zones = in_order([(row[0], geometry_rings(row[1])) for row in cursor], order)
+    zone_rings = dict(zones)
+    extents = [(zone, Zone_Geometry.rings_extent(rings)) for zone, rings in zones]
+
+    if overlap:
+        for group in Zone_Overlap.overlap_groups([extent for _, extent in extents]):
+            group_zones = [zones[n][0] for n in group]
+            arcpy.AddMessage("working on feature(s) {0}/{1}".format(", ".join(str(z) for z in group_zones), n_feat))
+            pos = np.searchsorted(zone_ids, group_zones)
+            if len(group) == 1:
+                with Run_Trace.phase("zone", zone=group_zones[0]):
+                    acc.hist[pos[0]] += BHI_Pyramid.zone_counts(pyramid, index, reader, zone_rings[group_zones[0]])
+                continue
+            with Run_Trace.phase("overlap group", items=len(group)):
+                acc.hist[pos] += Zone_Overlap.group_counts(index, reader, [zone_rings[z] for z in group_zones])
+        return acc
+
+    for zone, zone_reader in Zone_Prefetch.zone_readers(extents, reader, prefetch):
+        arcpy.AddMessage("working on feature {0}/{1}".format(zone, n_feat))
+        pos = int(np.searchsorted(zone_ids, zone))
+        with Run_Trace.phase("zone", zone=zone):
+            acc.hist[pos] += BHI_Pyramid.zone_counts(pyramid, index, zone_reader, zone_rings[zone])
+    return acc
+
+
+def zones_quick_look(zone_info, index, zone_ids, overviews, shape_area, spatial_reference=None):
+    """Approximate BHI fields of all zones from BHI_Overview class count overviews, with no BHI pixels read. Zones
+    are projected on the fly to spatial_reference (that of the BHI grid) if given."""
+    zone_rings = [[] for _ in zone_ids]
+    with arcpy.da.SearchCursor(zone_info, ["Zone_no", "SHAPE@"], spatial_reference=spatial_reference) as cursor:
+        for row in cursor:
+            zone_rings[int(np.searchsorted(zone_ids, row[0]))] = geometry_rings(row[1])
+    with Run_Trace.phase("quick look zones", items=len(zone_ids)):
+        return BHI_Overview.zones_quick_look(overviews, index, zone_ids, zone_rings, shape_area)
+
+
+def overlay_chunks(lines, zone_info, scratch, field="BDC", chunk_rows=BDC_Stats_Core.CHUNK_ROWS):
+    """Intersect a line network with every zone in one overlay and yield the clipped pieces as (Zone_no, value,
+    clipped length) arrays of at most chunk_rows rows, read through a cursor so the overlay is never held whole.
+    Pieces without a value are skipped."""
+    overlay = os.path.join(scratch, "zone_overlay")
+    with Run_Trace.phase("intersect network"):
+        arcpy.Intersect_analysis([lines, zone_info], overlay, output_type="LINE")
+    try:
+        with arcpy.da.SearchCursor(overlay, ["Zone_no", field, "SHAPE@LENGTH"]) as cursor:
+            rows = (row for row in cursor if row[1] is not None)
+            while True:
+                with Run_Trace.phase("read overlay chunk"):
+                    chunk = np.array(list(itertools.islice(rows, chunk_rows)), dtype=np.float64).reshape(-1, 3)
+                    Run_Trace.count(len(chunk), bytes_read=chunk.nbytes)
+                if not len(chunk):
+                    break
+                yield chunk[:, 0].astype(np.int64), chunk[:, 1], chunk[:, 2]
+    finally:
+        arcpy.Delete_management(overlay)
+
+
+def source_fingerprint(paths):
+    """Fingerprint feature classes or rasters by path, feature count, extent and the modification time of the files
+    that hold them, so cached data built from them can be recognised as stale."""
+    parts = []
+    for path in paths:
+        desc = arcpy.Describe(path)
+        container = desc.catalogPath
+        while container and not os.path.isdir(container):
+            container = os.path.dirname(container)
+        if container.lower().endswith(".gdb"):
+            files = [os.path.join(container, f) for f in os.listdir(container)]
+        else:
+            files = glob.glob(os.path.splitext(desc.catalogPath)[0] + ".*") or [desc.catalogPath]
+        mtime = max(os.path.getmtime(f) for f in files if os.path.exists(f)) if files else 0
+        ext = desc.extent
+        count = int(arcpy.GetCount_management(path).getOutput(0)) if hasattr(desc, "shapeType") else 0
+        parts.append([desc.catalogPath, count, [ext.XMin, ext.YMin, ext.XMax, ext.YMax], int(mtime)])
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def iter_reaches(bdc_nets, field="BDC"):
+    """Yield (BDC, length, parts) for every reach of one or more BDC networks, all in the coordinates of the first
+    network. Rows without geometry or a BDC value are yielded without parts, so positions follow the rows of the
+    networks in turn."""
+    sr = spatial_reference(bdc_nets[0]) if bdc_nets else None
+    for fc in bdc_nets:
+        with arcpy.da.SearchCursor(fc, [field, "SHAPE@"], spatial_reference=sr) as cursor:
+            for value, shape in cursor:
+                if shape is None or value is None:
+                    yield value, 0.0, []
+                    continue
+                yield value, shape.length, [[(pnt.X, pnt.Y) for pnt in part if pnt] for part in shape]
+
+
+def open_network_cache(bdc_nets, cache_dir):
+    """Open the BDC network cache in cache_dir, building it first if it is missing or its sources have changed."""
+    fingerprint = source_fingerprint(bdc_nets)
+    if not BDC_Network_Cache.is_current(cache_dir, fingerprint):
+        arcpy.AddMessage("building bdc network cache in {0}".format(cache_dir))
+        with Run_Trace.phase("build network cache"):
+            BDC_Network_Cache.build(iter_reaches(bdc_nets), cache_dir, fingerprint)
+    return BDC_Network_Cache.open_cache(cache_dir)
+
+
+def cache_zone_pieces(network, zone_info, order=None, overlap=False, spatial_reference=None):
+    """Overlay a BDC network cache with every zone, yielding (Zone_no, BDC values, clipped lengths) zone by zone,
+    in order (a list of Zone_no) when one is given. Only reaches near each zone are looked at; with overlap they are
+    gathered once for each group of overlapping zones. Zones are projected on the fly to spatial_reference, which
+    should be that of the network (see iter_reaches)."""
+    with arcpy.da.SearchCursor(zone_info, ["Zone_no", "SHAPE@"], spatial_reference=spatial_reference) as cursor:
+        zones = in_order([(row[0], geometry_rings(row[1])) for row in cursor], order)
+    if overlap:
+        for group in Zone_Overlap.overlap_groups([Zone_Geometry.rings_extent(rings) for _, rings in zones]):
+            with Run_Trace.phase("overlap group", items=len(group)):
+                pieces = list(network.group_reaches([zones[n][1] for n in group]))
+                Run_Trace.count(sum(len(values) for _, values, _ in pieces))
+            for k, values, clipped in pieces:
+                yield zones[group[k]][0], values, clipped
+        return
+    for zone, rings in zones:
+        with Run_Trace.phase("zone", zone=zone):
+            values, clipped = network.zone_reaches(rings)
+            Run_Trace.count(len(values))
+        yield zone, values, clipped
+
+
+def cached_results(zone_info, scratch, fields, compute, cache_path=None, fingerprint=None, spatial_reference=None):
+    """Return the results of every zone, reusing those already held in a result cache file.
+
+    Zones are keyed by a hash of their normalised geometry (in spatial_reference if given, as they are summarised)
+    plus the input fingerprint; only the zones missing from the cache are copied out and passed to compute(zones),
+    and their results are then added to the cache."""
+    if not cache_path:
+        return compute(zone_info)
+
+    keys = {}
+    with Run_Trace.phase("result cache lookup"):
+        with arcpy.da.SearchCursor(zone_info, ["Zone_no", "SHAPE@"], spatial_reference=spatial_reference) as cursor:
+            for row in cursor:
+                keys[row[0]] = Zone_Result_Cache.geometry_key(geometry_rings(row[1]))
+        zone_nos = sorted(keys)
+
+        cache = Zone_Result_Cache.ResultCache(cache_path, fingerprint, fields)
+        found = cache.lookup([keys[z] for z in zone_nos])
+        Run_Trace.count(len(found))
+    todo = [z for z in zone_nos if keys[z] not in found]
+
+    dtype = [("Zone_no", np.int64)] + [(f, np.float64) for f in fields]
+    parts = [np.array([tuple([z] + found[keys[z]]) for z in zone_nos if keys[z] in found], dtype=dtype)]
+
+    if todo:
+        todo_fc = zone_info
+        if len(todo) < len(zone_nos):
+            todo_fc = os.path.join(scratch, "zone_todo")
+            todo_fl = arcpy.MakeFeatureLayer_management(zone_info, "zoneTodoFL", "Zone_no IN ({0})".format(
+                ", ".join(str(z) for z in todo)))
+            arcpy.CopyFeatures_management(todo_fl, todo_fc)
+            arcpy.Delete_management(todo_fl)
+        computed = compute(todo_fc)
+        cache.store([keys[z] for z in computed["Zone_no"]], computed)
+        parts.append(computed)
+
+    arcpy.AddMessage(cache.summary())
+    cache.close()
+    return np.sort(np.concatenate(parts), order="Zone_no")
+
+
+def write_zone_fields(zone_info, results):
+    """Write a structured results array (Zone_no plus one column per output field) onto the zones in one
+    UpdateCursor pass."""
+    fields = [f for f in results.dtype.names if f != "Zone_no"]
+    lookup = dict((int(r["Zone_no"]), r) for r in results)
+
+    with Run_Trace.phase("write zone fields", items=len(results)):
+        with arcpy.da.UpdateCursor(zone_info, ["Zone_no"] + fields) as cursor:
+            for row in cursor:
+                res = lookup.get(row[0])
+                if res is None:
+                    continue
+                cursor.updateRow([row[0]] + [float(res[f]) for f in fields])
+
+
+def write_outputs(zone_info, zones_out, table_out, results, scratch):
+    """The last steps of every tool: write the results onto the zones, export the statistics table (if asked for),
+    copy the zones to zones_out and delete the scratch gdb."""
+    arcpy.AddMessage("writing statistics to features")
+    write_zone_fields(zone_info, results)
+
+    if table_out:
+        arcpy.AddMessage("exporting statistics table")
+        with Run_Trace.phase("export statistics table", items=len(results)):
+            Zone_Table_Export.write_table(results, table_out)
+
+    arcpy.AddMessage("copying final features")
+    with Run_Trace.phase("copy output features"):
+        arcpy.CopyFeatures_management(zone_info, zones_out)
+
+    remove_scratch(scratch)
+
+
+def remove_scratch(scratch):
+    """Delete the scratch gdb, its temporary folder and the in_memory workspace."""
+    if arcpy.Exists(scratch):
+        try:
+            arcpy.Delete_management(scratch)
+        except Exception:
+            print("An issue occured when deleting the scratch folder - not a big deal")
+    shutil.rmtree(os.path.dirname(scratch), ignore_errors=True)
+
+    arcpy.Delete_management(r"in_memory")
@@ -0,0 +1,132 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Beaver ToolBox Batch Runner.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It runs many BHI and BDC jobs in one long-lived
+#                  process, so arcpy (or GDAL), the BHI tile indexes, open rasters, pyramids, packed stores, network
+#                  caches and tile cache blocks are loaded once and stay warm from job to job. Jobs come from a JSON
+#                  manifest, or from job files dropped into a folder that is watched. Each job is timed and its
+#                  status reported; a failing job is recorded and the batch moves on. Run from the command line:
+#                      python Beaver_Batch.py <manifest.json> [report.json]
+#                      python Beaver_Batch.py --watch <job folder> [poll seconds] [--once]
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import importlib
+import traceback
+
+import BHI_Tile_Cache
+
+# job "tool" names and the tool scripts whose main() runs them
+TOOLS = {"bhi": "BHI_Interp_Script",
+         "bhi_stal": "BHI_StAl_Script",
+         "bdc": "BDC_Interp_Script",
+         "riparian": "BDC_Riparian_Script",
+         "rollup": "Beaver_Rollup"}
+
+DEFAULT_POLL = 5.0
+DONE_FOLDER = "done"
+FAILED_FOLDER = "failed"
+REPORT_SUFFIX = ".report.json"
+
+
+def tool_main(tool):
+    """Return the main() of a job tool, importing its script the first time it is needed."""
+    if tool not in TOOLS:
+        raise ValueError("unknown tool {0!r} - expected one of {1}".format(tool, ", ".join(sorted(TOOLS))))
+    return importlib.import_module(TOOLS[tool]).main
+
+
+def read_jobs(path):
+    """Read the jobs of a manifest: a list of jobs, or an object with a "jobs" list. Each job is an object with a
+    "tool" (see TOOLS), the "args" of the tool's main() by keyword and optionally a "name"."""
+    with open(path) as f:
+        manifest = json.load(f)
+    jobs = manifest["jobs"] if isinstance(manifest, dict) else manifest
+    for n, job in enumerate(jobs):
+        job.setdefault("name", "{0}:{1}".format(os.path.basename(path), n + 1))
+    return jobs
+
+
+def run_job(job, message=print):
+    """Run one job and return its report - name, tool, status ("ok" or "failed"), seconds and the error if any."""
+    report = {"name": job.get("name"), "tool": job.get("tool"), "status": "ok", "seconds": 0.0, "error": None}
+    message("job {0} ({1}) started".format(report["name"], report["tool"]))
+    start = time.time()
+    try:
+        tool_main(job["tool"])(**job.get("args", {}))
+    except Exception as e:
+        report["status"] = "failed"
+        report["error"] = "{0}: {1}".format(type(e).__name__, e)
+        message(traceback.format_exc())
+    report["seconds"] = round(time.time() - start, 3)
+    message("job {0} {1} in {2:.1f} s".format(report["name"], report["status"], report["seconds"]))
+    return report
+
+
+def write_report(reports, path):
+    with open(path, "w") as f:
+        json.dump(reports, f, indent=1)
+
+
+def summary(reports):
+    """Return a one line report of a batch."""
+    failed = sum(1 for r in reports if r["status"] != "ok")
+    return "{0} jobs ({1} failed) in {2:.1f} s".format(len(reports), failed, sum(r["seconds"] for r in reports))
+
+
+def run_manifest(path, report_out=None, message=print):
+    """Run every job of a manifest in turn and return their reports."""
+    BHI_Tile_Cache.keep_warm()
+    reports = [run_job(job, message) for job in read_jobs(path)]
+    if report_out:
+        write_report(reports, report_out)
+    message(summary(reports))
+    return reports
+
+
+def watch(folder, poll=DEFAULT_POLL, once=False, message=print):
+    """Run the job files (*.json manifests) dropped into folder, oldest first. Each is moved to folder/done or
+    folder/failed with a report of its jobs alongside. With once, stop when no job files are left."""
+    BHI_Tile_Cache.keep_warm()
+    for sub in (DONE_FOLDER, FAILED_FOLDER):
+        if not os.path.isdir(os.path.join(folder, sub)):
+            os.makedirs(os.path.join(folder, sub))
+
+    message("watching {0} for job files".format(folder))
+    while True:
+        pending = sorted((p for p in (os.path.join(folder, f) for f in os.listdir(folder))
+                          if os.path.isfile(p) and p.endswith(".json")), key=os.path.getmtime)
+        for path in pending:
+            try:
+                reports = [run_job(job, message) for job in read_jobs(path)]
+            except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+                # an unreadable job file - record it and leave the batch running
+                reports = [{"name": os.path.basename(path), "tool": None, "status": "failed", "seconds": 0.0,
+                            "error": "{0}: {1}".format(type(e).__name__, e)}]
+            sub = DONE_FOLDER if all(r["status"] == "ok" for r in reports) else FAILED_FOLDER
+            target = os.path.join(folder, sub, os.path.basename(path))
+            if os.path.exists(target):
+                os.remove(target)
+            shutil.move(path, target)
+            write_report(reports, os.path.splitext(target)[0] + REPORT_SUFFIX)
+            message("{0}: {1}".format(os.path.basename(path), summary(reports)))
+        if once and not pending:
+            return
+        if not pending:
+            time.sleep(poll)
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == "--watch":
+        args = [a for a in sys.argv[2:] if a != "--once"]
+        watch(args[0], float(args[1]) if len(args) > 1 else DEFAULT_POLL, once="--once" in sys.argv)
+    else:
+        run_manifest(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
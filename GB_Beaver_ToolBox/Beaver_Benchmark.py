@@ -0,0 +1,488 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Beaver ToolBox Benchmark.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It generates synthetic inputs of a chosen size - BHI
+#                  tiles (classes 0-5 with NoData patches) laid out on an OSGB-style grid, BDC reaches (0-30 dams/km)
+#                  and zone polygons from tens of metres to tens of km across - writes them to disk and runs the BHI
+#                  and BDC tools on them through the NumPy backend (Beaver_NumPy_Utils.run_bhi and run_bdc), with a
+#                  Run_Trace recording the time, items and bytes of every phase: rasterising zones, scheduling,
+#                  result cache lookups, reading rasters, writing outputs and so on. Each tool run is repeated for
+#                  the variants worth comparing - GeoTIFF tiles and a packed tile store, the pyramid, prefetching,
+#                  overlapping zones, the quick look overviews and a second run served from the result cache.
+#                  BHI tiles are written as GeoTIFFs only where GDAL or rasterio is installed; otherwise the BHI runs
+#                  read the packed store alone. Phases are timed inclusively, as in Run_Trace, so nested phases
+#                  (e.g. "read raster window" within "zone") also count towards their parent. The time taken to
+#                  open the toolbox and to import each tool script is measured in fresh interpreters (the toolbox
+#                  only where arcpy is installed). Results are saved as JSON to compare between versions:
+#                      python Beaver_Benchmark.py --preset medium --out bench_new.json --compare bench_old.json
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+
+import numpy as np
+
+import Beaver_NumPy_Utils
+import BHI_Overview
+import BHI_Pyramid
+import BHI_Stats_Core
+import BHI_Tile_Index
+import BHI_Tile_Store
+import Run_Trace
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+try:
+    import rasterio
+    import rasterio.transform
+except ImportError:
+    rasterio = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# grid origin of the synthetic tiles (an OSGB 100 km square corner)
+ORIGIN = (300000.0, 100000.0)
+NODATA = 99
+# zones whose tile windows are read ahead in the prefetch runs
+PREFETCH_ZONES = 4
+
+PRESETS = {
+    "small": {"zones": 10, "tiles": 2, "tile_px": 1000, "cell": 5.0, "reaches": 500,
+              "zone_min": 50.0, "zone_max": 2000.0},
+    "medium": {"zones": 1000, "tiles": 3, "tile_px": 2000, "cell": 5.0, "reaches": 20000,
+               "zone_min": 50.0, "zone_max": 10000.0},
+    "large": {"zones": 100000, "tiles": 4, "tile_px": 4000, "cell": 5.0, "reaches": 200000,
+              "zone_min": 20.0, "zone_max": 30000.0},
+}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOOL_SCRIPTS = ("BHI_Interp_Script", "BHI_StAl_Script", "BDC_Interp_Script")
+IMPORT_REPEATS = 3
+
+# run in a fresh interpreter: print the seconds taken by the statements, or -1 if a module they need is missing
+_IMPORT_TIMER = """
+import sys, time
+sys.path.insert(0, {here!r})
+try:
+    start = time.time()
+    {statements}
+    print(time.time() - start)
+except ImportError:
+    print(-1)
+"""
+
+# open the toolbox as ArcGIS does: load the .pyt and build every tool's parameters
+_OPEN_TOOLBOX = ("import runpy; box = runpy.run_path({0!r})['Toolbox'](); "
+                 "[tool().getParameterInfo() for tool in box.tools]").format(
+    os.path.join(HERE, "BeaverMod_ToolBox.pyt"))
+
+
+def _quiet(message):
+    pass
+
+
+########################################################################################################################
+# synthetic inputs
+########################################################################################################################
+
+def make_tiles(rng, tiles, tile_px, cell):
+    """Return a tiles x tiles grid of synthetic BHI tiles and a dict of their pixel arrays. Classes vary smoothly
+    over a few hundred metres, with scattered NoData patches."""
+    arrays = {}
+    out = []
+    size = tile_px * cell
+    coarse = max(tile_px // 40, 1)
+    for i in range(tiles):
+        for j in range(tiles):
+            base = rng.randint(0, BHI_Stats_Core.N_CLASSES, (coarse, coarse))
+            grid = np.kron(base, np.ones((-(-tile_px // coarse),) * 2, dtype=np.int64))[:tile_px, :tile_px]
+            noise = rng.randint(-1, 2, grid.shape)
+            grid = np.clip(grid + noise * (rng.random_sample(grid.shape) < 0.2), 0, BHI_Stats_Core.N_CLASSES - 1)
+            holes = rng.random_sample((coarse, coarse)) < 0.05
+            grid[np.kron(holes, np.ones((-(-tile_px // coarse),) * 2, dtype=bool))[:tile_px, :tile_px]] = NODATA
+
+            xmin, ymin = ORIGIN[0] + j * size, ORIGIN[1] + i * size
+            name = "E{0:.0f}N{1:.0f}".format(xmin, ymin)
+            arrays[name] = grid.astype(np.uint8)
+            out.append(BHI_Tile_Index.Tile(name, name, xmin, ymin, xmin + size, ymin + size, cell, NODATA))
+    return BHI_Tile_Index.TileIndex(out), arrays
+
+
+def make_reader(arrays):
+    """Tile reader over in-memory tile arrays."""
+    def reader(tile, row, col, nrows, ncols):
+        return arrays[tile.name][row:row + nrows, col:col + ncols]
+    return reader
+
+
+def make_zones(rng, n, extent, size_min, size_max):
+    """Return n irregular polygons (as ring lists) whose widths are log-uniform between size_min and size_max."""
+    xmin, ymin, xmax, ymax = extent
+    widths = np.exp(rng.uniform(np.log(size_min), np.log(size_max), n))
+    zones = []
+    for w in widths:
+        cx, cy = rng.uniform(xmin + w / 2, max(xmax - w / 2, xmin + w / 2)), \
+            rng.uniform(ymin + w / 2, max(ymax - w / 2, ymin + w / 2))
+        k = rng.randint(8, 33)
+        angle = np.sort(rng.uniform(0, 2 * np.pi, k))
+        radius = w / 2 * rng.uniform(0.6, 1.0, k)
+        # clockwise outer ring, as in a shapefile
+        ring = np.column_stack([cx + radius * np.cos(-angle), cy + radius * np.sin(-angle)])
+        zones.append([np.vstack([ring, ring[:1]])])
+    return zones, widths
+
+
+def make_reaches(rng, n, extent):
+    """Yield n synthetic BDC reaches (BDC, length, parts): short random walks with mostly low dam capacities."""
+    xmin, ymin, xmax, ymax = extent
+    for _ in range(n):
+        k = rng.randint(5, 21)
+        steps = rng.normal(0, 60.0, (k - 1, 2)) + rng.normal(0, 40.0, 2)
+        start = rng.uniform([xmin, ymin], [xmax, ymax])
+        pts = np.vstack([start, start + np.cumsum(steps, axis=0)])
+        bdc = float(np.clip(rng.exponential(4.0), 0, 30)) if rng.random_sample() > 0.2 else 0.0
+        yield bdc, float(np.hypot(*np.diff(pts, axis=0).T).sum()), [pts]
+
+
+def write_shapefile(shp_path, shape_type, shapes, fields, rows):
+    """Write a shapefile (.shp, .shx and .dbf) of polygons or polylines, each a list of parts, with numeric
+    attribute fields given as (name, width, decimals) and one row of values per shape."""
+    records = []
+    index = []
+    offset = 50
+    for n, parts in enumerate(shapes):
+        pts = np.vstack(parts)
+        starts = np.cumsum([0] + [len(p) for p in parts[:-1]])
+        body = struct.pack("<i4d2i", shape_type, pts[:, 0].min(), pts[:, 1].min(), pts[:, 0].max(),
+                           pts[:, 1].max(), len(parts), len(pts))
+        body += np.asarray(starts, dtype="<i4").tobytes() + pts.astype("<f8").tobytes()
+        records.append(struct.pack(">2i", n + 1, len(body) // 2) + body)
+        index.append(struct.pack(">2i", offset, len(body) // 2))
+        offset += 4 + len(body) // 2
+
+    pts = np.vstack([np.vstack(parts) for parts in shapes])
+    bbox = (pts[:, 0].min(), pts[:, 1].min(), pts[:, 0].max(), pts[:, 1].max())
+
+    def header(words):
+        return struct.pack(">7i", 9994, 0, 0, 0, 0, 0, words) + struct.pack("<2i8d", 1000, shape_type,
+                                                                            *(bbox + (0.0,) * 4))
+
+    base = os.path.splitext(shp_path)[0]
+    with open(base + ".shp", "wb") as f:
+        f.write(header(offset) + b"".join(records))
+    with open(base + ".shx", "wb") as f:
+        f.write(header(50 + 4 * len(index)) + b"".join(index))
+
+    today = datetime.date.today()
+    with open(base + ".dbf", "wb") as f:
+        f.write(struct.pack("<B3BIHH20x", 3, today.year - 1900, today.month, today.day, len(rows),
+                            32 * len(fields) + 33, 1 + sum(width for _, width, _ in fields)))
+        f.write(b"".join(struct.pack("<11sc4xBB14x", name.encode("latin-1"), b"N", width, dec)
+                         for name, width, dec in fields) + b"\r")
+        for row in rows:
+            f.write(b" " + b"".join("{0:.{1}f}".format(value, dec).rjust(width).encode("latin-1")
+                                    for value, (_, width, dec) in zip(row, fields)))
+        f.write(b"\x1a")
+    return shp_path
+
+
+def write_zones(zones, shp_path):
+    return write_shapefile(shp_path, 5, zones, [("ZONE_ID", 9, 0)], [[n + 1] for n in range(len(zones))])
+
+
+def write_geotiffs(index, arrays, folder):
+    """Write every tile as a GeoTIFF in folder with GDAL or rasterio; returns the folder."""
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for tile in index.tiles:
+        path = os.path.join(folder, tile.name + ".tif")
+        arr = arrays[tile.name]
+        if gdal is not None:
+            ds = gdal.GetDriverByName("GTiff").Create(path, arr.shape[1], arr.shape[0], 1, gdal.GDT_Byte,
+                                                      ["TILED=YES", "COMPRESS=LZW"])
+            ds.SetGeoTransform((tile.xmin, tile.cell, 0.0, tile.ymax, 0.0, -tile.cell))
+            band = ds.GetRasterBand(1)
+            band.SetNoDataValue(NODATA)
+            band.WriteArray(arr)
+            ds = None
+        else:
+            with rasterio.open(path, "w", driver="GTiff", height=arr.shape[0], width=arr.shape[1], count=1,
+                               dtype="uint8", nodata=NODATA, tiled=True, compress="lzw",
+                               transform=rasterio.transform.from_origin(tile.xmin, tile.ymax, tile.cell,
+                                                                        tile.cell)) as dst:
+                dst.write(arr, 1)
+    return folder
+
+
+########################################################################################################################
+# timing
+########################################################################################################################
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+class Bench(object):
+    def __init__(self, trace_memory=False):
+        """Collect the timings of named phases."""
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self.phases = []
+
+    def record(self, name, seconds, items=None, unit=None, peak=None, **extra):
+        """Record (and print) the timing of a phase."""
+        phase = {"name": name, "seconds": round(seconds, 4), "items": items, "unit": unit,
+                 "rate": round(items / seconds, 1) if items and seconds > 0 else None,
+                 "peak_mb": round(peak, 1) if peak is not None else None, "rss_mb": _peak_rss_mb()}
+        phase.update(extra)
+        self.phases.append(phase)
+        print("{0:<44} {1:>9.3f} s {2}".format(name, seconds, "{0:,.0f} {1}/s".format(phase["rate"], unit or "items")
+                                                if phase["rate"] else ""))
+        return phase
+
+    def run(self, name, func, items=None, unit=None):
+        """Time func(), recording its item count (a number, or a function of the result) and throughput."""
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.time()
+        result = func()
+        seconds = time.time() - start
+        peak = None
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0
+            tracemalloc.stop()
+        self.record(name, seconds, items(result) if callable(items) else items, unit, peak)
+        return result
+
+    def run_traced(self, name, func, items=None, unit=None):
+        """Time func() as run() does, under a Run_Trace, then record every phase of the trace - totalled by phase
+        name - as "name / phase", slowest first."""
+        traced = []
+
+        def call():
+            result, records = Run_Trace.traced_call((lambda task: func(), None))
+            traced.extend(records)
+            return result
+
+        result = self.run(name, call, items, unit)
+        totals = {}
+        for r in traced:
+            t = totals.setdefault(r["phase"], [0, 0.0, 0, 0])
+            t[0] += 1
+            t[1] += r["seconds"]
+            t[2] += r["items"]
+            t[3] += r["bytes_read"] + r["bytes_written"]
+        for phase, (calls, seconds, count, nbytes) in sorted(totals.items(), key=lambda kv: -kv[1][1]):
+            self.record("{0} / {1}".format(name, phase), seconds, count or None, calls=calls,
+                        mb=round(nbytes / 1024.0 / 1024.0, 1))
+        return result
+
+
+def _check_same(name, results, expected):
+    if not (len(results) == len(expected) and all(np.allclose(results[f], expected[f])
+                                                   for f in expected.dtype.names)):
+        raise AssertionError("{0} statistics differ from the first run".format(name))
+
+
+########################################################################################################################
+# pipelines
+########################################################################################################################
+
+def bench_bhi(bench, rng, params, folder, workers=1):
+    pixels = params["tiles"] ** 2 * params["tile_px"] ** 2
+    index, arrays = bench.run("bhi: generate tiles", lambda: make_tiles(rng, params["tiles"], params["tile_px"],
+                                                                        params["cell"]), pixels, "pixels")
+    size = params["tiles"] * params["tile_px"] * params["cell"]
+    extent = (ORIGIN[0], ORIGIN[1], ORIGIN[0] + size, ORIGIN[1] + size)
+    zones = bench.run("bhi: generate zones", lambda: make_zones(rng, params["zones"], extent, params["zone_min"],
+                                                                params["zone_max"])[0], params["zones"], "zones")
+    s_zone = bench.run("bhi: write zones", lambda: write_zones(zones, os.path.join(folder, "bhi_zones.shp")),
+                       len(zones), "zones")
+
+    rasters = None
+    if gdal is None and rasterio is None:
+        print("{0:<44} {1:>11}".format("bhi: write GeoTIFF tiles", "(skipped - needs GDAL or rasterio)"))
+    else:
+        rasters = [bench.run("bhi: write GeoTIFF tiles",
+                             lambda: write_geotiffs(index, arrays, os.path.join(folder, "tiles")), pixels, "pixels")]
+    store = os.path.join(folder, "store")
+    bench.run("bhi: pack tile store", lambda: BHI_Tile_Store.convert(index, make_reader(arrays), store,
+                                                                     message=_quiet), pixels, "pixels")
+    # every other run reads the GeoTIFFs if there are any
+    source = rasters or [store]
+    arrays = None
+
+    def run(name, **kwargs):
+        kwargs.setdefault("bhi_rasters", source)
+        return bench.run_traced(name, lambda: Beaver_NumPy_Utils.run_bhi(s_zone=s_zone, workers=workers,
+                                                                          message=_quiet, **kwargs),
+                                len(zones), "zones")
+
+    result_cache = os.path.join(folder, "bhi_results.sqlite")
+    first = run("bhi: run", zones_out=os.path.join(folder, "bhi_out.shp"), result_cache=result_cache,
+                table_out=os.path.join(folder, "bhi_out.csv"))
+    _check_same("result cache", run("bhi: run, result cache", zones_out=None, result_cache=result_cache), first)
+    if rasters:
+        _check_same("packed store", run("bhi: run, packed store", bhi_rasters=[store], zones_out=None), first)
+    _check_same("prefetch", run("bhi: run, prefetch", zones_out=None, prefetch=PREFETCH_ZONES), first)
+    _check_same("overlap", run("bhi: run, overlap", zones_out=None, overlap=True), first)
+
+    disk = Beaver_NumPy_Utils.tile_index(source)
+    pyramid = os.path.join(folder, "pyramid")
+    bench.run("bhi: build pyramid", lambda: BHI_Pyramid.build(disk, Beaver_NumPy_Utils.read_tile, pyramid,
+                                                              message=_quiet), pixels, "pixels")
+    _check_same("pyramid", run("bhi: run, pyramid", zones_out=None, pyramid_dir=pyramid), first)
+
+    overviews = os.path.join(folder, "overviews")
+    bench.run("bhi: build overviews", lambda: BHI_Overview.build(disk, Beaver_NumPy_Utils.read_tile, overviews,
+                                                                 message=_quiet), pixels, "pixels")
+    run("bhi: quick look", zones_out=None, overview_dir=overviews)
+
+
+def bench_bdc(bench, rng, params, folder, workers=1):
+    size = params["tiles"] * params["tile_px"] * params["cell"]
+    extent = (ORIGIN[0], ORIGIN[1], ORIGIN[0] + size, ORIGIN[1] + size)
+    reaches = bench.run("bdc: generate reaches", lambda: list(make_reaches(rng, params["reaches"], extent)),
+                        params["reaches"], "reaches")
+    zones = make_zones(rng, params["zones"], extent, params["zone_min"], params["zone_max"])[0]
+    network = bench.run("bdc: write network",
+                        lambda: write_shapefile(os.path.join(folder, "bdc_network.shp"), 3,
+                                                [parts for _, _, parts in reaches], [("BDC", 10, 3)],
+                                                [[bdc] for bdc, _, _ in reaches]), len(reaches), "reaches")
+    s_zone = write_zones(zones, os.path.join(folder, "bdc_zones.shp"))
+
+    def run(name, **kwargs):
+        return bench.run_traced(name, lambda: Beaver_NumPy_Utils.run_bdc([network], s_zone, workers=workers,
+                                                                          message=_quiet, **kwargs),
+                                len(zones), "zones")
+
+    # the first run builds the network cache, the others reuse it
+    cache_dir = os.path.join(folder, "network")
+    result_cache = os.path.join(folder, "bdc_results.sqlite")
+    first = run("bdc: run", zones_out=os.path.join(folder, "bdc_out.shp"), cache_dir=cache_dir,
+                result_cache=result_cache, table_out=os.path.join(folder, "bdc_out.csv"))
+    _check_same("result cache", run("bdc: run, result cache", zones_out=None, cache_dir=cache_dir,
+                                    result_cache=result_cache), first)
+    _check_same("overlap", run("bdc: run, overlap", zones_out=None, cache_dir=cache_dir, overlap=True), first)
+
+
+def _import_seconds(statements):
+    code = _IMPORT_TIMER.format(here=HERE, statements=statements)
+    times = [float(subprocess.check_output([sys.executable, "-c", code], cwd=HERE).decode("utf-8").split()[-1])
+             for _ in range(IMPORT_REPEATS)]
+    return None if min(times) < 0 else sorted(times)[len(times) // 2]
+
+
+def bench_imports(bench):
+    """Record the median time to open the toolbox and to import each tool script, in fresh interpreters."""
+    for name, statements in [("import: open toolbox", _OPEN_TOOLBOX)] + \
+            [("import: " + script, "import " + script) for script in TOOL_SCRIPTS]:
+        seconds = _import_seconds(statements)
+        if seconds is None:
+            print("{0:<44} {1:>11}".format(name, "(skipped - needs arcpy)"))
+            continue
+        bench.record(name, seconds)
+
+
+########################################################################################################################
+# reports
+########################################################################################################################
+
+def _version():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=here,
+                                       stderr=subprocess.STDOUT).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(new, old):
+    """Print the phases of two benchmark results side by side."""
+    old_phases = dict((p["name"], p) for p in old["phases"])
+    print("\n{0:<44} {1:>10} {2:>10} {3:>8}".format("phase", old["version"][:10], new["version"][:10], "speedup"))
+    for phase in new["phases"]:
+        before = old_phases.get(phase["name"])
+        if before is None:
+            continue
+        speedup = before["seconds"] / phase["seconds"] if phase["seconds"] > 0 else float("inf")
+        print("{0:<44} {1:>9.3f}s {2:>9.3f}s {3:>7.2f}x".format(phase["name"], before["seconds"],
+                                                               phase["seconds"], speedup))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Beaver toolbox pipelines on synthetic data.")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="small")
+    for key, value in sorted(PRESETS["small"].items()):
+        parser.add_argument("--" + key.replace("_", "-"), type=type(value), default=None,
+                            help="override the preset value")
+    parser.add_argument("--only", choices=["bhi", "bdc", "imports"], default=None,
+                        help="run one pipeline (or the import timings) only")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for the tool runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true", help="record the peak NumPy memory of each phase")
+    parser.add_argument("--out", default=None, help="save the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="compare with a JSON file saved by an earlier run")
+    args = parser.parse_args(argv)
+
+    params = dict(PRESETS[args.preset])
+    for key in params:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+
+    folder = tempfile.mkdtemp(prefix="beaver_bench_")
+    rng = np.random.RandomState(args.seed)
+    bench = Bench(args.trace_memory)
+    try:
+        if args.only in (None, "bhi"):
+            bench_bhi(bench, rng, params, folder, args.workers)
+        if args.only in (None, "bdc"):
+            bench_bdc(bench, rng, params, folder, args.workers)
+        if args.only in (None, "imports"):
+            bench_imports(bench)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    result = {"version": _version(), "created": datetime.datetime.now().isoformat(),
+              "python": platform.python_version(), "numpy": np.__version__, "machine": platform.platform(),
+              "preset": args.preset, "params": params, "workers": args.workers, "seed": args.seed,
+              "phases": bench.phases, "peak_rss_mb": _peak_rss_mb()}
+    if result["peak_rss_mb"] is not None:
+        print("peak memory: {0:.1f} MB".format(result["peak_rss_mb"]))
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+    return result
+
+
+if __name__ == '__main__':
+    main()
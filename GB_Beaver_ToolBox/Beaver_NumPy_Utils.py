@@ -0,0 +1,694 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Beaver ToolBox NumPy Backend.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It is an arcpy-free backend for the BHI and BDC tools:
+#                  zones and BDC networks are read from shapefiles, BHI rasters from GeoTIFF (or any format GDAL or
+#                  rasterio can open) and zones are rasterised here by cell centre, so the same zonal statistics can be
+#                  run on machines without ArcGIS. Results are written to a copy of the zone shapefile and/or a flat
+#                  statistics table. Zone_no follows the record order of the zone shapefile (1, 2, 3 ...), as the
+#                  OBJECTIDs of the arcpy backend do.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+from __future__ import print_function
+
+import os
+import glob
+import json
+import shutil
+import struct
+import datetime
+import hashlib
+import tempfile
+
+import numpy as np
+
+import BDC_Network_Cache
+import BDC_Stats_Core
+import BHI_Overview
+import BHI_Pyramid
+import BHI_Stats_Core
+import BHI_Tile_Cache
+import BHI_Tile_Index
+import BHI_Tile_Store
+import Riparian_Corridor
+import Run_Trace
+import Zone_Geometry
+import Zone_Overlap
+import Zone_Parallel
+import Zone_Prefetch
+import Zone_Result_Cache
+import Zone_Rollup
+import Zone_Schedule
+import Zone_Table_Export
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+try:
+    import rasterio
+    import rasterio.windows
+except ImportError:
+    rasterio = None
+
+POLYGON_TYPES = (5, 15, 25)
+POLYLINE_TYPES = (3, 13, 23)
+RASTER_EXTENSIONS = (".tif", ".tiff", ".img")
+OS_GRID_SHP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "OsGridShp", "OSGB_Grid_100km.shp")
+
+# raster datasets opened by this process, by path
+_DATASETS = {}
+# tiles of the rasters opened by this process, by path: (modification time, Tile)
+_TILES = {}
+
+
+########################################################################################################################
+# shapefile reading and writing
+########################################################################################################################
+
+def read_shapes(shp_path):
+    """Read the geometry of every record of a polygon or polyline shapefile. Returns the shape type and, per
+    record, a list of parts (n x 2 arrays of x, y) - an empty list for null shapes."""
+    with open(shp_path, "rb") as f:
+        data = f.read()
+
+    shape_type = struct.unpack("<i", data[32:36])[0]
+    if shape_type not in POLYGON_TYPES + POLYLINE_TYPES:
+        raise ValueError("{0} is not a polygon or polyline shapefile".format(shp_path))
+
+    shapes = []
+    pos = 100
+    while pos + 8 <= len(data):
+        length = struct.unpack(">i", data[pos + 4:pos + 8])[0] * 2
+        rec = data[pos + 8:pos + 8 + length]
+        pos += 8 + length
+        if struct.unpack("<i", rec[:4])[0] == 0:
+            shapes.append([])
+            continue
+        n_parts, n_points = struct.unpack("<2i", rec[36:44])
+        starts = list(struct.unpack("<{0}i".format(n_parts), rec[44:44 + 4 * n_parts])) + [n_points]
+        xy = np.frombuffer(rec, dtype="<f8", count=2 * n_points, offset=44 + 4 * n_parts).reshape(-1, 2)
+        shapes.append([xy[starts[k]:starts[k + 1]] for k in range(n_parts)])
+    return shape_type, shapes
+
+
+def _dbf_encoding(shp_path):
+    try:
+        with open(os.path.splitext(shp_path)[0] + ".cpg") as f:
+            return f.read().strip() or "latin-1"
+    except (IOError, OSError):
+        return "latin-1"
+
+
+def read_dbf(shp_path):
+    """Read the attribute table of a shapefile. Returns the field descriptors [(name, type, length, decimals)]
+    and the raw bytes of every record."""
+    with open(os.path.splitext(shp_path)[0] + ".dbf", "rb") as f:
+        data = f.read()
+
+    n_records, header_len, record_len = struct.unpack("<IHH", data[4:12])
+    fields = []
+    pos = 32
+    while pos < header_len - 1 and data[pos:pos + 1] != b"\r":
+        name, ftype, width, dec = struct.unpack("<11sc4xBB14x", data[pos:pos + 32])
+        fields.append((name.split(b"\x00")[0].decode("latin-1"), ftype.decode("latin-1"), width, dec))
+        pos += 32
+    records = [data[header_len + k * record_len:header_len + (k + 1) * record_len] for k in range(n_records)]
+    return fields, records
+
+
+def dbf_text_column(shp_path, field):
+    """Return one attribute of every record as stripped text."""
+    fields, records = read_dbf(shp_path)
+    names = [f[0].upper() for f in fields]
+    if field.upper() not in names:
+        raise ValueError("field {0} not found in {1}".format(field, shp_path))
+    k = names.index(field.upper())
+    start = 1 + sum(f[2] for f in fields[:k])
+    width = fields[k][2]
+    encoding = _dbf_encoding(shp_path)
+    return [rec[start:start + width].decode(encoding).strip() for rec in records]
+
+
+def dbf_column(shp_path, field):
+    """Return one attribute of every record as a float array (NaN where blank or not numeric)."""
+    text = dbf_text_column(shp_path, field)
+    values = np.full(len(text), np.nan)
+    for n, value in enumerate(text):
+        try:
+            values[n] = float(value)
+        except ValueError:
+            pass
+    return values
+
+
+def read_os_grid(shp_path=OS_GRID_SHP):
+    """Return the tile names and (n, 4) bounding boxes of the OS 100 km grid, for Zone_Schedule. The stored
+    corners are a few mm off the whole metre, so boxes are rounded."""
+    names = dbf_text_column(shp_path, "TILE_NAME")
+    boxes = [np.vstack(parts) for parts in read_shapes(shp_path)[1]]
+    return names, np.round([[b[:, 0].min(), b[:, 1].min(), b[:, 0].max(), b[:, 1].max()] for b in boxes])
+
+
+def write_zone_shapefile(s_zone, zones_out, results, id_field="Zone_no"):
+    """Write a copy of the zone shapefile with the Zone_no and result fields added to its attribute table. Fields
+    of the same name already in the zones are replaced; names are cut to the 10 characters dBASE allows. Results
+    are matched to records by id_field (record order from 1), e.g. Reach_no for the reaches of a BDC network."""
+    if not zones_out.lower().endswith(".shp"):
+        raise ValueError("the NumPy backend writes output zones as a shapefile (.shp): {0}".format(zones_out))
+    src, dst = os.path.splitext(s_zone)[0], os.path.splitext(zones_out)[0]
+    for ext in (".shp", ".shx", ".prj", ".cpg"):
+        if os.path.exists(src + ext):
+            shutil.copyfile(src + ext, dst + ext)
+
+    fields, records = read_dbf(s_zone)
+    new_names = [name[:10] for name in results.dtype.names]
+    keep = [k for k, f in enumerate(fields) if f[0].upper() not in [n.upper() for n in new_names]]
+    offsets = np.concatenate([[1], 1 + np.cumsum([f[2] for f in fields])])
+
+    new_fields = [(name, "N", 9 if name == id_field else 19, 0 if name == id_field else 11) for name in new_names]
+    out_fields = [fields[k] for k in keep] + new_fields
+    lookup = dict((int(r[id_field]), r) for r in results)
+
+    today = datetime.date.today()
+    header = struct.pack("<B3BIHH20x", 3, today.year - 1900, today.month, today.day, len(records),
+                         32 * len(out_fields) + 33, 1 + sum(f[2] for f in out_fields))
+    desc = b"".join(struct.pack("<11sc4xBB14x", name.encode("latin-1"), ftype.encode("latin-1"), width, dec)
+                    for name, ftype, width, dec in out_fields)
+
+    with open(dst + ".dbf", "wb") as f:
+        f.write(header + desc + b"\r")
+        for n, rec in enumerate(records):
+            row = [rec[:1]] + [rec[offsets[k]:offsets[k + 1]] for k in keep]
+            res = lookup.get(n + 1)
+            for name, (_, _, width, dec) in zip(results.dtype.names, new_fields):
+                value = (n + 1) if name == id_field else (float(res[name]) if res is not None else 0.0)
+                text = "{0:d}".format(int(value)) if dec == 0 else "{0:.{1}f}".format(value, dec)
+                row.append(text[:width].rjust(width).encode("latin-1"))
+            f.write(b"".join(row))
+        f.write(b"\x1a")
+    return zones_out
+
+
+########################################################################################################################
+# zones
+########################################################################################################################
+
+def _ring_area(ring):
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * float(np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y))
+
+
+def read_zones(s_zone):
+    """Read a polygon zone shapefile. Returns Zone_no (record order from 1), the rings of every zone and the zone
+    areas; outer rings run clockwise and holes anticlockwise, so the signed ring areas add up to the zone area."""
+    shape_type, shapes = read_shapes(s_zone)
+    if shape_type not in POLYGON_TYPES:
+        raise ValueError("{0} is not a polygon shapefile".format(s_zone))
+    zone_ids = np.arange(1, len(shapes) + 1, dtype=np.int64)
+    area = np.array([abs(sum(_ring_area(ring) for ring in rings)) for rings in shapes])
+    return zone_ids, shapes, area
+
+
+########################################################################################################################
+# rasters
+########################################################################################################################
+
+def open_raster(path):
+    """Open a BHI raster with GDAL (or rasterio) and return it as a BHI_Tile_Index.Tile. A raster already open in
+    this process is reused unless it has been modified since."""
+    stamp = os.path.getmtime(path)
+    held = _TILES.get(path)
+    if held is not None and held[0] == stamp and path in _DATASETS:
+        return held[1]
+
+    if gdal is not None:
+        ds = gdal.Open(path)
+        if ds is None:
+            raise IOError("could not open raster {0}".format(path))
+        x0, dx, rx, y1, ry, dy = ds.GetGeoTransform()
+        nrows, ncols, nodata = ds.RasterYSize, ds.RasterXSize, ds.GetRasterBand(1).GetNoDataValue()
+    elif rasterio is not None:
+        ds = rasterio.open(path)
+        t = ds.transform
+        x0, dx, rx, y1, ry, dy = t.c, t.a, t.b, t.f, t.d, t.e
+        nrows, ncols, nodata = ds.height, ds.width, ds.nodata
+    else:
+        raise ImportError("the NumPy backend needs GDAL (osgeo) or rasterio to read BHI rasters")
+
+    if rx != 0 or ry != 0 or abs(dx) != abs(dy):
+        raise ValueError("{0} must be north up with square cells".format(path))
+    _DATASETS[path] = ds
+    tile = BHI_Tile_Index.Tile(os.path.basename(path), path, x0, y1 + nrows * dy, x0 + ncols * dx, y1, dx, nodata)
+    _TILES[path] = (stamp, tile)
+    return tile
+
+
+def read_tile(tile, row, col, nrows, ncols):
+    """Tile reader for BHI_Tile_Index: read a block of a tile given in pixel offsets from its top left corner."""
+    if BHI_Tile_Store.is_store_tile(tile):
+        return BHI_Tile_Store.read_tile(tile, row, col, nrows, ncols)
+    ds = _DATASETS.get(tile.path)
+    if ds is None:
+        open_raster(tile.path)
+        ds = _DATASETS[tile.path]
+    with Run_Trace.phase("read raster window"):
+        if gdal is not None:
+            arr = ds.GetRasterBand(1).ReadAsArray(col, row, ncols, nrows)
+        else:
+            arr = ds.read(1, window=rasterio.windows.Window(col, row, ncols, nrows))
+        Run_Trace.count(arr.size, bytes_read=arr.nbytes)
+    return arr
+
+
+def tile_index(bhi_rasters):
+    """Build a tile index from a list of BHI rasters, folders of BHI rasters and/or BHI_Tile_Store packed stores."""
+    tiles = []
+    for path in bhi_rasters:
+        if BHI_Tile_Store.is_store(path):
+            tiles.extend(BHI_Tile_Store.open_store(path).tiles)
+        elif path.endswith(BHI_Tile_Store.DIRECTORY_SUFFIX):
+            tiles.append(BHI_Tile_Store.store_tile(path))
+        elif os.path.isdir(path):
+            tiles.extend(open_raster(p) for p in sorted(glob.glob(os.path.join(path, "*")))
+                         if os.path.splitext(p)[1].lower() in RASTER_EXTENSIONS)
+        else:
+            tiles.append(open_raster(path))
+    return BHI_Tile_Index.TileIndex(tiles)
+
+
+########################################################################################################################
+# BDC networks
+########################################################################################################################
+
+def iter_reaches(bdc_nets, field="BDC"):
+    """Yield (BDC, length, parts) for every reach of one or more BDC network shapefiles. Records without geometry
+    or a BDC value are yielded without parts, so positions follow the records of the networks in turn."""
+    for shp in bdc_nets:
+        shape_type, shapes = read_shapes(shp)
+        if shape_type not in POLYLINE_TYPES:
+            raise ValueError("{0} is not a polyline shapefile".format(shp))
+        for value, parts in zip(dbf_column(shp, field), shapes):
+            if not parts or np.isnan(value):
+                yield value, 0.0, []
+                continue
+            length = sum(float(np.hypot(*np.diff(part, axis=0).T).sum()) for part in parts)
+            yield value, length, parts
+
+
+def source_fingerprint(paths):
+    """Fingerprint input files (and every file sharing their name, e.g. .shp/.dbf/.shx, or inside a folder) by
+    path, size and modification time."""
+    parts = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, "*")))
+        else:
+            files = sorted(glob.glob(os.path.splitext(path)[0] + ".*")) or [path]
+        parts.append([path, [[os.path.basename(f), os.path.getsize(f), int(os.path.getmtime(f))]
+                             for f in files if os.path.isfile(f)]])
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+########################################################################################################################
+# workers - one Zone_no range each, so they can run on a Zone_Parallel pool
+########################################################################################################################
+
+def bhi_zone_worker(task):
+    """Summarise the BHI of a range of zones, each rasterised from its own rings. Returns the BHI fields and the
+    tile cache report."""
+    index = tile_index(task["bhi_rasters"])
+    if task["overview_dir"]:
+        # quick look - no BHI pixels are read, only the class count overviews.
+        overviews = BHI_Overview.open_overviews(task["overview_dir"])
+        with Run_Trace.phase("quick look zones", items=len(task["zone_ids"])):
+            return BHI_Overview.zones_quick_look(overviews, index, task["zone_ids"], task["rings"],
+                                                 task["area"]), "(quick look from overviews)"
+    acc, summary = _bhi_accumulate(task, index)
+    return acc.fields(task["area"], task["fieldset"]), summary
+
+
+def bhi_histogram_worker(task):
+    """Summarise the BHI of a range of zones as in bhi_zone_worker, returning the class histograms of the zones
+    (in Zone_no order) rather than their fields, e.g. for Zone_Rollup."""
+    acc, summary = _bhi_accumulate(task, tile_index(task["bhi_rasters"]))
+    return acc.hist, summary
+
+
+def _bhi_accumulate(task, index):
+    cache = BHI_Tile_Cache.open_cache(read_tile, budget_mb=task["cache_mb"])
+    pyramid = BHI_Pyramid.open_pyramid(task["pyramid_dir"]) if task["pyramid_dir"] else None
+    acc = BHI_Stats_Core.BHIAccumulator(task["zone_ids"])
+
+    if task["overlap"]:
+        # overlapping zones are summarised together, reading the pixels under each group once.
+        extents = [Zone_Geometry.rings_extent(r) for r in task["rings"]]
+        for group in Zone_Overlap.ordered_groups(task["order"], extents):
+            if len(group) == 1:
+                with Run_Trace.phase("zone", zone=task["zone_ids"][group[0]]):
+                    acc.hist[group[0]] += BHI_Pyramid.zone_counts(pyramid, index, cache, task["rings"][group[0]])
+                continue
+            with Run_Trace.phase("overlap group", items=len(group)):
+                acc.hist[group] += Zone_Overlap.group_counts(index, cache, [task["rings"][pos] for pos in group])
+        return acc, cache.summary()
+
+    # the pyramid reads only scattered boundary blocks - only whole zone windows are worth reading ahead.
+    prefetch = None
+    if task["prefetch"] and pyramid is None:
+        prefetch = Zone_Prefetch.Prefetcher(index, cache, task["prefetch"], task["prefetch_mb"])
+    extents = [(pos, Zone_Geometry.rings_extent(task["rings"][pos])) for pos in task["order"]]
+
+    for pos, reader in Zone_Prefetch.zone_readers(extents, cache, prefetch):
+        with Run_Trace.phase("zone", zone=task["zone_ids"][pos]):
+            acc.hist[pos] += BHI_Pyramid.zone_counts(pyramid, index, reader, task["rings"][pos])
+    summary = cache.summary() if prefetch is None else "{0}; {1}".format(cache.summary(), prefetch.summary())
+    return acc, summary
+
+
+def bdc_zone_worker(task):
+    """Clip the cached BDC network to a range of zones and return their BDC fields."""
+    network = BDC_Network_Cache.open_cache(task["cache_dir"])
+
+    def zone_pieces():
+        for pos in task["order"]:
+            zone = task["zone_ids"][pos]
+            with Run_Trace.phase("zone", zone=zone):
+                values, clipped = network.zone_reaches(task["rings"][pos])
+                Run_Trace.count(len(values))
+            yield zone, values, clipped
+
+    def group_pieces():
+        # overlapping zones share one gathering of the reaches under them
+        extents = [Zone_Geometry.rings_extent(r) for r in task["rings"]]
+        for group in Zone_Overlap.ordered_groups(task["order"], extents):
+            with Run_Trace.phase("overlap group", items=len(group)):
+                pieces = list(network.group_reaches([task["rings"][pos] for pos in group]))
+                Run_Trace.count(sum(len(values) for _, values, _ in pieces))
+            for k, values, clipped in pieces:
+                yield task["zone_ids"][group[k]], values, clipped
+
+    acc = BDC_Stats_Core.BDCAccumulator(task["zone_ids"], task["fieldset"])
+    pieces = group_pieces() if task["overlap"] else zone_pieces()
+    return BDC_Stats_Core.accumulate_zone_pieces(acc, pieces).fields()
+
+
+def bdc_piece_worker(task):
+    """Clip the cached BDC network to a range of zones as in bdc_zone_worker, returning the clipped pieces - the
+    Zone_no, reach id, BDC value and clipped length of every reach in every zone - rather than their fields."""
+    network = BDC_Network_Cache.open_cache(task["cache_dir"])
+    zones, reach, bdc, length = [np.zeros(0, np.int64)], [np.zeros(0, np.int64)], [np.zeros(0)], [np.zeros(0)]
+    for pos in task["order"]:
+        zone = task["zone_ids"][pos]
+        with Run_Trace.phase("zone", zone=zone):
+            ids, values, clipped = network.zone_reach_pieces(task["rings"][pos])
+            Run_Trace.count(len(ids))
+        zones.append(np.full(len(ids), zone, dtype=np.int64))
+        reach.append(np.asarray(ids, dtype=np.int64))
+        bdc.append(np.asarray(values, dtype=np.float64))
+        length.append(np.asarray(clipped, dtype=np.float64))
+    return np.concatenate(zones), np.concatenate(reach), np.concatenate(bdc), np.concatenate(length)
+
+
+def riparian_worker(task):
+    """Count the BHI classes by nearest reach and distance band over a run of BHI blocks (Riparian_Corridor).
+    Returns the reach ids of the network cache and their counts."""
+    network = BDC_Network_Cache.open_cache(task["cache_dir"])
+    return Riparian_Corridor.corridor_counts(tile_index(task["bhi_rasters"]), read_tile, network, task["bands"],
+                                             task["blocks"])
+
+
+########################################################################################################################
+# tool runs
+########################################################################################################################
+
+def _zone_tasks(zone_ids, rings, area, workers, message=print, **shared):
+    """Split the zones into tasks following their OS 100 km tile schedule (Zone_Schedule). Each task holds its zones
+    sorted by Zone_no and, under "order", the positions in which to process them."""
+    with Run_Trace.phase("schedule zones", items=len(zone_ids)):
+        extents = [Zone_Geometry.rings_extent(r) or (np.nan,) * 4 for r in rings]
+        groups = Zone_Schedule.schedule(extents, read_os_grid())
+    message(Zone_Schedule.describe(groups))
+
+    tasks = []
+    for part in Zone_Schedule.split_order(groups, 1 if workers == 1 else workers * 4):
+        members = np.sort(part)
+        task = {"zone_ids": zone_ids[members], "rings": [rings[n] for n in members], "area": area[members],
+                "order": np.searchsorted(members, part)}
+        task.update(shared)
+        tasks.append(task)
+    return tasks
+
+
+def cached_results(zone_ids, rings, fields, compute, cache_path=None, fingerprint=None, message=print):
+    """Return the results of every zone, passing only the positions of zones missing from the result cache to
+    compute(positions). The NumPy counterpart of Beaver_Arc_Utils.cached_results."""
+    if not cache_path:
+        return compute(np.arange(len(zone_ids)))
+
+    with Run_Trace.phase("result cache lookup"):
+        keys = [Zone_Result_Cache.geometry_key(r) for r in rings]
+        cache = Zone_Result_Cache.ResultCache(cache_path, fingerprint, fields)
+        found = cache.lookup(keys)
+        Run_Trace.count(len(found))
+    todo = np.array([n for n, key in enumerate(keys) if key not in found], dtype=np.int64)
+
+    dtype = [("Zone_no", np.int64)] + [(f, np.float64) for f in fields]
+    parts = [np.array([tuple([zone_ids[n]] + found[key]) for n, key in enumerate(keys) if key in found],
+                      dtype=dtype)]
+    if len(todo):
+        computed = compute(todo)
+        cache.store([keys[n] for n in todo], computed)
+        parts.append(computed)
+
+    message(cache.summary())
+    cache.close()
+    return np.sort(np.concatenate(parts), order="Zone_no")
+
+
+def _write_outputs(s_zone, zones_out, table_out, results, message):
+    if zones_out:
+        message("writing statistics to {0}".format(zones_out))
+        with Run_Trace.phase("write zone shapefile", items=len(results)):
+            write_zone_shapefile(s_zone, zones_out, results)
+    if table_out:
+        message("exporting statistics table")
+        with Run_Trace.phase("export statistics table", items=len(results)):
+            Zone_Table_Export.write_table(results, table_out)
+
+
+def run_bhi(bhi_rasters, s_zone, zones_out, workers=1, cache_mb=512, pyramid_dir=None, result_cache=None,
+            table_out=None, message=print, overview_dir=None, prefetch=0,
+            prefetch_mb=Zone_Prefetch.DEFAULT_BUDGET_MB, overlap=False, stats_spec=None):
+    """BHI zonal statistics without arcpy. bhi_rasters is a list of BHI rasters and/or folders of BHI tiles. With
+    overview_dir the approximate quick look statistics are returned instead, from BHI_Overview overviews. With
+    prefetch > 0 each worker reads the tile windows of that many upcoming zones in a background thread. With overlap
+    overlapping zones share their pixel reads (Zone_Overlap) and prefetch is not used. stats_spec (a Zone_Stats_Spec
+    JSON file or dict) chooses the output fields; the quick look always gives the BHI_* fields."""
+    workers = max(1, int(workers or 1))
+    fieldset = BHI_Stats_Core.field_set(stats_spec)
+    if overview_dir and not fieldset.default:
+        message("quick look mode gives the BHI_* fields only - the statistics specification is not used")
+    with Run_Trace.phase("read zones"):
+        zone_ids, rings, area = read_zones(s_zone)
+        Run_Trace.count(len(zone_ids))
+    index = tile_index(bhi_rasters)
+
+    def compute(positions):
+        tasks = _zone_tasks(zone_ids[positions], [rings[n] for n in positions], area[positions], workers, message,
+                            bhi_rasters=[t.path for t in index.tiles], cache_mb=float(cache_mb),
+                            pyramid_dir=pyramid_dir, overview_dir=overview_dir, prefetch=int(prefetch or 0),
+                            prefetch_mb=float(prefetch_mb), overlap=bool(overlap), fieldset=fieldset)
+        message("summarising {0} features on {1} worker(s)...".format(len(positions), workers))
+        outputs = Zone_Parallel.run_zones(bhi_zone_worker, tasks, workers)
+        for n, (_, summary) in enumerate(outputs):
+            message("zone range {0}/{1} {2}".format(n + 1, len(outputs), summary))
+        return np.sort(np.concatenate([res for res, _ in outputs]), order="Zone_no")
+
+    fingerprint = source_fingerprint([t.path for t in index.tiles]) if result_cache else None
+    fields = BHI_Overview.QUICK_FIELDS if overview_dir else fieldset.names
+    if not overview_dir:
+        fingerprint = fieldset.fingerprint(fingerprint)
+    results = cached_results(zone_ids, rings, fields, compute, result_cache, fingerprint, message)
+
+    for zone in BHI_Stats_Core.outside_zones(results):
+        message("\n WARNING: A FEATURE {0} FALLS OUTSIDE OF THE PROVIDED BHI AREA! \n".format(zone))
+
+    _write_outputs(s_zone, zones_out, table_out, results, message)
+    return results
+
+
+def run_bdc(bdc_nets, s_zone, zones_out, workers=1, cache_dir=None, result_cache=None, table_out=None,
+            message=print, overlap=False, stats_spec=None):
+    """BDC zonal statistics without arcpy. bdc_nets is a list of BDC network shapefiles; the network is held in a
+    BDC_Network_Cache, in cache_dir if given or in a temporary folder otherwise. With overlap overlapping zones
+    share the reaches gathered under them. stats_spec (a Zone_Stats_Spec JSON file or dict) chooses the output
+    fields."""
+    workers = max(1, int(workers or 1))
+    fieldset = BDC_Stats_Core.field_set(stats_spec)
+    with Run_Trace.phase("read zones"):
+        zone_ids, rings, area = read_zones(s_zone)
+        Run_Trace.count(len(zone_ids))
+
+    fingerprint = source_fingerprint(bdc_nets)
+    folder = cache_dir or tempfile.mkdtemp(prefix="beaver_bdc_")
+    try:
+        if not BDC_Network_Cache.is_current(folder, fingerprint):
+            message("building bdc network cache in {0}".format(folder))
+            with Run_Trace.phase("build network cache"):
+                BDC_Network_Cache.build(iter_reaches(bdc_nets), folder, fingerprint)
+
+        def compute(positions):
+            tasks = _zone_tasks(zone_ids[positions], [rings[n] for n in positions], area[positions], workers,
+                                message, cache_dir=folder, overlap=bool(overlap), fieldset=fieldset)
+            message("overlaying bdc network with {0} features on {1} worker(s)".format(len(positions), workers))
+            return np.sort(np.concatenate(Zone_Parallel.run_zones(bdc_zone_worker, tasks, workers)), order="Zone_no")
+
+        results = cached_results(zone_ids, rings, fieldset.names, compute, result_cache,
+                                 fieldset.fingerprint(fingerprint), message)
+    finally:
+        if not cache_dir:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    _write_outputs(s_zone, zones_out, table_out, results, message)
+    return results
+
+
+def _level_keys(s_zone, levels, parent_table, message):
+    """Return {level: parent key of every zone}. Levels are zone attribute fields, columns of parent_table (joined
+    on the zone attribute named in its first column) or Zone_Rollup.ALL."""
+    key_field, table = Zone_Rollup.read_parent_table(parent_table) if parent_table else (None, {})
+    n_zones = len(read_shapes(s_zone)[1])
+    keys = {}
+    for level in levels:
+        if level == Zone_Rollup.ALL:
+            keys[Zone_Rollup.ALL_KEY] = [Zone_Rollup.ALL_KEY] * n_zones
+        elif level in table:
+            fine = dbf_text_column(s_zone, key_field)
+            keys[level] = [table[level].get(k, "") for k in fine]
+            missing = sum(1 for k in fine if k not in table[level])
+            if missing:
+                message("WARNING: {0} feature(s) have no {1} in {2}".format(missing, level, parent_table))
+        else:
+            keys[level] = dbf_text_column(s_zone, level)
+    return keys
+
+
+def run_rollup(s_zone, levels, out_folder, bhi_rasters=None, bdc_nets=None, parent_table=None, workers=1,
+               cache_mb=512, pyramid_dir=None, cache_dir=None, table_ext=".csv", zones_out=None, message=print,
+               stats_spec=None):
+    """Summarise the fine zones of s_zone once and roll the results up to each parent level (Zone_Rollup), writing
+    one table per level, named after it, to out_folder - plus the fine zones (Zone_no) themselves, and their
+    shapefile to zones_out if given. levels are attribute fields of the zones, columns of parent_table or "*" for
+    all zones together. Either or both of bhi_rasters and bdc_nets are summarised, with the fields of stats_spec (see
+    Zone_Stats_Spec). The fine zones must not overlap."""
+    workers = max(1, int(workers or 1))
+    with Run_Trace.phase("read zones"):
+        zone_ids, rings, area = read_zones(s_zone)
+        Run_Trace.count(len(zone_ids))
+    keys = _level_keys(s_zone, levels, parent_table, message)
+    keys[Zone_Rollup.FINE_LEVEL] = zone_ids
+
+    hist = pieces = None
+    if bhi_rasters:
+        index = tile_index(bhi_rasters)
+        tasks = _zone_tasks(zone_ids, rings, area, workers, message, bhi_rasters=[t.path for t in index.tiles],
+                            cache_mb=float(cache_mb), pyramid_dir=pyramid_dir, overview_dir=None, prefetch=0,
+                            prefetch_mb=Zone_Prefetch.DEFAULT_BUDGET_MB, overlap=False)
+        message("summarising bhi of {0} features on {1} worker(s)...".format(len(zone_ids), workers))
+        outputs = Zone_Parallel.run_zones(bhi_histogram_worker, tasks, workers)
+        for n, (_, summary) in enumerate(outputs):
+            message("zone range {0}/{1} {2}".format(n + 1, len(outputs), summary))
+        order = np.argsort(np.concatenate([task["zone_ids"] for task in tasks]))
+        hist = np.concatenate([h for h, _ in outputs])[order]
+
+    if bdc_nets:
+        fingerprint = source_fingerprint(bdc_nets)
+        folder = cache_dir or tempfile.mkdtemp(prefix="beaver_bdc_")
+        try:
+            if not BDC_Network_Cache.is_current(folder, fingerprint):
+                message("building bdc network cache in {0}".format(folder))
+                with Run_Trace.phase("build network cache"):
+                    BDC_Network_Cache.build(iter_reaches(bdc_nets), folder, fingerprint)
+            tasks = _zone_tasks(zone_ids, rings, area, workers, message, cache_dir=folder)
+            message("overlaying bdc network with {0} features on {1} worker(s)".format(len(zone_ids), workers))
+            outputs = Zone_Parallel.run_zones(bdc_piece_worker, tasks, workers)
+        finally:
+            if not cache_dir:
+                shutil.rmtree(folder, ignore_errors=True)
+        zones, reach, bdc, length = [np.concatenate(part) for part in zip(*outputs)]
+        pieces = np.searchsorted(zone_ids, zones), reach, bdc, length
+
+    with Run_Trace.phase("roll up levels", items=len(keys)):
+        tables = Zone_Rollup.roll_up(keys, hist, area, pieces, BHI_Stats_Core.field_set(stats_spec),
+                                     BDC_Stats_Core.field_set(stats_spec))
+
+    if not os.path.isdir(out_folder):
+        os.makedirs(out_folder)
+    for name, table in sorted(tables.items()):
+        path = os.path.join(out_folder, name + table_ext)
+        message("writing {0} level statistics ({1} rows) to {2}".format(name, len(table), path))
+        Zone_Table_Export.write_table(table, path)
+    if zones_out:
+        message("writing statistics to {0}".format(zones_out))
+        fine = tables[Zone_Rollup.FINE_LEVEL]
+        write_zone_shapefile(s_zone, zones_out, fine[[f for f in fine.dtype.names if f != Zone_Rollup.COUNT_FIELD]])
+    return tables
+
+
+def run_riparian(bhi_rasters, bdc_nets, out_folder, bands=Riparian_Corridor.DEFAULT_BANDS, workers=1, cache_dir=None,
+                 table_out=None, message=print):
+    """BHI statistics within distance bands of every BDC reach, without arcpy. The BHI near the networks is swept
+    once (Riparian_Corridor) and a copy of each network is written to out_folder with the band fields added. Reaches
+    are numbered (Reach_no) in record order, through the networks in turn in the statistics table."""
+    workers = max(1, int(workers or 1))
+    bands = Riparian_Corridor.parse_bands(bands)
+    nets_out = [os.path.join(out_folder, os.path.basename(net)) for net in bdc_nets]
+    for net, net_out in zip(bdc_nets, nets_out):
+        if os.path.abspath(net) == os.path.abspath(net_out):
+            raise ValueError("the output folder would overwrite the input network {0}".format(net))
+    index = tile_index(bhi_rasters)
+    n_records = [len(read_dbf(net)[1]) for net in bdc_nets]
+
+    fingerprint = source_fingerprint(bdc_nets)
+    folder = cache_dir or tempfile.mkdtemp(prefix="beaver_bdc_")
+    try:
+        if not BDC_Network_Cache.is_current(folder, fingerprint):
+            message("building bdc network cache in {0}".format(folder))
+            with Run_Trace.phase("build network cache"):
+                BDC_Network_Cache.build(iter_reaches(bdc_nets), folder, fingerprint)
+        network = BDC_Network_Cache.open_cache(folder)
+        source = np.array(network.source)
+
+        with Run_Trace.phase("plan corridor blocks"):
+            blocks = Riparian_Corridor.corridor_blocks(index, network, bands)
+        parts = np.array_split(np.arange(len(blocks)), max(1, min(len(blocks), 1 if workers == 1 else workers * 4)))
+        tasks = [{"bhi_rasters": [t.path for t in index.tiles], "cache_dir": folder, "bands": bands,
+                  "blocks": [blocks[k] for k in part]} for part in parts if len(part)]
+        message("sweeping {0} bhi blocks within {1:g} m of {2} reaches on {3} worker(s)...".format(
+            len(blocks), bands[-1], len(network), workers))
+        outputs = Zone_Parallel.run_zones(riparian_worker, tasks, workers)
+    finally:
+        if not cache_dir:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    results = Riparian_Corridor.record_fields(outputs, source, sum(n_records), bands)
+
+    if not os.path.isdir(out_folder):
+        os.makedirs(out_folder)
+    first = 0
+    for net, net_out, n in zip(bdc_nets, nets_out, n_records):
+        message("writing riparian statistics to {0}".format(net_out))
+        part = results[first:first + n].copy()
+        part["Reach_no"] -= first
+        with Run_Trace.phase("write network shapefile", items=n):
+            write_zone_shapefile(net, net_out, part, id_field="Reach_no")
+        first += n
+    if table_out:
+        message("exporting statistics table")
+        with Run_Trace.phase("export statistics table", items=len(results)):
+            Zone_Table_Export.write_table(results, table_out)
+    return results
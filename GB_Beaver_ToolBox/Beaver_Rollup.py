@@ -0,0 +1,50 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Hierarchical Zone Roll-up Tool Script.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It summarises the BHI and/or BDC of a fine zone
+#                  layer (e.g. sub-catchments) once and rolls the results up to each parent level - catchment, river
+#                  basin district, national - writing one statistics table per level, without reading the BHI or
+#                  the BDC network again for each level. Parent levels are attribute fields of the zones or columns
+#                  of a parent-key table; "*" rolls every zone into one. Runs on the NumPy backend
+#                  (Beaver_NumPy_Utils) only, from the command line, with the fields of an optional statistics
+#                  specification (Zone_Stats_Spec):
+#                      python Beaver_Rollup.py <zones.shp> <level;level;*> <out folder> [bhi] [bdc nets] [table]
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+from __future__ import print_function
+
+import sys
+
+import Beaver_NumPy_Utils
+import Run_Trace
+
+
+def _split(value):
+    # multi-value parameters arrive as a single "a;b;c" string
+    if hasattr(value, "split"):
+        return [v.strip("'\"") for v in value.split(";") if v]
+    return value
+
+
+def main(s_zone, levels, out_folder, bhi_home=None, bdc_nets=None, parent_table=None, workers=1, cache_mb=512,
+         pyramid_dir=None, cache_dir=None, table_ext=".csv", zones_out=None, trace_out=None, profile=False,
+         stats_spec=None):
+    Run_Trace.start(trace_out, str(profile).lower() in ("true", "1"))
+    try:
+        Beaver_NumPy_Utils.run_rollup(s_zone, _split(levels), out_folder, bhi_rasters=_split(bhi_home) or None,
+                                      bdc_nets=_split(bdc_nets) or None, parent_table=parent_table or None,
+                                      workers=workers, cache_mb=float(cache_mb), pyramid_dir=pyramid_dir or None,
+                                      cache_dir=cache_dir or None, table_ext=table_ext, zones_out=zones_out or None,
+                                      stats_spec=stats_spec or None)
+    finally:
+        Run_Trace.finish(print)
+
+
+if __name__ == '__main__':
+    main(
+        sys.argv[1],
+        sys.argv[2],
+        sys.argv[3],
+        *sys.argv[4:])
@@ -0,0 +1,218 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Riparian Corridor BHI Statistics.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It summarises the BHI within distance bands (e.g. 10,
+#                  50 and 100 m) of every BDC reach in one sweep over the BHI, without buffering any reach. Each block
+#                  of BHI pixels is labelled with its nearest reach and the distance to it: the cells crossed by the
+#                  reaches near the block are seeded with their reach and grown outwards ring by ring, nearest offset
+#                  first, out to the widest band. Pixels are then counted by reach, band and class with one bincount,
+#                  so work follows the BHI area near the network rather than the number of reaches x buffers. Each
+#                  pixel counts towards its nearest reach only; distances are between cell centres, from the cells a
+#                  reach passes through.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import math
+
+import numpy as np
+
+import BHI_Stats_Core
+import Run_Trace
+
+DEFAULT_BANDS = (10.0, 50.0, 100.0)
+BLOCK_SIZE = 1024
+
+
+def parse_bands(bands):
+    """Return the distance bands (map units) as a sorted float array, from a list or a "10;50;100" string."""
+    if hasattr(bands, "split"):
+        bands = [b for b in bands.replace(",", ";").split(";") if b.strip()]
+    bands = np.unique(np.asarray([float(b) for b in bands], dtype=np.float64))
+    if not len(bands) or bands[0] <= 0:
+        raise ValueError("riparian distance bands must be positive: {0}".format(list(bands)))
+    return bands
+
+
+def band_prefix(band):
+    """Field name prefix of a band, e.g. R10 or R12_5 - short enough for dBASE's 10 character names."""
+    return "R{0:g}".format(band).replace(".", "_")
+
+
+def band_fields(bands):
+    """Return the output field names: the mean, standard deviation and class percentages of every band."""
+    fields = []
+    for band in bands:
+        prefix = band_prefix(band)
+        fields += [prefix + "_MEAN", prefix + "_STD"]
+        fields += ["{0}_P{1}".format(prefix, c) for c in range(BHI_Stats_Core.N_CLASSES)]
+    return fields
+
+
+def ring_offsets(radius):
+    """Return the (drow, dcol, squared distance) cell offsets within radius cells, nearest first."""
+    r = int(math.ceil(radius))
+    drow, dcol = np.mgrid[-r:r + 1, -r:r + 1]
+    d2 = (drow ** 2 + dcol ** 2).ravel()
+    order = np.argsort(d2, kind="mergesort")
+    order = order[d2[order] <= radius ** 2]
+    return drow.ravel()[order], dcol.ravel()[order], d2[order]
+
+
+def _crossings(a0, a1, origin, cell):
+    """Return the segment of each crossing of grid lines (origin + k * cell) by coordinate a and its parameter t."""
+    lo, hi = np.minimum(a0, a1), np.maximum(a0, a1)
+    k0 = np.ceil((lo - origin) / cell).astype(np.int64)
+    n = np.where(a1 != a0, np.floor((hi - origin) / cell).astype(np.int64) - k0 + 1, 0).clip(0)
+    seg = np.repeat(np.arange(len(a0)), n)
+    k = k0[seg] + np.arange(len(seg)) - np.repeat(np.cumsum(n) - n, n)
+    return seg, (origin + k * cell - a0[seg]) / (a1 - a0)[seg]
+
+
+def seed_cells(segs, owner, xmin, ymax, cell, nrows, ncols):
+    """Return the cells (flat positions in an nrows x ncols grid) crossed by line segments and the owner of each. A
+    cell crossed by several reaches is seeded with one of them."""
+    if not len(segs):
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    # split every segment where it crosses a grid line - the midpoint of each piece lies in one crossed cell
+    ends = np.arange(len(segs))
+    x_seg, x_t = _crossings(segs[:, 0], segs[:, 2], xmin, cell)
+    y_seg, y_t = _crossings(segs[:, 1], segs[:, 3], ymax, cell)
+    seg = np.concatenate([ends, ends, x_seg, y_seg])
+    t = np.concatenate([np.zeros(len(segs)), np.ones(len(segs)), x_t, y_t])
+    order = np.lexsort((t, seg))
+    seg, t = seg[order], t[order]
+    same = seg[:-1] == seg[1:]
+    seg, t = seg[:-1][same], 0.5 * (t[:-1] + t[1:])[same]
+
+    x = segs[seg, 0] + t * (segs[seg, 2] - segs[seg, 0])
+    y = segs[seg, 1] + t * (segs[seg, 3] - segs[seg, 1])
+    col = np.floor((x - xmin) / cell).astype(np.int64)
+    row = np.floor((ymax - y) / cell).astype(np.int64)
+    inside = (row >= 0) & (row < nrows) & (col >= 0) & (col < ncols)
+    pix, first = np.unique(row[inside] * ncols + col[inside], return_index=True)
+    return pix, np.asarray(owner)[seg[inside][first]]
+
+
+def nearest_labels(seeds, labels, nrows, ncols, offsets):
+    """Label every cell of an nrows x ncols grid within reach of the offsets with its nearest seed. Returns the
+    label (-1 where none) and squared distance in cells of each cell."""
+    # work on a grid with a margin as wide as the offsets, so every offset is one flat shift with no bounds checks
+    drow, dcol, d2 = offsets
+    m = int(max(np.abs(drow).max(), np.abs(dcol).max())) if len(drow) else 0
+    width = ncols + 2 * m
+    label = np.full((nrows + 2 * m) * width, -1, dtype=np.int64)
+    dist2 = np.zeros(len(label), dtype=np.int64)
+    flat = (seeds // ncols + m) * width + seeds % ncols + m
+    for shift, d in zip(drow * width + dcol, d2):
+        pix = flat + shift
+        free = label[pix] < 0
+        label[pix[free]] = labels[free]
+        dist2[pix[free]] = d
+    label = label.reshape(-1, width)[m:m + nrows, m:m + ncols].ravel()
+    return label, dist2.reshape(-1, width)[m:m + nrows, m:m + ncols].ravel()
+
+
+def corridor_blocks(index, network, bands, block_size=BLOCK_SIZE):
+    """Return the BHI blocks (tile position, row, col, nrows, ncols) within the widest band of the network."""
+    if not len(network):
+        return []
+    # distances run between cell centres, so a cell a band away may lie up to a cell beyond the reach itself
+    bbox, pad = np.asarray(network.bbox), float(bands[-1]) + index.cell
+    win = index.window(bbox[:, 0].min() - pad, bbox[:, 1].min() - pad, bbox[:, 2].max() + pad,
+                       bbox[:, 3].max() + pad)
+    blocks = []
+    for part in index.tile_windows(win):
+        number = index.tiles.index(part.tile)
+        for row, col, nrows, ncols in BHI_Stats_Core.iter_blocks(part.nrows, part.ncols, block_size):
+            blocks.append((number, part.row + row, part.col + col, nrows, ncols))
+    return blocks
+
+
+def block_counts(tile, reader, network, bands, row, col, nrows, ncols, offsets=None):
+    """Count the BHI classes of one block of a tile by nearest reach and band. Returns the reach ids and their
+    (n, bands, 6) counts, each band holding every pixel within its distance (bands are nested)."""
+    cell = tile.cell
+    radius = bands[-1] / cell
+    pad = int(math.ceil(radius))
+    xmin, ymax = tile.xmin + (col - pad) * cell, tile.ymax - (row - pad) * cell
+    prows, pcols = nrows + 2 * pad, ncols + 2 * pad
+    ids = network.candidates(xmin, ymax - prows * cell, xmin + pcols * cell, ymax)
+    empty = np.zeros(0, np.int64), np.zeros((0, len(bands), BHI_Stats_Core.N_CLASSES), np.int64)
+    if not len(ids):
+        return empty
+
+    # label the block and a margin of the widest band around it, so reaches just outside still claim their pixels
+    segs, owner = network.segments(ids)
+    seeds, labels = seed_cells(segs, owner, xmin, ymax, cell, prows, pcols)
+    if not len(seeds):
+        return empty
+    label, dist2 = nearest_labels(seeds, labels, prows, pcols, offsets or ring_offsets(radius))
+    label = label.reshape(prows, pcols)[pad:pad + nrows, pad:pad + ncols].ravel()
+    dist2 = dist2.reshape(prows, pcols)[pad:pad + nrows, pad:pad + ncols].ravel()
+
+    values = np.asarray(reader(tile, row, col, nrows, ncols)).ravel()
+    valid = (label >= 0) & (values >= 0) & (values <= BHI_Stats_Core.N_CLASSES - 1)
+    if tile.nodata is not None:
+        valid &= values != tile.nodata
+    if not valid.any():
+        return empty
+    Run_Trace.count(int(valid.sum()))
+
+    band = np.searchsorted((bands / cell) ** 2 + 1e-9, dist2[valid])
+    keys = (label[valid] * len(bands) + band) * BHI_Stats_Core.N_CLASSES + values[valid].astype(np.int64)
+    counts = np.bincount(keys, minlength=len(ids) * len(bands) * BHI_Stats_Core.N_CLASSES)
+    counts = np.cumsum(counts.reshape(len(ids), len(bands), BHI_Stats_Core.N_CLASSES), axis=1)
+    hit = counts[:, -1].sum(axis=1) > 0
+    return ids[hit], counts[hit]
+
+
+def corridor_counts(index, reader, network, bands, blocks):
+    """Sum block_counts over a run of blocks (see corridor_blocks). Returns the sorted reach ids and their counts."""
+    offsets = None
+    ids, counts = [], []
+    for number, row, col, nrows, ncols in blocks:
+        tile = index.tiles[number]
+        offsets = offsets if offsets is not None else ring_offsets(bands[-1] / tile.cell)
+        with Run_Trace.phase("corridor block"):
+            block_ids, block_hist = block_counts(tile, reader, network, bands, row, col, nrows, ncols, offsets)
+        ids.append(block_ids)
+        counts.append(block_hist)
+    return merge_counts(ids, counts, len(bands))
+
+
+def merge_counts(ids, counts, n_bands):
+    """Add up lists of (reach ids, counts) into one sorted set of reach ids."""
+    ids = np.concatenate([np.zeros(0, np.int64)] + list(ids))
+    counts = np.concatenate([np.zeros((0, n_bands, BHI_Stats_Core.N_CLASSES), np.int64)] + list(counts))
+    reaches, inverse = np.unique(ids, return_inverse=True)
+    total = np.zeros((len(reaches), n_bands, BHI_Stats_Core.N_CLASSES), np.int64)
+    np.add.at(total, inverse.ravel(), counts)
+    return reaches, total
+
+
+def record_fields(outputs, source, n_records, bands):
+    """Build the band fields of every record of the networks (Reach_no from 1, through the networks in turn) from
+    the (reach ids, counts) of each run of blocks; source maps the network cache reaches to their records. Records
+    left out of the cache get 0 for every field."""
+    reaches, counts = merge_counts([ids for ids, _ in outputs], [c for _, c in outputs], len(bands))
+    hist = np.zeros((n_records, len(bands), BHI_Stats_Core.N_CLASSES), dtype=np.int64)
+    hist[np.asarray(source)[reaches]] = counts
+    return corridor_fields(np.arange(1, n_records + 1), hist, bands)
+
+
+def corridor_fields(reach_nos, counts, bands):
+    """Build a structured array holding Reach_no and the band fields (see band_fields) of every reach; counts is
+    the (n, bands, 6) class counts of each reach. Reaches without BHI pixels get 0 for every field."""
+    out = np.zeros(len(reach_nos), dtype=[("Reach_no", np.int64)] + [(f, np.float64) for f in band_fields(bands)])
+    out["Reach_no"] = reach_nos
+    for b, band in enumerate(bands):
+        prefix = band_prefix(band)
+        hist = counts[:, b]
+        stats = BHI_Stats_Core.bhi_stats(hist)
+        count = np.where(stats["count"] > 0, stats["count"], 1).astype(np.float64)
+        out[prefix + "_MEAN"] = stats["mean"]
+        out[prefix + "_STD"] = stats["std"]
+        for c in range(BHI_Stats_Core.N_CLASSES):
+            out["{0}_P{1}".format(prefix, c)] = np.round(hist[:, c] / count * 100, 2)
+    return out
@@ -0,0 +1,192 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Run Trace.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It records how long each phase of a run takes - wall
+#                  time, bytes read and written and item counts, per phase and per zone - and writes them to a JSON or
+#                  CSV trace with a summary of the slowest phases and zones. A cProfile profile can be saved alongside.
+#                  Phases are timed inclusively, so nested phases also count towards their parent. When no trace
+#                  is started every call returns at once and costs next to nothing.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+from __future__ import print_function
+
+import os
+import csv
+import json
+import time
+import threading
+
+COLUMNS = ("phase", "zone", "start", "seconds", "items", "bytes_read", "bytes_written", "pid")
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, trace, record):
+        self.trace = trace
+        self.record = record
+
+    def __enter__(self):
+        self.trace.stack.append(self.record)
+        self.record["start"] = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.record["seconds"] = time.time() - self.record["start"]
+        self.record["start"] -= self.trace.started
+        self.trace.stack.pop()
+        self.trace.records.append(self.record)
+        return False
+
+
+class Trace(object):
+    def __init__(self, path=None, profile=False):
+        """A run trace. path (.json or .csv) receives the records when the trace is finished; with profile a
+        cProfile profile of the run is written to path + ".pstats"."""
+        self.path = path
+        self.records = []
+        self._local = threading.local()
+        self.started = time.time()
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @property
+    def stack(self):
+        """The open phases of the calling thread - background threads (e.g. prefetching) nest their own."""
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def phase(self, name, zone=None, items=0):
+        """Context manager timing one phase, optionally for one zone."""
+        return _Phase(self, {"phase": name, "zone": None if zone is None else int(zone), "items": int(items),
+                             "bytes_read": 0, "bytes_written": 0, "pid": os.getpid()})
+
+    def count(self, items=0, bytes_read=0, bytes_written=0):
+        """Add items and bytes to the innermost open phase."""
+        if self.stack:
+            record = self.stack[-1]
+            record["items"] += int(items)
+            record["bytes_read"] += int(bytes_read)
+            record["bytes_written"] += int(bytes_written)
+
+    def summary(self, top=10):
+        """Return report lines for the slowest phases (totalled by name) and the slowest zones."""
+        phases = {}
+        zones = {}
+        for r in self.records:
+            p = phases.setdefault(r["phase"], [0, 0.0, 0.0, 0, 0])
+            p[0] += 1
+            p[1] += r["seconds"]
+            p[2] = max(p[2], r["seconds"])
+            p[3] += r["items"]
+            p[4] += r["bytes_read"] + r["bytes_written"]
+            if r["zone"] is not None:
+                zones[r["zone"]] = zones.get(r["zone"], 0.0) + r["seconds"]
+
+        lines = ["{0:<32} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}".format("phase", "calls", "total s", "max s",
+                                                                         "items", "MB")]
+        for name, p in sorted(phases.items(), key=lambda kv: -kv[1][1])[:top]:
+            lines.append("{0:<32} {1:>8} {2:>10.2f} {3:>10.3f} {4:>10} {5:>10.1f}".format(
+                name[:32], p[0], p[1], p[2], p[3], p[4] / 1024.0 / 1024.0))
+        if zones:
+            lines.append("slowest zones: " + ", ".join("{0} ({1:.2f} s)".format(z, s) for z, s in
+                                                      sorted(zones.items(), key=lambda kv: -kv[1])[:top]))
+        return lines
+
+    def write(self, path=None):
+        """Write the records to a .csv file or, for any other extension, a JSON file with a summary."""
+        path = path or self.path
+        if path.lower().endswith(".csv"):
+            mode, kwargs = ("wb", {}) if str is bytes else ("w", {"newline": ""})
+            with open(path, mode, **kwargs) as f:
+                writer = csv.DictWriter(f, COLUMNS, extrasaction="ignore")
+                writer.writeheader()
+                writer.writerows(self.records)
+        else:
+            with open(path, "w") as f:
+                json.dump({"seconds": time.time() - self.started, "summary": self.summary(),
+                           "records": self.records}, f, indent=1)
+
+    def finish(self, message=print):
+        """Stop profiling, write the trace and report the slowest phases."""
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats((self.path or "beaver_run") + ".pstats")
+        if self.path:
+            self.write()
+        for line in self.summary():
+            message(line)
+
+
+# the trace of the run in this process - None when tracing is off
+_current = None
+
+
+def start(path=None, profile=False):
+    """Start tracing this process's run; does nothing unless a trace file or profiling is asked for."""
+    global _current
+    _current = Trace(path, profile) if (path or profile) else None
+    return _current
+
+
+def finish(message=print):
+    """Finish the current trace, if any."""
+    global _current
+    if _current is not None:
+        _current.finish(message)
+    _current = None
+
+
+def enabled():
+    return _current is not None
+
+
+def phase(name, zone=None, items=0):
+    """Time a phase of the current trace: with Run_Trace.phase("rasterise zones"): ..."""
+    if _current is None:
+        return _NULL
+    return _current.phase(name, zone, items)
+
+
+def count(items=0, bytes_read=0, bytes_written=0):
+    """Add items and bytes to the innermost open phase of the current trace."""
+    if _current is not None:
+        _current.count(items, bytes_read, bytes_written)
+
+
+def traced_call(job):
+    """Run worker(task) for job = (worker, task) under a trace of its own and return (result, records); used to
+    collect the records of pool workers."""
+    global _current
+    worker, task = job
+    _current = trace = Trace()
+    try:
+        result = worker(task)
+    finally:
+        _current = None
+    for record in trace.records:
+        record["start"] += trace.started
+    return result, trace.records
+
+
+def add_records(records):
+    """Add records returned by traced_call to the current trace."""
+    if _current is not None:
+        for record in records:
+            record["start"] -= _current.started
+        _current.records.extend(records)
@@ -0,0 +1,265 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Zone Geometry Helpers.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It holds arcpy-free polygon helpers used to work with
+#                  search zones directly in NumPy: zones are held as lists of rings (multipart polygons and holes are
+#                  handled with the even-odd rule), pixels are tested at their cell centres as FeatureToRaster does,
+#                  grids of blocks are classified as inside, outside or on the zone boundary and line segments are
+#                  clipped to zones to measure the length of channel inside them. Edges are bucketed into horizontal
+#                  bands, so points and segments are only ever tested against the edges near them.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import numpy as np
+
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+# polygon edges per horizontal band of an edge index (see edge_bands)
+EDGES_PER_BAND = 32
+
+
+def ring_edges(rings):
+    """Return the edges of a list of rings as an (n, 4) array of x0, y0, x1, y1. Rings may be open or closed."""
+    edges = []
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64)
+        if len(ring) < 3:
+            continue
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        edges.append(np.hstack([ring[:-1], ring[1:]]))
+    if not edges:
+        return np.zeros((0, 4))
+    edges = np.vstack(edges)
+    return edges[(edges[:, 0] != edges[:, 2]) | (edges[:, 1] != edges[:, 3])]
+
+
+def edge_bands(edges, per_band=EDGES_PER_BAND):
+    """Bucket edges into horizontal bands of equal height, about per_band edges to a band. Returns (ymin, band
+    height, number of bands, edge ids, band starts): the edges of band b are edge_ids[starts[b]:starts[b + 1]], each
+    edge listed in every band its y range touches."""
+    lo, hi = np.minimum(edges[:, 1], edges[:, 3]), np.maximum(edges[:, 1], edges[:, 3])
+    ymin = float(lo.min()) if len(edges) else 0.0
+    span = float(hi.max()) - ymin if len(edges) else 0.0
+    n_bands = max(1, len(edges) // per_band)
+    while True:
+        height = span / n_bands or 1.0
+        first = np.clip(((lo - ymin) / height).astype(np.int64), 0, n_bands - 1)
+        n = np.clip(((hi - ymin) / height).astype(np.int64), 0, n_bands - 1) - first + 1
+        # long edges crossing many bands are listed in each - use fewer bands if that swamps the index
+        if n_bands == 1 or n.sum() <= 4 * len(edges):
+            break
+        n_bands = max(1, n_bands // 4)
+    edge = np.repeat(np.arange(len(edges)), n)
+    band = np.repeat(first, n) + (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n))
+    order = np.argsort(band, kind="mergesort")
+    return ymin, height, n_bands, edge[order], np.searchsorted(band[order], np.arange(n_bands + 1))
+
+
+def band_of(bands, y):
+    """Return the band of each y (see edge_bands), -1 below and n_bands above the indexed edges."""
+    ymin, height, n_bands = bands[:3]
+    b = np.floor((np.asarray(y, dtype=np.float64) - ymin) / height)
+    return np.clip(b, -1, n_bands).astype(np.int64)
+
+
+def edges_near(bands, ylo, yhi):
+    """Return the ids of the edges listed in the bands from ylo to yhi (see edge_bands), each once."""
+    b0, b1 = np.clip(band_of(bands, [ylo, yhi]), 0, bands[2] - 1)
+    return np.unique(bands[3][bands[4][b0]:bands[4][b1 + 1]])
+
+
+def points_in_polygon(x, y, edges, chunk=2048, bands=None):
+    """Even-odd test of many points against a polygon's edges. Each point is only tested against the edges of its
+    band (see edge_bands), in chunks of points and edges to bound memory."""
+    x = np.asarray(x, dtype=np.float64).ravel()
+    y = np.asarray(y, dtype=np.float64).ravel()
+    inside = np.zeros(x.shape, dtype=bool)
+    if len(x) == 0 or len(edges) == 0:
+        return inside
+    bands = bands or edge_bands(edges)
+    band = band_of(bands, y)
+    order = np.argsort(band, kind="mergesort")
+    starts = np.searchsorted(band[order], np.arange(bands[2] + 1))
+    for b in np.nonzero(np.diff(starts))[0]:
+        pts = order[starts[b]:starts[b + 1]]
+        near = edges[bands[3][bands[4][b]:bands[4][b + 1]]]
+        for p in range(0, len(pts), chunk):
+            ids = pts[p:p + chunk]
+            px, py = x[ids, None], y[ids, None]
+            for start in range(0, len(near), chunk):
+                e = near[start:start + chunk]
+                x0, y0, x1, y1 = e[:, 0], e[:, 1], e[:, 2], e[:, 3]
+                crosses = (y0 > py) != (y1 > py)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    xint = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+                inside[ids] ^= (np.count_nonzero(crosses & (px < xint), axis=1) % 2).astype(bool)
+    return inside
+
+
+def polygon_runs(edges, xmin, ymax, cell, nrows, ncols):
+    """Rasterise a polygon onto a window (top left corner xmin, ymax) by cell centre, scanline by scanline, as
+    row runs. Returns (rows, col_starts, col_ends) arrays, ends exclusive, sorted by row and column."""
+    empty = np.zeros(0, dtype=np.int64)
+    if len(edges) == 0 or nrows == 0 or ncols == 0:
+        return empty, empty, empty
+
+    x0, y0, x1, y1 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+    lo, hi = np.minimum(y0, y1), np.maximum(y0, y1)
+
+    # rows whose centre y = ymax - (r + 0.5) * cell lies in [lo, hi) of each edge
+    r_first = np.ceil((ymax - hi) / cell - 0.5).astype(np.int64)
+    r_last = np.ceil((ymax - lo) / cell - 0.5).astype(np.int64) - 1
+    r_first = np.maximum(r_first, 0)
+    r_last = np.minimum(r_last, nrows - 1)
+    n = np.maximum(r_last - r_first + 1, 0)
+    if n.sum() == 0:
+        return empty, empty, empty
+
+    edge = np.repeat(np.arange(len(edges)), n)
+    rows = np.repeat(r_first, n) + (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n))
+    yc = ymax - (rows + 0.5) * cell
+    xs = x0[edge] + (yc - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+
+    order = np.lexsort((xs, rows))
+    rows, xs = rows[order], xs[order]
+    # crossings pair up along each scanline: (enter, leave), (enter, leave) ...
+    cols = np.ceil((xs - xmin) / cell - 0.5).astype(np.int64)
+    cols = np.clip(cols, 0, ncols)
+    run_rows, starts, ends = rows[0::2], cols[0::2], cols[1::2]
+    keep = ends > starts
+    return run_rows[keep], starts[keep], ends[keep]
+
+
+def run_pixels(rows, starts, ends):
+    """Expand row runs into the (row, col) index arrays of every pixel they cover."""
+    n = ends - starts
+    pix_rows = np.repeat(rows, n)
+    pix_cols = np.repeat(starts, n) + (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n))
+    return pix_rows, pix_cols
+
+
+def polygon_mask(edges, xmin, ymax, cell, nrows, ncols):
+    """Rasterise a polygon onto a window (top left corner xmin, ymax) by cell centre. Returns a boolean
+    nrows x ncols mask."""
+    mask = np.zeros((nrows, ncols), dtype=bool)
+    mask[run_pixels(*polygon_runs(edges, xmin, ymax, cell, nrows, ncols))] = True
+    return mask
+
+
+def touched_blocks(edges, xmin, ymax, size, nrows, ncols):
+    """Mark the blocks of a grid (top left corner xmin, ymax, square blocks of side size) that a polygon edge
+    passes through. Edges are split into pieces no longer than half a block so each piece can only touch the
+    blocks under its bounding box; the result is conservative, never missing a touched block."""
+    touched = np.zeros((nrows, ncols), dtype=bool)
+    if len(edges) == 0:
+        return touched
+
+    length = np.hypot(edges[:, 2] - edges[:, 0], edges[:, 3] - edges[:, 1])
+    pieces = np.maximum(np.ceil(length / (size / 2.0)).astype(np.int64), 1)
+    edge = np.repeat(np.arange(len(edges)), pieces)
+    k = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    t0 = k / pieces[edge].astype(np.float64)
+    t1 = (k + 1) / pieces[edge].astype(np.float64)
+    dx = edges[edge, 2] - edges[edge, 0]
+    dy = edges[edge, 3] - edges[edge, 1]
+    ax, ay = edges[edge, 0] + t0 * dx, edges[edge, 1] + t0 * dy
+    bx, by = edges[edge, 0] + t1 * dx, edges[edge, 1] + t1 * dy
+
+    c0 = np.floor((np.minimum(ax, bx) - xmin) / size).astype(np.int64)
+    c1 = np.floor((np.maximum(ax, bx) - xmin) / size).astype(np.int64)
+    r0 = np.floor((ymax - np.maximum(ay, by)) / size).astype(np.int64)
+    r1 = np.floor((ymax - np.minimum(ay, by)) / size).astype(np.int64)
+
+    for r, c in ((r0, c0), (r0, c1), (r1, c0), (r1, c1)):
+        ok = (r >= 0) & (r < nrows) & (c >= 0) & (c < ncols)
+        touched[r[ok], c[ok]] = True
+    return touched
+
+
+def classify_blocks(edges, xmin, ymax, size, nrows, ncols):
+    """Classify each block of a grid as OUTSIDE, INSIDE or on the BOUNDARY of a polygon. A block that no edge
+    passes through is wholly inside or outside, which its centre decides."""
+    state = np.where(touched_blocks(edges, xmin, ymax, size, nrows, ncols), BOUNDARY, OUTSIDE)
+    rows, cols = np.nonzero(state == OUTSIDE)
+    if rows.size:
+        inside = points_in_polygon(xmin + (cols + 0.5) * size, ymax - (rows + 0.5) * size, edges)
+        state[rows[inside], cols[inside]] = INSIDE
+    return state
+
+
+def segments_inside_length(segments, edges, chunk=128, edge_chunk=2048):
+    """Return the length of each line segment (x0, y0, x1, y1) that lies inside a polygon.
+
+    Every segment is cut where it crosses a polygon edge and the pieces whose midpoints are inside are summed.
+    Segments are taken in chunks of neighbours (sorted by grid cell), and each chunk is only tested against the
+    edges whose bounding box meets the chunk's, edge_chunk edges at a time, so the work follows the length of
+    boundary near the segments rather than segments x edges."""
+    segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+    inside_length = np.zeros(len(segments))
+    if len(segments) == 0 or len(edges) == 0:
+        return inside_length
+
+    sx, sy = segments[:, 0], segments[:, 1]
+    dx, dy = segments[:, 2] - sx, segments[:, 3] - sy
+    seg_ids, ts = [np.arange(len(segments)), np.arange(len(segments))], [np.zeros(len(segments)),
+                                                                         np.ones(len(segments))]
+    bands = edge_bands(edges)
+    e_xlo, e_xhi = np.minimum(edges[:, 0], edges[:, 2]), np.maximum(edges[:, 0], edges[:, 2])
+    e_ylo, e_yhi = np.minimum(edges[:, 1], edges[:, 3]), np.maximum(edges[:, 1], edges[:, 3])
+
+    # order the segments by the cell of a grid of about chunk segments a cell holding their midpoint
+    mx, my = sx + dx / 2, sy + dy / 2
+    cells = int(np.ceil(np.sqrt(len(segments) / float(chunk))))
+    width = max(float(mx.max() - mx.min()), float(my.max() - my.min())) / cells or 1.0
+    col = np.minimum(((mx - mx.min()) / width).astype(np.int64), cells - 1)
+    row = np.minimum(((my - my.min()) / width).astype(np.int64), cells - 1)
+    by_cell = np.lexsort((col, row))
+
+    for c0 in range(0, len(segments), chunk):
+        ids = by_cell[c0:c0 + chunk]
+        xlo, xhi = np.minimum(sx[ids], sx[ids] + dx[ids]).min(), np.maximum(sx[ids], sx[ids] + dx[ids]).max()
+        ylo, yhi = np.minimum(sy[ids], sy[ids] + dy[ids]).min(), np.maximum(sy[ids], sy[ids] + dy[ids]).max()
+        near = edges_near(bands, ylo, yhi)
+        near = near[(e_xlo[near] <= xhi) & (e_xhi[near] >= xlo) & (e_ylo[near] <= yhi) & (e_yhi[near] >= ylo)]
+        for e0 in range(0, len(near), edge_chunk):
+            e = edges[near[e0:e0 + edge_chunk]]
+            ex, ey = e[:, 0], e[:, 1]
+            fx, fy = e[:, 2] - ex, e[:, 3] - ey
+            denom = dx[ids, None] * fy[None, :] - dy[ids, None] * fx[None, :]
+            qx, qy = ex[None, :] - sx[ids, None], ey[None, :] - sy[ids, None]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                t = (qx * fy[None, :] - qy * fx[None, :]) / denom
+                u = (qx * dy[ids, None] - qy * dx[ids, None]) / denom
+            hit = (denom != 0) & (t > 0) & (t < 1) & (u >= 0) & (u <= 1)
+            rows, cols = np.nonzero(hit)
+            seg_ids.append(ids[rows])
+            ts.append(t[rows, cols])
+
+    seg_ids = np.concatenate(seg_ids)
+    ts = np.concatenate(ts)
+    order = np.lexsort((ts, seg_ids))
+    seg_ids, ts = seg_ids[order], ts[order]
+
+    same = seg_ids[1:] == seg_ids[:-1]
+    seg, ta, tb = seg_ids[:-1][same], ts[:-1][same], ts[1:][same]
+    mid = (ta + tb) / 2
+    inside = points_in_polygon(sx[seg] + mid * dx[seg], sy[seg] + mid * dy[seg], edges, bands=bands)
+    seg_length = np.hypot(dx, dy)
+    return np.bincount(seg[inside], weights=(tb - ta)[inside] * seg_length[seg[inside]], minlength=len(segments))
+
+
+def rings_extent(rings):
+    """Return (xmin, ymin, xmax, ymax) of a list of rings, or None if they hold no polygon."""
+    edges = ring_edges(rings)
+    return edges_extent(edges) if len(edges) else None
+
+
+def edges_extent(edges):
+    """Return (xmin, ymin, xmax, ymax) of a set of edges."""
+    return (float(np.minimum(edges[:, 0], edges[:, 2]).min()), float(np.minimum(edges[:, 1], edges[:, 3]).min()),
+            float(np.maximum(edges[:, 0], edges[:, 2]).max()), float(np.maximum(edges[:, 1], edges[:, 3]).max()))
+
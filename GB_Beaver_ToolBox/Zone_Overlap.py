@@ -0,0 +1,116 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Overlapping Zone Sharing.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It lets heavily overlapping search zones (e.g. 1, 5
+#                  and 10 km buffers around the same sites) share their work. Zones are gathered into groups whose
+#                  bounding boxes overlap; each group's BHI pixels are read once, block by block, and split into faces
+#                  - the pixels covered by the same set of zones - by labelling every pixel with one bit per zone
+#                  from the zones' scanline runs. Class counts are taken once per face and each zone's histogram is
+#                  the sum of its faces, so pixel work follows the area of the union rather than the sum of the zone
+#                  areas.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import numpy as np
+
+import BHI_Stats_Core
+import Run_Trace
+import Zone_Geometry
+
+# zones labelled per pass over a block - one bit each of a (signed) 64 bit label
+ZONES_PER_WORD = 63
+BLOCK_SIZE = 1024
+
+
+def overlap_groups(extents):
+    """Split zones into groups whose bounding boxes overlap, directly or through other zones of the group.
+
+    extents holds (xmin, ymin, xmax, ymax), or None, per zone. Returns a list of position arrays, ordered by each
+    group's first position; zones without geometry are groups of their own."""
+    box = np.array([e if e is not None else (np.nan,) * 4 for e in extents], dtype=np.float64).reshape(-1, 4)
+    parent = np.arange(len(box))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # sweep along x: each zone is only tested against the zones starting before it ends
+    valid = np.flatnonzero(~np.isnan(box).any(axis=1))
+    order = valid[np.argsort(box[valid, 0], kind="mergesort")]
+    starts = box[order, 0]
+    for a, i in enumerate(order):
+        near = order[a + 1:np.searchsorted(starts, box[i, 2], side="left")]
+        for j in near[(box[near, 1] < box[i, 3]) & (box[near, 3] > box[i, 1])]:
+            ri, rj = find(i), find(j)
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+
+    roots = np.array([find(i) for i in range(len(box))], dtype=np.int64)
+    groups = {}
+    for pos, root in enumerate(roots):
+        groups.setdefault(root, []).append(pos)
+    return [np.array(groups[root]) for root in sorted(groups, key=lambda r: groups[r][0])]
+
+
+def ordered_groups(order, extents):
+    """Group the zones of a processing order (positions) by overlap, keeping each group at its first zone's turn.
+    extents is indexed by position."""
+    order = np.asarray(order)
+    return [order[g] for g in overlap_groups([extents[pos] for pos in order])]
+
+
+def _face_counts(batch, values, nodata, counts):
+    """Label the pixels of a window with one bit per zone of batch ((position, (rows, starts, ends)), runs relative
+    to the window) and add the class counts of every face to the zones it belongs to."""
+    diff = np.zeros((values.shape[0], values.shape[1] + 1), dtype=np.int64)
+    for bit, (_, (rows, starts, ends)) in enumerate(batch):
+        # the runs of one zone never overlap, so summing distinct bits along each row gives the set of zones
+        np.add.at(diff, (rows, starts), np.int64(1) << bit)
+        np.add.at(diff, (rows, ends), -(np.int64(1) << bit))
+    labels = np.cumsum(diff[:, :-1], axis=1)
+    covered = labels != 0
+    faces, face_of = np.unique(labels[covered], return_inverse=True)
+    face_hist = BHI_Stats_Core.bhi_histogram(face_of.ravel(), values[covered], np.arange(len(faces)), nodata=nodata)
+    member = (faces[:, None] >> np.arange(len(batch), dtype=np.int64)) & 1
+    counts[[pos for pos, _ in batch]] += member.T.dot(face_hist)
+
+
+def group_counts(index, reader, group_rings, block_size=BLOCK_SIZE):
+    """Return the BHI class counts (n x 6) of a group of zones, each given as a list of rings, reading the pixels
+    under the group once. Matches BHI_Pyramid.zone_counts for every zone."""
+    counts = np.zeros((len(group_rings), BHI_Stats_Core.N_CLASSES), dtype=np.int64)
+    edges = [Zone_Geometry.ring_edges(rings) for rings in group_rings]
+    live = np.array([pos for pos, e in enumerate(edges) if len(e)], dtype=np.int64)
+    if not live.size:
+        return counts
+    extents = np.array([Zone_Geometry.edges_extent(edges[pos]) for pos in live])
+
+    win = index.window(extents[:, 0].min(), extents[:, 1].min(), extents[:, 2].max(), extents[:, 3].max())
+    for part in index.tile_windows(win):
+        tile = part.tile
+        for row, col, nrows, ncols in BHI_Stats_Core.iter_blocks(part.nrows, part.ncols, block_size):
+            row, col = part.row + row, part.col + col
+            xmin, ymax = tile.xmin + col * tile.cell, tile.ymax - row * tile.cell
+            near = live[(extents[:, 0] < xmin + ncols * tile.cell) & (extents[:, 2] > xmin) &
+                        (extents[:, 1] < ymax) & (extents[:, 3] > ymax - nrows * tile.cell)]
+            with Run_Trace.phase("rasterise zone", items=len(near)):
+                runs = [(pos, Zone_Geometry.polygon_runs(edges[pos], xmin, ymax, tile.cell, nrows, ncols))
+                        for pos in near]
+                runs = [(pos, r) for pos, r in runs if len(r[0])]
+            if not runs:
+                continue
+
+            # read only the rows and columns spanned by the runs, once for every zone of the group
+            r0 = min(r[0][0] for _, r in runs)
+            r1 = max(r[0][-1] for _, r in runs) + 1
+            c0 = min(r[1].min() for _, r in runs)
+            c1 = max(r[2].max() for _, r in runs)
+            values = np.asarray(reader(tile, row + r0, col + c0, r1 - r0, c1 - c0))
+            runs = [(pos, (rows - r0, starts - c0, ends - c0)) for pos, (rows, starts, ends) in runs]
+            for b in range(0, len(runs), ZONES_PER_WORD):
+                _face_counts(runs[b:b + ZONES_PER_WORD], values, tile.nodata, counts)
+            Run_Trace.count(values.size)
+    return counts
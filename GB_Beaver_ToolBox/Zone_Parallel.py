@@ -0,0 +1,63 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Parallel Zone Evaluation.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It splits the search zones into contiguous Zone_no
+#                  ranges and evaluates them on a pool of worker processes. Each worker builds its own private scratch
+#                  gdb, so runs and workers never collide, and hands its per-zone results back to the parent which
+#                  writes them once at the end.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import os
+import sys
+import multiprocessing
+
+import numpy as np
+
+import Run_Trace
+
+
+def zone_chunks(zone_ids, n_chunks):
+    """Split the sorted Zone_no values into at most n_chunks contiguous (first, last) ranges of similar size."""
+    zone_ids = np.asarray(zone_ids)
+    if zone_ids.size == 0:
+        return []
+    n_chunks = max(1, min(int(n_chunks), zone_ids.size))
+    return [(int(part[0]), int(part[-1])) for part in np.array_split(zone_ids, n_chunks)]
+
+
+def _set_executable():
+    """Inside ArcMap/ArcGIS Pro sys.executable is the application, not python - point multiprocessing at the
+    interpreter shipped with it instead."""
+    if os.name != "nt" or os.path.basename(sys.executable).lower().startswith("python"):
+        return
+    for exe in ("python.exe", "pythonw.exe"):
+        path = os.path.join(sys.exec_prefix, exe)
+        if os.path.exists(path):
+            multiprocessing.set_executable(path)
+            return
+
+
+def run_zones(worker, tasks, workers=1):
+    """Run worker(task) for every task and return the results in task order.
+
+    With a single worker (or a single task) everything runs in this process; otherwise the tasks are spread over a
+    process pool of the requested size."""
+    workers = max(1, int(workers or 1))
+    if workers == 1 or len(tasks) <= 1:
+        return [worker(task) for task in tasks]
+
+    _set_executable()
+    pool = multiprocessing.Pool(min(workers, len(tasks)))
+    try:
+        if not Run_Trace.enabled():
+            return pool.map(worker, tasks, chunksize=1)
+        # workers trace into their own records, which are gathered into this run's trace
+        outputs = pool.map(Run_Trace.traced_call, [(worker, task) for task in tasks], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    for _, records in outputs:
+        Run_Trace.add_records(records)
+    return [result for result, _ in outputs]
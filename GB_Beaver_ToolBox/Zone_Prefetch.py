@@ -0,0 +1,167 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Zone Prefetch Pipeline.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It overlaps BHI tile reads with the zone statistics:
+#                  while one zone is being summarised a background thread reads the tile windows under the next few
+#                  zones, in the order they will be processed. The number of zones read ahead and the memory they
+#                  may hold are both bounded, and the time spent waiting on the reader (stall time) is reported so
+#                  the depth can be tuned, e.g. for tiles on network storage.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import time
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+import Run_Trace
+
+DEFAULT_DEPTH = 4
+DEFAULT_BUDGET_MB = 256
+
+_DONE = object()
+
+
+class _ZoneReader(object):
+    def __init__(self, prefetcher, parts):
+        """Tile reader serving the windows prefetched for one zone, falling back to a direct read."""
+        self.prefetcher = prefetcher
+        self.parts = parts
+
+    def __call__(self, tile, row, col, nrows, ncols):
+        for part_tile, part_row, part_col, arr in self.parts:
+            if (part_tile.path == tile.path and part_row <= row and part_col <= col and
+                    row + nrows <= part_row + arr.shape[0] and col + ncols <= part_col + arr.shape[1]):
+                self.prefetcher.hits += 1
+                return arr[row - part_row:row - part_row + nrows, col - part_col:col - part_col + ncols]
+        self.prefetcher.misses += 1
+        return self.prefetcher.read(tile, row, col, nrows, ncols)
+
+
+class Prefetcher(object):
+    def __init__(self, index, reader, depth=DEFAULT_DEPTH, budget_mb=DEFAULT_BUDGET_MB):
+        """Read ahead the windows of up to depth zones of a BHI_Tile_Index.TileIndex, holding at most budget_mb
+        megabytes. reader(tile, row, col, nrows, ncols) is only ever called by one thread at a time."""
+        self.index = index
+        self.reader = reader
+        self.depth = max(1, int(depth))
+        self.budget = int(float(budget_mb) * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.held_cond = threading.Condition()
+        self.held = 0
+        self.zones = 0
+        self.skipped = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.stall = 0.0
+
+    def read(self, tile, row, col, nrows, ncols):
+        with self.lock:
+            return self.reader(tile, row, col, nrows, ncols)
+
+    def _fetch(self, extent, stop):
+        if extent is None:
+            return [], 0
+        parts = self.index.tile_windows(self.index.window(*extent))
+        need = sum(p.nrows * p.ncols for p in parts)
+        if need > self.budget:
+            # larger than the whole budget - the zone reads its own windows when it gets there
+            self.skipped += 1
+            return [], 0
+
+        with self.held_cond:
+            while self.held and self.held + need > self.budget and not stop.is_set():
+                self.held_cond.wait(0.1)
+            self.held += need
+        with Run_Trace.phase("prefetch zone windows"):
+            arrays = [(p.tile, p.row, p.col, np.asarray(self.read(p.tile, p.row, p.col, p.nrows, p.ncols)))
+                      for p in parts]
+            nbytes = sum(a.nbytes for _, _, _, a in arrays)
+            Run_Trace.count(len(arrays), bytes_read=nbytes)
+        self.bytes_read += nbytes
+        return arrays, need
+
+    def _release(self, need):
+        with self.held_cond:
+            self.held -= need
+            self.held_cond.notify_all()
+
+    def run(self, zones):
+        """Yield (key, reader) for zones given as (key, (xmin, ymin, xmax, ymax)) in processing order; reader serves
+        the zone's tile windows, read in the background while the zones before it were being summarised."""
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for key, extent in zones:
+                    if stop.is_set():
+                        return
+                    parts, need = self._fetch(extent, stop)
+                    if not put((key, parts, need, None)):
+                        self._release(need)
+                        return
+            except Exception as e:
+                put((None, [], 0, e))
+                return
+            put(_DONE)
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                with Run_Trace.phase("prefetch stall"):
+                    item = q.get()
+                self.stall += time.time() - start
+                if item is _DONE:
+                    break
+                key, parts, need, error = item
+                if error is not None:
+                    raise error
+                self.zones += 1
+                try:
+                    yield key, _ZoneReader(self, parts)
+                finally:
+                    self._release(need)
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    item = q.get(timeout=0.1)
+                    if item is not _DONE:
+                        self._release(item[2])
+                except queue.Empty:
+                    pass
+
+    def summary(self):
+        """Return a one line report of the prefetch counters."""
+        return ("prefetch: {0} zones ({1} too large to read ahead), {2} reads served ahead, {3} direct reads, "
+                "{4:.1f} MB read ahead, {5:.2f} s stalled waiting for reads".format(
+                    self.zones, self.skipped, self.hits, self.misses, self.bytes_read / 1024.0 / 1024.0,
+                    self.stall))
+
+
+def zone_readers(zones, reader, prefetch=None):
+    """Yield (key, reader) for zones given as (key, extent) - read ahead by prefetch when one is given, otherwise
+    with reader itself for every zone."""
+    if prefetch is None:
+        return ((key, reader) for key, _ in zones)
+    return prefetch.run(zones)
@@ -0,0 +1,88 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Zone Result Cache.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It keeps a persistent (sqlite) cache of per-zone
+#                  results keyed by a hash of the normalised zone geometry plus a fingerprint of the BHI/BDC inputs.
+#                  Re-running an edited AOI file then only recomputes the zones that were added or changed.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import json
+import sqlite3
+import hashlib
+
+import numpy as np
+
+# coordinates are rounded to this many decimal places (mm in OSGB) before hashing
+PRECISION = 3
+
+
+def _normalise_ring(ring):
+    ring = np.round(np.asarray(ring, dtype=np.float64).reshape(-1, 2), PRECISION) + 0.0
+    if len(ring) > 1 and np.array_equal(ring[0], ring[-1]):
+        ring = ring[:-1]
+    if len(ring) < 3:
+        return None
+    # anticlockwise, starting from the lowest (x, y) vertex
+    area = np.sum(ring[:, 0] * np.roll(ring[:, 1], -1) - np.roll(ring[:, 0], -1) * ring[:, 1])
+    if area < 0:
+        ring = ring[::-1]
+    start = np.lexsort((ring[:, 1], ring[:, 0]))[0]
+    return np.roll(ring, -start, axis=0)
+
+
+def geometry_key(rings):
+    """Hash a zone given as a list of rings. The hash does not depend on ring order, ring direction, the start
+    vertex of each ring or sub-millimetre coordinate noise."""
+    rings = [r for r in (_normalise_ring(ring) for ring in rings) if r is not None]
+    rings.sort(key=lambda r: (r[0, 0], r[0, 1], len(r)))
+    digest = hashlib.sha1()
+    for ring in rings:
+        digest.update(np.ascontiguousarray(ring).tobytes())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, path, fingerprint, fields):
+        """Open (or create) a result cache file. Only results stored with the same input fingerprint and the same
+        output fields are ever returned."""
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results "
+                          "(geom TEXT, inputs TEXT, fields TEXT, vals TEXT, PRIMARY KEY (geom, inputs, fields))")
+        self.fingerprint = fingerprint
+        self.fields = list(fields)
+        self.fields_key = ",".join(self.fields)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, keys):
+        """Return {key: [values in field order]} for the keys found in the cache."""
+        found = {}
+        unique = list(set(keys))
+        for start in range(0, len(unique), 500):
+            batch = unique[start:start + 500]
+            rows = self.conn.execute(
+                "SELECT geom, vals FROM results WHERE inputs = ? AND fields = ? AND geom IN ({0})".format(
+                    ",".join("?" * len(batch))), [self.fingerprint, self.fields_key] + batch)
+            for geom, vals in rows:
+                found[geom] = json.loads(vals)
+        hits = sum(1 for key in keys if key in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def store(self, keys, results):
+        """Store the rows of a structured results array under their geometry keys."""
+        rows = [(key, self.fingerprint, self.fields_key, json.dumps([float(r[f]) for f in self.fields]))
+                for key, r in zip(keys, results)]
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", rows)
+
+    def close(self):
+        self.conn.close()
+
+    def summary(self):
+        """Return a one line report of cache hits and misses."""
+        return "result cache: {0} zones reused, {1} zones computed".format(self.hits, self.misses)
@@ -0,0 +1,103 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Hierarchical Zone Roll-up.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It rolls the statistics of a fine zone layer (e.g.
+#                  sub-catchments) up to nested parent levels (catchment, river basin district, national) without
+#                  reading the BHI or BDC network again. The fine pass keeps the mergeable state of every zone - its
+#                  BHI class histogram and area, and its clipped BDC reaches - and each level sums that state over
+#                  the zones of every parent. Pieces of one reach falling in several zones of a parent are joined into
+#                  one, so BDC_MEAN, BDC_STD and the piece counts match a run over the parent polygons, as do the
+#                  weighted, category and quantile fields. The fine zones must not overlap one another.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import csv
+
+import numpy as np
+
+import BDC_Stats_Core
+import BHI_Stats_Core
+
+# level name rolling every zone into a single parent (e.g. national)
+ALL = "*"
+ALL_KEY = "ALL"
+
+FINE_LEVEL = "Zone_no"
+COUNT_FIELD = "N_ZONES"
+
+
+def parent_index(keys):
+    """Return the distinct parent keys (sorted) and the parent position of each fine zone."""
+    parents, parent = np.unique(np.asarray(keys), return_inverse=True)
+    return parents, parent.ravel()
+
+
+def read_parent_table(path):
+    """Read a parent-key table (CSV). The first column holds a key of the fine zones, each further column the
+    parent key of one level. Returns the key field name and {level: {fine key: parent key}}."""
+    with open(path) as f:
+        rows = list(csv.reader(f))
+    header = [name.strip() for name in rows[0]]
+    levels = dict((name, {}) for name in header[1:])
+    for row in rows[1:]:
+        if not row:
+            continue
+        for name, value in zip(header[1:], row[1:]):
+            levels[name][row[0].strip()] = value.strip()
+    return header[0], levels
+
+
+def roll_up_bhi(hist, area, parent, n_parents):
+    """Sum the BHI class histograms and areas of the fine zones into their parents."""
+    parent_hist = BHI_Stats_Core.empty_histogram(n_parents)
+    np.add.at(parent_hist, parent, np.asarray(hist, dtype=np.int64))
+    return parent_hist, np.bincount(parent, weights=area, minlength=n_parents)
+
+
+def roll_up_bdc(parent, n_parents, zone_pos, reach, bdc, length, fieldset=None):
+    """Build the BDCAccumulator of the parents from the fine pieces (zone position, reach id, BDC value, clipped
+    length). The pieces of one reach within one parent become a single piece of their summed length."""
+    acc = BDC_Stats_Core.BDCAccumulator(np.arange(n_parents), fieldset)
+    if not len(reach):
+        return acc
+    n_reach = int(np.max(reach)) + 1
+    keys, first, inverse = np.unique(parent[zone_pos] * n_reach + reach, return_index=True, return_inverse=True)
+    merged = np.bincount(inverse.ravel(), weights=length, minlength=len(keys))
+    return acc.update(keys // n_reach, np.asarray(bdc)[first], merged)
+
+
+def level_table(name, keys, n_zones, *results):
+    """Build the output table of one level: its parent keys, the number of fine zones in each and the fields of
+    one or more results arrays whose Zone_no is the parent position."""
+    keys = np.asarray(keys)
+    fields = [(f, r.dtype[f]) for r in results for f in r.dtype.names if f != "Zone_no"]
+    out = np.zeros(len(keys), dtype=[(name, keys.dtype), (COUNT_FIELD, np.int64)] + fields)
+    out[name] = keys
+    out[COUNT_FIELD] = n_zones
+    for r in results:
+        for f in r.dtype.names:
+            if f != "Zone_no":
+                out[f] = r[f]
+    return out
+
+
+def roll_up(levels, hist=None, area=None, pieces=None, bhi_set=None, bdc_set=None):
+    """Roll the fine state up every level and return {level name: table}.
+
+    levels maps each level name to the parent key of every fine zone. hist and area are the fine BHI histograms and
+    zone areas, pieces the fine BDC (zone position, reach id, BDC value, clipped length) arrays; either may be None.
+    bhi_set and bdc_set are the Zone_Stats_Spec field sets of the tables (the BHI_* and BDC_* fields by default).
+    """
+    tables = {}
+    for name, keys in levels.items():
+        parents, parent = parent_index(keys)
+        n = len(parents)
+        results = []
+        if hist is not None:
+            parent_hist, parent_area = roll_up_bhi(hist, area, parent, n)
+            results.append(BHI_Stats_Core.bhi_fields(np.arange(n), parent_hist, parent_area, bhi_set))
+        if pieces is not None:
+            results.append(roll_up_bdc(parent, n, *pieces, fieldset=bdc_set).fields())
+        tables[name] = level_table(name, parents, np.bincount(parent, minlength=n), *results)
+    return tables
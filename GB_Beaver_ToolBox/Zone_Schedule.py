@@ -0,0 +1,105 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Spatial Zone Scheduling.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It orders the search zones for processing so that
+#                  each OS 100 km tile (OsGridShp/OSGB_Grid_100km.shp) is worked through once: zones lying in a
+#                  single tile are grouped by tile, tiles are visited along a Hilbert curve and the zones of each tile
+#                  along a Hilbert curve inside it, so neighbouring zones reuse cached BHI blocks and network sections.
+#                  Zones crossing a tile edge (or lying outside the grid) are handled in a final pass. Only the
+#                  processing order changes - results are always returned sorted by Zone_no.
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import numpy as np
+
+# bits per axis of the Hilbert curve cells
+HILBERT_ORDER = 16
+
+CROSS_TILE = "cross-tile"
+
+
+def hilbert_index(x, y, box, order=HILBERT_ORDER):
+    """Return the position along a Hilbert curve covering box (xmin, ymin, xmax, ymax) of each point."""
+    n = 1 << order
+    xmin, ymin, xmax, ymax = box
+    span = max(xmax - xmin, ymax - ymin, 1e-9)
+    x = np.clip(((np.asarray(x, dtype=np.float64) - xmin) / span * n).astype(np.int64), 0, n - 1)
+    y = np.clip(((np.asarray(y, dtype=np.float64) - ymin) / span * n).astype(np.int64), 0, n - 1)
+
+    d = np.zeros(x.shape, dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s >>= 1
+    return d
+
+
+def _curve_order(positions, cx, cy, box):
+    return positions[np.argsort(hilbert_index(cx[positions], cy[positions], box), kind="mergesort")]
+
+
+def schedule(extents, grid, chunk=4096):
+    """Group zones by OS 100 km tile and order them for processing.
+
+    extents is an (n, 4) array of zone xmin, ymin, xmax, ymax (NaN for zones without geometry) and grid the tile
+    names and (m, 4) tile boxes of the OS grid. Returns [(tile name, zone positions in processing order)], tiles in
+    curve order and the zones crossing tile edges last."""
+    extents = np.asarray(extents, dtype=np.float64).reshape(-1, 4)
+    names, boxes = grid
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    n = len(extents)
+
+    tile_of = np.full(n, -1, dtype=np.int64)
+    for start in range(0, n, chunk):
+        e = extents[start:start + chunk, None, :]
+        hit = ((e[..., 0] < boxes[:, 2]) & (e[..., 2] > boxes[:, 0]) &
+               (e[..., 1] < boxes[:, 3]) & (e[..., 3] > boxes[:, 1]))
+        single = hit.sum(axis=1) == 1
+        tile_of[start:start + chunk][single] = np.argmax(hit[single], axis=1)
+
+    valid = ~np.isnan(extents).any(axis=1)
+    cx = np.where(valid, (extents[:, 0] + extents[:, 2]) / 2, 0)
+    cy = np.where(valid, (extents[:, 1] + extents[:, 3]) / 2, 0)
+
+    grid_box = (boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max())
+    tile_curve = np.argsort(hilbert_index((boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2,
+                                          grid_box), kind="mergesort")
+    groups = []
+    for t in tile_curve:
+        positions = np.flatnonzero(tile_of == t)
+        if positions.size:
+            groups.append((names[t], _curve_order(positions, cx, cy, boxes[t])))
+
+    rest = np.flatnonzero(tile_of < 0)
+    if rest.size:
+        rest_box = grid_box
+        if valid[rest].any():
+            e = extents[rest[valid[rest]]]
+            rest_box = (e[:, 0].min(), e[:, 1].min(), e[:, 2].max(), e[:, 3].max())
+        groups.append((CROSS_TILE, _curve_order(rest, cx, cy, rest_box)))
+    return groups
+
+
+def split_order(groups, n_tasks):
+    """Cut the processing order into n_tasks consecutive runs of similar size, so each task works through whole
+    tiles (or neighbouring parts of one) in turn."""
+    order = np.concatenate([positions for _, positions in groups]) if groups else np.zeros(0, dtype=np.int64)
+    n_tasks = max(1, min(int(n_tasks), order.size))
+    return [part for part in np.array_split(order, n_tasks) if part.size]
+
+
+def describe(groups):
+    """Return a one line report of a schedule."""
+    n_zones = sum(len(positions) for _, positions in groups)
+    cross = sum(len(positions) for name, positions in groups if name == CROSS_TILE)
+    n_tiles = sum(1 for name, _ in groups if name != CROSS_TILE)
+    return "scheduled {0} zones over {1} OS 100 km tiles ({2} crossing tile edges, handled last)".format(
+        n_zones, n_tiles, cross)
@@ -0,0 +1,215 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Zone Statistics Specification.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It compiles a declarative list of output fields - the
+#                  statistic of each (mean, std, min, max, sum, count, weight, share, area or quantile), an optional
+#                  value range, a weighting, a scale and rounding - into the state the BHI and BDC accumulators keep
+#                  and the grouped reduction that turns that state into fields. Value ranges of all fields are cut
+#                  into one set of elementary bins, so every count, length and share field comes from a single
+#                  digitize and bincount per chunk however many fields ask for them; quantiles are taken from the
+#                  sorted values of each zone. The BHI_* and BDC_* fields are the default specification; a JSON file
+#                  can replace or extend it:
+#                      {"bhi": ["default", {"name": "BHI_MED", "stat": "quantile", "q": 0.5}],
+#                       "bdc": ["default", {"name": "BDC_P90", "stat": "quantile", "q": 0.9, "weighted": true},
+#                               {"name": "BDC_km_HI", "stat": "weight", "gt": 10, "scale": 0.001}]}
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import json
+import hashlib
+
+import numpy as np
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+STATS = ("mean", "std", "min", "max", "sum", "count", "weight", "share", "area", "quantile")
+CONDITIONS = ("eq", "gt", "ge", "lt", "le")
+OPTIONS = ("name", "stat", "q", "weighted", "scale", "round") + CONDITIONS
+
+# statistics taken over the values within a field's range - any other statistic covers every value of the zone
+BINNED = ("count", "weight", "share", "area")
+
+# a spec list item standing for the tool's default fields
+DEFAULT = "default"
+DEFAULT_ROUND = 2
+
+# shapefile (dBASE) field names are cut to this many characters
+DBF_NAME_LENGTH = 10
+
+
+def read_spec(spec):
+    """Return a specification as {tool: [field, ...]}, from None, a dict or the path of a JSON file."""
+    if not spec:
+        return {}
+    if isinstance(spec, dict):
+        return spec
+    with open(spec) as f:
+        return json.load(f)
+
+
+def _check(field):
+    if not isinstance(field, dict):
+        raise ValueError("a statistics field is an object of options or \"{0}\": {1}".format(DEFAULT, field))
+    unknown = sorted(set(field) - set(OPTIONS))
+    if not isinstance(field.get("name"), string_types) or field.get("stat") not in STATS:
+        raise ValueError("a statistics field needs a name and a stat (one of {0}): {1}".format(", ".join(STATS),
+                                                                                              field))
+    if unknown:
+        raise ValueError("unknown option(s) {0} in statistics field {1}".format(", ".join(unknown), field["name"]))
+    if field["stat"] not in BINNED and any(c in field for c in CONDITIONS):
+        raise ValueError("value ranges only apply to the {0} statistics: {1}".format(", ".join(BINNED),
+                                                                                     field["name"]))
+    if field["stat"] == "quantile" and not 0 <= float(field.get("q", -1)) <= 1:
+        raise ValueError("quantile field {0} needs a q between 0 and 1".format(field["name"]))
+
+
+def _meets(field, values):
+    """True for the values within the range of a field."""
+    values = np.asarray(values, dtype=np.float64)
+    ok = np.ones(values.shape, dtype=bool)
+    for key, test in (("eq", np.equal), ("gt", np.greater), ("ge", np.greater_equal), ("lt", np.less),
+                      ("le", np.less_equal)):
+        if key in field:
+            ok &= test(values, float(field[key]))
+    return ok
+
+
+class FieldSet(object):
+    def __init__(self, fields, default=False):
+        """The compiled output fields of one tool. The bounds of every field range cut the values into elementary
+        bins - each bound on its own and the open intervals between them - and bins that fall in the same ranges
+        are joined into groups, which are all an accumulator needs to count."""
+        for field in fields:
+            _check(field)
+        names = [f["name"] for f in fields]
+        if len(set(names)) != len(names):
+            raise ValueError("statistics field names must be unique: {0}".format(names))
+        cut = [n[:DBF_NAME_LENGTH].upper() for n in names]
+        clashes = sorted(set(n for n, c in zip(names, cut) if cut.count(c) > 1))
+        if clashes:
+            raise ValueError("statistics field names must differ in their first {0} characters, which is all a "
+                             "shapefile keeps: {1}".format(DBF_NAME_LENGTH, ", ".join(clashes)))
+        self.fields = [dict(f) for f in fields]
+        self.names = names
+        self.default = default
+        self.key = hashlib.sha1(json.dumps(self.fields, sort_keys=True).encode("utf-8")).hexdigest()
+        self.binned = [f for f in self.fields if f["stat"] in BINNED]
+        self.quantiles = any(f["stat"] == "quantile" for f in self.fields)
+
+        self.points = np.unique([float(f[c]) for f in self.binned for c in CONDITIONS if c in f])
+        p = self.points
+        if len(p):
+            # a value inside each elementary bin: below, at, between and above the bounds
+            between = np.r_[p[0] - 1, (p[:-1] + p[1:]) / 2, p[-1] + 1]
+            reps = np.empty(2 * len(p) + 1)
+            reps[0::2], reps[1::2] = between, p
+        else:
+            reps = np.zeros(1)
+        rows, self.bin_group = np.unique(self.member_of(reps), axis=0, return_inverse=True)
+        self.bin_group = self.bin_group.ravel()
+        self.group_member = rows.astype(np.float64)
+
+    @property
+    def n_groups(self):
+        return len(self.group_member)
+
+    def fingerprint(self, inputs):
+        """Extend an input fingerprint for the result cache, so fields of the same name computed differently by
+        another specification are never reused."""
+        return inputs if self.default or inputs is None else "{0}-{1}".format(inputs, self.key)
+
+    def member_of(self, values):
+        """Return which values (rows) fall within the range of each binned field (columns)."""
+        values = np.asarray(values, dtype=np.float64)
+        return np.column_stack([_meets(f, values) for f in self.binned] or [np.zeros(len(values), dtype=bool)])
+
+    def groups(self, values):
+        """Return the bin group of each value - one digitize for every field range at once."""
+        values = np.asarray(values, dtype=np.float64)
+        if not len(self.points):
+            return np.zeros(values.shape, dtype=np.int64)
+        i = np.searchsorted(self.points, values, side="left")
+        exact = self.points[np.minimum(i, len(self.points) - 1)] == values
+        return self.bin_group[2 * i + exact]
+
+    def evaluate(self, zone_ids, state):
+        """Build a structured array holding Zone_no and every field for each zone from the accumulated state.
+
+        state holds per zone: count and weight (totals), sum, mean, std, min and max (with w_mean and w_std weighted
+        by weight), group_count and group_weight (n x n_groups) and, for area fields, area (square metres) and,
+        for quantile fields, quantile(q, weighted). Zones without any value get 0 for every field."""
+        out = np.zeros(len(zone_ids), dtype=[("Zone_no", np.int64)] + [(name, np.float64) for name in self.names])
+        out["Zone_no"] = zone_ids
+        has_data = state["count"] > 0
+        safe_weight = np.where(state["weight"] > 0, state["weight"], 1)
+        binned = dict((id(f), k) for k, f in enumerate(self.binned))
+
+        for field in self.fields:
+            stat, weighted = field["stat"], bool(field.get("weighted"))
+            if stat in BINNED and any(c in field for c in CONDITIONS):
+                member = self.group_member[:, binned[id(field)]]
+                count = state["group_count"].dot(member)
+                weight = state["group_weight"].dot(member) if stat != "count" else count
+            elif stat in BINNED:
+                count = state["count"]
+                weight = state["weight"] if stat != "count" else count
+            if stat in ("mean", "std"):
+                value = state[("w_" if weighted else "") + stat]
+            elif stat in ("min", "max", "sum"):
+                value = np.where(has_data, state[stat], 0)
+            elif stat in ("count", "weight"):
+                value = weight
+            elif stat == "share":
+                value = weight / safe_weight * 100
+            elif stat == "area":
+                # from the share to 2 decimals, as the per-zone tools have always done
+                value = np.where(has_data, np.asarray(state["area"], dtype=np.float64) / 100 *
+                                 np.round(weight / safe_weight * 100, 2) / 1000000, 0)
+            else:
+                value = np.where(has_data, state["quantile"](float(field["q"]), weighted), 0)
+
+            value = value * field.get("scale", 1)
+            digits = field.get("round", DEFAULT_ROUND)
+            out[field["name"]] = np.round(value, digits) if digits is not None else value
+        return out
+
+
+def field_set(spec, tool, default_fields, stats=STATS):
+    """Compile the fields of one tool ("bhi" or "bdc") from a specification (see read_spec). A tool missing from
+    it gets default_fields; the "default" item of a field list stands for them. stats are the statistics the tool
+    can give."""
+    fields = read_spec(spec).get(tool)
+    if fields is None:
+        return FieldSet(default_fields, default=True)
+    expanded = []
+    for field in fields:
+        expanded += list(default_fields) if field == DEFAULT else [field]
+        if field != DEFAULT and isinstance(field, dict) and field.get("stat") in STATS and field["stat"] not in stats:
+            raise ValueError("the {0} statistics have no {1} field: {2}".format(tool, field["stat"], field.get("name")))
+    return FieldSet(expanded, default=expanded == list(default_fields))
+
+
+def grouped_quantile(idx, values, weights, n, q):
+    """Return the q quantile of the values of each of n groups: the smallest value whose cumulative weight (values
+    sorted within the group) reaches q of the group's total. Values of zero weight are skipped; empty groups
+    get 0."""
+    keep = np.asarray(weights) > 0
+    idx, values, weights = np.asarray(idx)[keep], np.asarray(values)[keep], np.asarray(weights)[keep]
+    out = np.zeros(n)
+    if not len(idx):
+        return out
+    order = np.lexsort((values, idx))
+    idx, values, cum = idx[order], values[order], np.cumsum(weights[order])
+    count = np.bincount(idx, minlength=n)
+    end = np.cumsum(count)
+    start = end - count
+    has = count > 0
+    before = np.where(start[has] > 0, cum[np.maximum(start[has] - 1, 0)], 0)
+    total = cum[end[has] - 1] - before
+    pos = np.clip(np.searchsorted(cum, before + q * total, side="left"), start[has], end[has] - 1)
+    out[has] = values[pos]
+    return out
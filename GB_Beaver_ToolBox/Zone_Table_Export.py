@@ -0,0 +1,66 @@
+########################################################################################################################
+########################################################################################################################
+# --- Title: Zone Statistics Table Export.
+# --- Description: This Script is part of the BeaverMod_ToolBox. It writes the per-zone results array (Zone_no plus
+#                  one column per statistic) to a flat table alongside the output features: CSV (.csv), a columnar
+#                  NumPy archive with one array per field (.npz) or, where pyarrow is installed, Parquet (.parquet).
+# --- Authors: Hugh Graham, Alan Puttock and Richard Brazier (May, 2019)
+########################################################################################################################
+########################################################################################################################
+
+import os
+import csv
+
+import numpy as np
+
+FORMATS = (".csv", ".npz", ".parquet")
+
+
+def _write_csv(results, path):
+    names = list(results.dtype.names)
+    mode, kwargs = ("wb", {}) if str is bytes else ("w", {"newline": ""})
+    with open(path, mode, **kwargs) as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        for row in results.tolist():
+            writer.writerow(row)
+
+
+def _write_npz(results, path):
+    np.savez_compressed(path, **dict((name, np.ascontiguousarray(results[name])) for name in results.dtype.names))
+
+
+def _write_parquet(results, path):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("writing .parquet tables needs pyarrow - use a .csv or .npz table instead")
+    table = pyarrow.Table.from_arrays([pyarrow.array(results[name]) for name in results.dtype.names],
+                                      names=list(results.dtype.names))
+    pyarrow.parquet.write_table(table, path)
+
+
+def write_table(results, path):
+    """Write a structured results array to path; the format is chosen from the file extension. Rows are sorted by
+    Zone_no, or by the first field of tables without one (e.g. the parent levels of Zone_Rollup)."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError("unsupported statistics table format '{0}' - use one of {1}".format(ext, ", ".join(FORMATS)))
+    results = np.asarray(results)
+    results = np.sort(results, order="Zone_no" if "Zone_no" in results.dtype.names else results.dtype.names[0])
+    {".csv": _write_csv, ".npz": _write_npz, ".parquet": _write_parquet}[ext](results, path)
+    return path
+
+
+def read_table(path):
+    """Read a .csv or .npz table written by write_table back into a structured array."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npz":
+        with np.load(path) as data:
+            names = list(data.files)
+            return np.rec.fromarrays([data[name] for name in names], names=names).view(np.ndarray)
+    if ext == ".csv":
+        data = np.genfromtxt(path, delimiter=",", names=True, dtype=None, encoding=None)
+        return np.atleast_1d(data)
+    raise ValueError("unsupported statistics table format '{0}'".format(ext))